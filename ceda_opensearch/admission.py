@@ -0,0 +1,158 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from ceda_opensearch.errors import Http503, Http503Busy
+
+
+LOGGING = logging.getLogger(__name__)
+
+
+class AdmissionLimiter(object):
+    """
+    Limit the number of requests to elastic search in progress at once, with
+    a bounded queue of requests waiting for a slot.
+
+    The limit is adjusted from the time the requests take: it is increased by
+    about one for each limit's worth of requests that finish within the
+    target latency (additive increase), and multiplied by the backoff when a
+    request is slow or fails to reach elastic search (multiplicative
+    decrease). When elastic search slows down fewer requests are sent to it,
+    and the rest are rejected quickly rather than all waiting for it.
+
+    """
+
+    def __init__(self, initial_limit, min_limit, max_limit, max_queue,
+                 queue_timeout, target_latency, backoff=0.9, retry_after=1):
+        """
+        Init the AdmissionLimiter.
+
+        @param initial_limit (int): the number of requests allowed at first
+        @param min_limit (int): the limit is never reduced below this, or
+            below one
+        @param max_limit (int): the limit is never increased above this
+        @param max_queue (int): the maximum number of requests waiting for a
+            slot, any more are rejected at once
+        @param queue_timeout (float): the maximum number of seconds a request
+            waits for a slot before it is rejected
+        @param target_latency (float): requests that take longer than this
+            number of seconds reduce the limit
+        @param backoff (float): the factor the limit is multiplied by when
+            it is reduced
+        @param retry_after (int): the number of seconds rejected clients are
+            asked to wait before trying again
+
+        """
+        self.limit = float(initial_limit)
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.target_latency = target_latency
+        self.backoff = backoff
+        self.retry_after = retry_after
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    @contextmanager
+    def admit(self):
+        """
+        Wait for a slot for a request to elastic search, and adjust the limit
+        from the time the request takes.
+
+        @raise Http503Busy if there is no slot
+
+        """
+        self._acquire()
+        start = time.monotonic()
+        failed = False
+        try:
+            yield
+        except Http503:
+            failed = True
+            raise
+        finally:
+            self._release(time.monotonic() - start, failed)
+
+    def stats(self):
+        """
+        Get the statistics for this limiter.
+
+        @return a dict of the current limit, the number of requests in
+            progress and waiting, and the number admitted and rejected
+
+        """
+        with self._condition:
+            return {'limit': int(self.limit), 'in_flight': self.in_flight,
+                    'waiting': self.waiting, 'admitted': self.admitted,
+                    'rejected': self.rejected}
+
+    def _acquire(self):
+        with self._condition:
+            if self.in_flight >= int(self.limit):
+                if self.waiting >= self.max_queue:
+                    self._reject("the queue is full")
+                self.waiting += 1
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self.in_flight >= int(self.limit):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject("no slot became free")
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+
+    def _release(self, latency, failed):
+        with self._condition:
+            self.in_flight -= 1
+            if failed or latency > self.target_latency:
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+            else:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify()
+
+    def _reject(self, reason):
+        self.rejected += 1
+        LOGGING.warning("Search rejected, %s, limit %s, in flight %s",
+                        reason, int(self.limit), self.in_flight)
+        raise Http503Busy("The search service is busy, please try again "
+                          "later", retry_after=self.retry_after)
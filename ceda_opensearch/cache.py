@@ -0,0 +1,226 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    A thread safe least recently used cache, bounded by the total size of the
+    entries, where each entry expires after a fixed time.
+
+    """
+
+    def __init__(self, max_size, ttl):
+        """
+        Init the LRUCache.
+
+        @param max_size (int): the maximum total size of the entries, if this
+            is 0 nothing is cached
+        @param ttl (float): the number of seconds an entry is valid for
+
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        Get the value for a key, counting a hit or a miss.
+
+        @param key: a hashable key
+        @param default: the value to return if there is no valid entry
+
+        @return the cached value or default
+
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, size, value = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=1):
+        """
+        Add a value to the cache, evicting the least recently used entries to
+        make space for it.
+
+        @param key: a hashable key
+        @param value: the value to cache
+        @param size (int): the size of the value, in the same units as max_size
+
+        """
+        if size > self.max_size:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self._entries and self._size + size > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            self._entries[key] = (time.monotonic() + self.ttl, size, value)
+            self._size += size
+
+    def delete(self, key):
+        """
+        Remove the entry for a key, if there is one.
+
+        @param key: a hashable key
+
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """
+        Remove all of the entries.
+
+        """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        """
+        Get the statistics for this cache.
+
+        @return a dict of the number of hits, misses and evictions plus the
+            number and total size of the entries
+
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries), 'size': self._size}
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls for the same key, so that only the first one
+    does the work and the others wait for, and share, its result.
+
+    """
+
+    def __init__(self):
+        """
+        Init the SingleFlight.
+
+        """
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, function):
+        """
+        Call the function, unless a call for the key is already running, in
+        which case wait for that call to finish and return its result.
+
+        @param key: a hashable key
+        @param function: a callable that takes no arguments
+
+        @return the result of the function
+
+        @raise the exception raised by the function, in every waiting thread
+
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function()
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        """
+        Get the statistics for this SingleFlight.
+
+        @return a dict of the number of calls made, calls that waited for
+            another call and calls currently running
+
+        """
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced,
+                    'running': len(self._calls)}
+
+
+class _Call(object):
+    """
+    A call in progress in a SingleFlight.
+
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
@@ -0,0 +1,160 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+from contextlib import contextmanager
+import logging
+import math
+import threading
+import time
+
+from ceda_opensearch.errors import Http503, Http503Busy, Http503Deadline
+
+
+LOGGING = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Stop sending requests to elastic search after it has failed a number of
+    times in a row, so that requests fail at once rather than each waiting
+    for a connection to time out.
+
+    While the breaker is open all requests are rejected. After the reset
+    timeout one request at a time is let through as a probe: if it succeeds
+    the breaker closes, if it fails the breaker opens again.
+
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        """
+        Init the CircuitBreaker.
+
+        @param failure_threshold (int): the number of failures in a row that
+            open the breaker
+        @param reset_timeout (float): the number of seconds the breaker stays
+            open before a probe is let through
+
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def call(self):
+        """
+        Let a request to elastic search through if the breaker allows it,
+        and record whether it failed. Only Http503 errors count as failures,
+        apart from Http503Busy, which means that the request was not sent, and
+        Http503Deadline, which means that the time allowed for the request ran
+        out.
+
+        @raise Http503 if the breaker is open
+
+        """
+        probe = self._before()
+        try:
+            yield
+        except (Http503Busy, Http503Deadline):
+            self._on_not_sent(probe)
+            raise
+        except Http503:
+            self._on_failure(probe)
+            raise
+        except BaseException:
+            # elastic search answered, even if the request was bad
+            self._on_success(probe)
+            raise
+        else:
+            self._on_success(probe)
+
+    def stats(self):
+        """
+        Get the statistics for this breaker.
+
+        @return a dict of the state, the number of failures in a row, and the
+            number of times the breaker has opened and requests it has
+            rejected
+
+        """
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures,
+                    'opened': self.opened, 'rejected': self.rejected}
+
+    def _before(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+            remaining = self._opened_at + self.reset_timeout - time.monotonic()
+            if remaining <= 0 and not self._probing:
+                self.state = HALF_OPEN
+                self._probing = True
+                return True
+            self.rejected += 1
+        raise Http503("The elastic search service is unavailable",
+                      retry_after=max(1, math.ceil(remaining)))
+
+    def _on_not_sent(self, probe):
+        if probe:
+            # let the next request be the probe
+            with self._lock:
+                self._probing = False
+
+    def _on_success(self, probe):
+        with self._lock:
+            if probe:
+                LOGGING.info("Circuit breaker closed")
+                self._probing = False
+                self.state = CLOSED
+            self.failures = 0
+
+    def _on_failure(self, probe):
+        with self._lock:
+            if probe:
+                self._probing = False
+            self.failures += 1
+            if probe or (self.state == CLOSED and
+                         self.failures >= self.failure_threshold):
+                LOGGING.warning("Circuit breaker opened after %s failures",
+                                self.failures)
+                self.state = OPEN
+                self.opened += 1
+                self._opened_at = time.monotonic()
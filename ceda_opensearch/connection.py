@@ -0,0 +1,181 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+from contextvars import ContextVar
+import threading
+
+from elasticsearch import Transport
+from elasticsearch.connection import Urllib3HttpConnection
+
+
+# True while a request is made whose response body is returned as text
+RAW_RESPONSE = ContextVar('raw_response', default=False)
+
+
+class CountingConnection(Urllib3HttpConnection):
+    """
+    A connection to an elastic search node that counts how its pool of
+    connections is used, so that the pool can be sized against the number of
+    server threads.
+
+    """
+
+    def __init__(self, *args, maxsize=10, **kwargs):
+        """
+        Init the CountingConnection.
+
+        @param maxsize (int): the maximum number of connections kept open to
+            the node
+
+        """
+        super(CountingConnection, self).__init__(*args, maxsize=maxsize,
+                                                 **kwargs)
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.max_in_use = 0
+        self.requests = 0
+        self.overflows = 0
+
+    def perform_request(self, *args, **kwargs):
+        with self._lock:
+            self.requests += 1
+            if self.in_use >= self.maxsize:
+                # all of the pooled connections are busy, so a new one is
+                # opened for this request and closed afterwards
+                self.overflows += 1
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        try:
+            return super(CountingConnection, self).perform_request(
+                *args, **kwargs)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+
+    def stats(self):
+        """
+        Get the statistics for the pool of connections to this node.
+
+        @return a dict with the keys:
+                'host': the URL of the node
+                'maxsize': the maximum number of connections kept open
+                'in_use': the number of requests in progress
+                'max_in_use': the most requests that have been in progress
+                    at once
+                'requests': the number of requests made
+                'overflows': the number of requests made when all of the
+                    kept connections were in use
+                'new_connections': the number of connections opened
+                'idle': the number of open connections waiting to be used
+
+        """
+        queue = getattr(self.pool.pool, 'queue', ())
+        with self._lock:
+            return {'host': self.host, 'maxsize': self.maxsize,
+                    'in_use': self.in_use, 'max_in_use': self.max_in_use,
+                    'requests': self.requests, 'overflows': self.overflows,
+                    'new_connections': self.pool.num_connections,
+                    'idle': sum(1 for conn in list(queue)
+                                if conn is not None)}
+
+
+class RawTransport(Transport):
+    """
+    A Transport that can also return the body of a response as text, without
+    parsing it, for responses that are copied into ours.
+
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RawTransport, self).__init__(*args, **kwargs)
+        self.deserializer = _RawDeserializer(self.deserializer)
+
+    def perform_raw_request(self, method, url, params=None, body=None):
+        """
+        Perform a request in the same way as perform_request, so that it is
+        retried and failed nodes are marked as dead, but return the body of
+        the response as text.
+
+        @param method (str): the HTTP method
+        @param url (str): the path of the request
+        @param params (dict): the query parameters, which may include
+            request_timeout
+        @param body: the body of the request
+
+        @return a str containing the body of the response
+
+        """
+        token = RAW_RESPONSE.set(True)
+        try:
+            return self.perform_request(method, url, params=params, body=body)
+        finally:
+            RAW_RESPONSE.reset(token)
+
+    def _get_sniff_data(self, initial=False):
+        # the nodes found by sniffing after a raw request fails are parsed
+        token = RAW_RESPONSE.set(False)
+        try:
+            return super(RawTransport, self)._get_sniff_data(initial)
+        finally:
+            RAW_RESPONSE.reset(token)
+
+
+class _RawDeserializer(object):
+    """
+    Wrap a Deserializer so that it returns the body of the response unchanged
+    for the requests made by RawTransport.perform_raw_request.
+
+    """
+
+    def __init__(self, deserializer):
+        self.deserializer = deserializer
+
+    def loads(self, s, mimetype=None):
+        if RAW_RESPONSE.get():
+            return s
+        return self.deserializer.loads(s, mimetype)
+
+
+def get_pool_stats(client):
+    """
+    Get the statistics for the connections of an elastic search client.
+
+    @param client: an Elasticsearch client created with CountingConnection
+
+    @return a list containing a dict, as returned by CountingConnection.stats,
+        for each node
+
+    """
+    return [connection.stats()
+            for connection in client.transport.connection_pool.connections
+            if isinstance(connection, CountingConnection)]
@@ -69,6 +69,9 @@ SAR_PREFIX = 'sar'
 TIME_NAMESPACE = 'http://a9.com/-/opensearch/extensions/time/1.0/'
 TIME_PREFIX = 'time'
 
+WFS_NAMESPACE = 'http://www.opengis.net/wfs/2.0'
+WFS_PREFIX = 'wfs'
+
 XLINK_NAMESPACE = 'http://www.w3.org/1999/xlink'
 XLINK_PREFIX = 'xlink'
 
@@ -30,49 +30,224 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
+import base64
+import binascii
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
 import datetime
+import hashlib
+import json
 import logging
-
-from elasticsearch.exceptions import ConnectionError, TransportError
-from elasticsearch_dsl import Search
-
-from ceda_opensearch.errors import Http400, Http503
-from ceda_opensearch.helper import get_index, import_count_and_page
+import math
+import re
+import time
+
+from elasticsearch.client.utils import _make_path
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout, \
+    NotFoundError, TransportError
+from elasticsearch_dsl import MultiSearch, Search
+from elasticsearch_dsl.utils import AttrDict
+
+from ceda_opensearch.errors import Http400, Http503, Http503Deadline
+from ceda_opensearch.helper import canonical_context, get_index, \
+    get_search_options, import_count_and_page
+from ceda_opensearch.metrics import observe, timed
 from ceda_opensearch.middleware import CedaOpensearchMiddleware
-from ceda_opensearch.settings import ELASTIC_INDEX
+from ceda_opensearch.settings import ELASTIC_EXPLAIN, ELASTIC_INDEX, \
+    ELASTIC_FACETS, ELASTIC_SEARCH_TERMS, ELASTIC_TIEBREAKER_FIELD, \
+    ELASTIC_TIMEOUT, ELASTIC_TIMEOUTS, ELASTIC_TOTALS, \
+    ELASTIC_TRACK_TOTAL_HITS, ELASTIC_UNIQUE_SORT_FIELDS, FACET_SIZE, \
+    SEARCH_SINGLE_FLIGHT
+from ceda_opensearch.slow_query import trace_context, trace_search
 
 
 LOGGING = logging.getLogger(__name__)
 
+# How each parameter is searched for. Each entry has:
+#    'fields': the fields to search, a document matches if any of them match
+#    'query': 'term' for an exact match on a keyword field, or 'match_phrase'
+#        for a case insensitive match on a text field
+#    'values': optional, a map from the upper cased value in the request to the
+#        value to search for
+# All of these queries are put in the filter context, they do not contribute to
+# a score, as the results are sorted by time, and elastic search can cache
+# them. Entries can be replaced using ELASTIC_SEARCH_TERMS in the settings.
 # N.B. bbox, geometry, minCloudCoverPercentage, maxCloudCoverPercentage,
 # startDate and endDate have been left out on purpose, there are separate calls
 # to get the bbox filter, geometry filter, cloud filter and temporal filter
 SEARCH_TERMS = {
-    'uid': 'misc.product_info.Name',
-    'dataFormat': 'data_format.format',
-    'dataOnline': 'file.location',
-    'instrument': 'misc.platform.Instrument Abbreviation',
-    'mission': 'misc.platform.Mission',
-    'name': 'misc.product_info.Name',
-    'platform': 'misc.platform.Satellite',
-    'polarisationChannels': 'misc.product_info.Polarisation',
-    'productType': 'misc.product_info.Product Type',
-    'orbitDirection': 'misc.orbit_info.Pass Direction',
-    'orbitNumber': 'misc.orbit_info.Start Orbit Number',
-    'relativeOrbitNumber': 'misc.orbit_info.Start Relative Orbit Number',
-    'resolution': 'misc.product_info.Resolution',
-    'sensorMode': ['misc.product_info.Datatake Type',
-                   'misc.platform.Instrument Mode'],
+    'uid': {'fields': ['misc.product_info.Name.keyword'],
+            'query': 'term'},
+    'dataFormat': {'fields': ['data_format.format'],
+                   'query': 'match_phrase'},
+    'dataOnline': {'fields': ['file.location.keyword'],
+                   'query': 'term',
+                   'values': {'TRUE': 'on_disk', 'FALSE': 'on_tape'}},
+    'instrument': {'fields': ['misc.platform.Instrument Abbreviation'],
+                   'query': 'match_phrase'},
+    'mission': {'fields': ['misc.platform.Mission'],
+                'query': 'match_phrase'},
+    'name': {'fields': ['misc.product_info.Name.keyword'],
+             'query': 'term'},
+    'platform': {'fields': ['misc.platform.Satellite'],
+                 'query': 'match_phrase'},
+    'polarisationChannels': {'fields': ['misc.product_info.Polarisation'],
+                             'query': 'match_phrase'},
+    'productType': {'fields': ['misc.product_info.Product Type'],
+                    'query': 'match_phrase'},
+    'orbitDirection': {'fields': ['misc.orbit_info.Pass Direction'],
+                       'query': 'match_phrase'},
+    'orbitNumber': {'fields': ['misc.orbit_info.Start Orbit Number'],
+                    'query': 'match_phrase'},
+    'relativeOrbitNumber': {
+        'fields': ['misc.orbit_info.Start Relative Orbit Number'],
+        'query': 'match_phrase'},
+    'resolution': {'fields': ['misc.product_info.Resolution'],
+                   'query': 'match_phrase'},
+    'sensorMode': {'fields': ['misc.product_info.Datatake Type',
+                              'misc.platform.Instrument Mode'],
+                   'query': 'match_phrase'},
+}
+SEARCH_TERMS.update(ELASTIC_SEARCH_TERMS)
+
+# The facets that can be counted, each is the body of an elastic search
+# aggregation. The terms facets count the values of the keyword fields for the
+# parameters in SEARCH_TERMS. Entries can be replaced using ELASTIC_FACETS in
+# the settings.
+FACETS = {
+    'instrument': {'terms': {
+        'field': 'misc.platform.Instrument Abbreviation.keyword',
+        'size': FACET_SIZE}},
+    'mission': {'terms': {'field': 'misc.platform.Mission.keyword',
+                          'size': FACET_SIZE}},
+    'platform': {'terms': {'field': 'misc.platform.Satellite.keyword',
+                           'size': FACET_SIZE}},
+    'polarisationChannels': {'terms': {
+        'field': 'misc.product_info.Polarisation.keyword',
+        'size': FACET_SIZE}},
+    'productType': {'terms': {
+        'field': 'misc.product_info.Product Type.keyword',
+        'size': FACET_SIZE}},
+    'month': {'date_histogram': {'field': 'temporal.start_time',
+                                 'calendar_interval': 'month',
+                                 'format': 'yyyy-MM',
+                                 'min_doc_count': 1}},
 }
+FACETS.update(ELASTIC_FACETS)
+
+# The facets counted if none are requested
+DEFAULT_FACETS = ('mission', 'platform', 'productType', 'month')
+
+# Elastic search will only let you page through the first 10,000 results
+MAX_RESULT_WINDOW = 10000
+
+# The value of the cursor parameter used to request the first page of results
+# in cursor mode
+CURSOR_START = '*'
+
+SORT_ORDER = [{'temporal.start_time': {'order': 'desc'}}]
+
+# Cursor searches break ties between results with the same start time, ending
+# with fields that are unique for each document, so that each result is on
+# exactly one page
+CURSOR_SORT_ORDER = SORT_ORDER + [
+    {field: {'order': 'desc'}}
+    for field in [ELASTIC_TIEBREAKER_FIELD] + list(ELASTIC_UNIQUE_SORT_FIELDS)]
+
+# The keyword field holding the uid of a document, and the path of the uid in
+# the _source
+UID_FIELD = 'misc.product_info.Name.keyword'
+UID_SOURCE_PATH = ('misc', 'product_info', 'Name')
+
+# The policies for counting the total number of results, the value of the
+# totals parameter:
+#    'exact': count all of the results
+#    'capped': count accurately up to ELASTIC_TRACK_TOTAL_HITS results
+#    'estimate': do not count, use a cached total for the same query or
+#        estimate the total from the results returned
+TOTALS_EXACT = 'exact'
+TOTALS_CAPPED = 'capped'
+TOTALS_ESTIMATE = 'estimate'
+
+# The parameters that do not change which results match a query
+PAGING_PARAMETERS = ('maximumRecords', 'startPage', 'startRecord', 'cursor',
+                     'totals')
+
+# The status codes from elastic search that mean it is unavailable
+UNAVAILABLE_STATUS = (502, 503, 504)
+
+# Map the relation of the total from elastic search to the symbol used in
+# responses
+RELATIONS = {'gte': '>=', 'lte': '<='}
+
+# For raw searches only ask for the parts of the response used to build the
+# json rows
+RAW_FILTER_PATH = 'took,timed_out,hits.total,hits.hits._source'
+
+# The time elastic search took, at the start of the body of a raw search
+# response
+RAW_TOOK_RE = re.compile(r'\{"took":(\d+),')
+
+# The start of the body of a raw search response, up to the hits
+RAW_PREFIX_RE = re.compile(
+    r'\{(?:"took":\d+,)?(?:"timed_out":(true|false),)?"hits":\{'
+    r'(?:"total":\{"value":(\d+),"relation":"(\w+)"\},?)?')
+RAW_HITS_START = '"hits":[{"_source":'
+
+# The estimated size, in bytes, of a response without any hits or buckets, and
+# of each aggregation bucket, used to size cache entries
+RESPONSE_SIZE = 1024
+BUCKET_SIZE = 100
+
+# The number of seconds after the deadline of a request that the client waits
+# for elastic search to return partial results
+DEADLINE_GRACE = 1
+
+
+class RawHits(object):
+    """
+    The _source of each hit as json text, taken directly from the elastic
+    search response body without being parsed.
+
+    """
+
+    def __init__(self, text, count):
+        """
+        Init the RawHits.
+
+        @param text (str): the _source of each hit, separated by commas
+        @param count (int): the number of hits
+
+        """
+        self.text = text
+        self.count = count
 
+    def __len__(self):
+        return self.count
 
-def get_search_results(context):
+
+def get_search_results(context, source_fields=None, explain=ELASTIC_EXPLAIN,
+                       bypass_cache=False, raw=False):
     """
     Get the search results based on the query_attr.
 
+    Results are cached, keyed on the canonical form of the context. Identical
+    searches made while this one is running wait for, and return, its
+    results. If elastic search is unavailable the last results found for the
+    search are returned, if there are any, and the 'stale' search option is
+    set.
+
     @param context (dict): the query parameters from the users request plus
     defaults from the OSQuery. This only contains parameters for registered
     OSParams.
+    @param source_fields (list): the paths of the _source fields to return, if
+    None the whole _source is returned
+    @param explain (bool): if True include an explanation of the score of each
+    hit
+    @param bypass_cache (bool): if True do not use a cached result, the cache
+    is updated with the new result
+    @param raw (bool): if True return the hits as RawHits rather than as an
+    attribute list, this cannot be used with a cursor
 
     @return a tuple containing an attribute list, a count of total results, and results relation.
     The relation is needed because elasticsearch does not calculate the true count if there are
@@ -80,67 +255,1080 @@ def get_search_results(context):
 
     """
     LOGGING.debug("get_search_results(context)")
+    cache = CedaOpensearchMiddleware.get_search_cache()
+    key = _get_cache_key(context, source_fields, explain, raw)
+    trace_context(key[0])
+    if not bypass_cache:
+        results = cache.get(key)
+        if results is not None:
+            LOGGING.debug("get_search_results returning cached results")
+            return results
+
+    try:
+        results, timed_out = _single_flight(
+            ('search',) + key,
+            lambda: _run_search(context, source_fields, explain, raw, key))
+    except Http503Deadline:
+        # the request ran out of time, elastic search may be working
+        raise
+    except Http503 as ex:
+        results = CedaOpensearchMiddleware.get_stale_cache().get(key)
+        if results is None:
+            raise
+        LOGGING.warning("get_search_results returning stale results. %s",
+                        ex.message)
+        get_search_options()['stale'] = True
+        return results
+    if timed_out:
+        get_search_options()['timed_out'] = True
+    return results
+
+
+def _run_search(context, source_fields, explain, raw, key):
+    """
+    Run a search in elastic search and cache the results, in the search
+    cache and the stale cache. Partial results, from a search that timed out,
+    are not cached.
+
+    @return a tuple containing the results, as returned by
+        get_search_results, and True if the search timed out
+
+    """
+    elastic_search = _get_search(context, source_fields, explain)
+    if raw:
+        hits, total, relation, timed_out = _execute_raw_search(
+            elastic_search)
+        total, relation = _get_total(context, total, relation, len(hits))
+        LOGGING.debug("get_search_results returning %s raw hits out of %s "
+                      "(%s)", len(hits), total, relation)
+        results = (hits, total, relation)
+        size = len(hits.text)
+    else:
+        response = _execute_search(elastic_search)
+        with timed('deserialise'):
+            results = _get_results(response, context)
+        timed_out = response.timed_out
+        size = _get_response_size(response)
+    if timed_out:
+        LOGGING.warning("The search timed out, returning partial results")
+    else:
+        CedaOpensearchMiddleware.get_search_cache().set(key, results, size)
+        CedaOpensearchMiddleware.get_stale_cache().set(key, results, size)
+    return results, timed_out
+
+
+def _single_flight(key, function):
+    """
+    Call the function, sharing the result with any identical calls made
+    while it is running, unless SEARCH_SINGLE_FLIGHT is off.
+
+    @param key: a hashable key identifying the search
+    @param function: a callable that runs the search
+
+    @return the result of the function
+
+    """
+    if not SEARCH_SINGLE_FLIGHT:
+        return function()
+    return CedaOpensearchMiddleware.get_single_flight().do(key, function)
+
+
+def get_multi_search_results(contexts, source_fields=None,
+                             explain=ELASTIC_EXPLAIN, bypass_cache=False):
+    """
+    Get the search results for a list of contexts, sending all of the
+    searches that are not in the cache to elastic search in one multi search.
+
+    Each context is searched in the same way as by get_search_results, and
+    the results are cached in the same way, apart from identical searches
+    running in other requests, which are not waited for as each search is
+    part of one multi search. If elastic search is unavailable the last
+    results found for each search are returned, if there are any.
+
+    @param contexts (list): a list of dicts of query parameters, each one
+    as would be passed to get_search_results
+    @param source_fields (list): the paths of the _source fields to return, if
+    None the whole _source is returned
+    @param explain (bool): if True include an explanation of the score of each
+    hit
+    @param bypass_cache (bool): if True do not use cached results, the cache
+    is updated with the new results
+
+    @return a list, in the order of the contexts, where each item is either a
+        tuple containing the results, as returned by get_search_results, True
+        if the search timed out and True if the results are stale or, if
+        that search failed, an Http400 or Http503
+
+    """
+    LOGGING.debug("get_multi_search_results(%s contexts)", len(contexts))
+    cache = CedaOpensearchMiddleware.get_search_cache()
+    results = [None] * len(contexts)
+    # the positions of the contexts for each search to be run, identical
+    # searches are only run once
+    pending = OrderedDict()
+    searches = []
+    for i, context in enumerate(contexts):
+        key = _get_cache_key(context, source_fields, explain, False)
+        trace_context(key[0])
+        if key in pending:
+            pending[key].append(i)
+            continue
+        if not bypass_cache:
+            cached = cache.get(key)
+            if cached is not None:
+                results[i] = (cached, False, False)
+                continue
+        try:
+            searches.append(_get_search(context, source_fields, explain))
+        except Http400 as ex:
+            results[i] = ex
+            continue
+        pending[key] = [i]
+
+    if not pending:
+        return results
+
+    try:
+        responses = _execute_multi_search(searches)
+    except Http503Deadline:
+        raise
+    except Http503 as ex:
+        stale_cache = CedaOpensearchMiddleware.get_stale_cache()
+        for key, positions in pending.items():
+            result = stale_cache.get(key)
+            for i in positions:
+                results[i] = ex if result is None else (result, False, True)
+        if not any(isinstance(result, tuple) for result in results):
+            raise
+        LOGGING.warning("get_multi_search_results returning stale results. "
+                        "%s", ex.message)
+        return results
+
+    for (key, positions), response in zip(pending.items(), responses):
+        if response is None:
+            result = Http400("The search could not be run")
+        else:
+            hits = _get_results(response, contexts[positions[0]])
+            timed_out = response.timed_out
+            if timed_out:
+                LOGGING.warning("A search in a multi search timed out, "
+                                "returning partial results")
+            else:
+                size = _get_response_size(response)
+                cache.set(key, hits, size)
+                CedaOpensearchMiddleware.get_stale_cache().set(key, hits,
+                                                               size)
+            result = (hits, timed_out, False)
+        for i in positions:
+            results[i] = result
+    return results
+
+
+def _execute_multi_search(searches):
+    """
+    Execute the searches in one multi search, converting errors from elastic
+    search.
+
+    @param searches (list): the elasticsearch_dsl Searches
+
+    @return a list containing an elasticsearch_dsl Response for each search,
+        or None if that search failed
+
+    """
+    multi_search = MultiSearch(
+        using=CedaOpensearchMiddleware.get_elasticsearch(),
+        index=ELASTIC_INDEX)
+    for elastic_search in searches:
+        multi_search = multi_search.add(elastic_search)
+    multi_search = multi_search.params(request_timeout=_get_timeout('msearch'))
+    with _convert_errors(admit=True):
+        start = time.monotonic()
+        responses = multi_search.execute(raise_on_error=False)
+    wall = time.monotonic() - start
+    _observe_search('msearch', wall, None)
+    for elastic_search, response in zip(searches, responses):
+        if response is not None:
+            body = response.to_dict()
+            hits = body.get('hits', {})
+            trace_search('msearch', elastic_search, wall, body.get('took'),
+                         len(hits.get('hits', ())),
+                         hits.get('total', {}).get('value'),
+                         body.get('timed_out'))
+    return responses
+
+
+def get_multi_search_counts(contexts, track_total_hits=MAX_RESULT_WINDOW):
+    """
+    Get the number of results for a list of contexts, using one multi search
+    that does not return any hits. The cache is not used.
+
+    @param contexts (list): a list of dicts of query parameters, each one
+    as would be passed to get_search_results
+    @param track_total_hits (int): count the results accurately up to this
+    number
+
+    @return a list, in the order of the contexts, where each item is either a
+        tuple containing a count of total results, the results relation and
+        the time, in milliseconds, elastic search took to run the search or,
+        if that search failed, an Http400
+
+    """
+    LOGGING.debug("get_multi_search_counts(%s contexts)", len(contexts))
+    counts = [None] * len(contexts)
+    pending = []
+    multi_search = MultiSearch(
+        using=CedaOpensearchMiddleware.get_elasticsearch(),
+        index=ELASTIC_INDEX)
+    for i, context in enumerate(contexts):
+        try:
+            elastic_search = _get_search(context)
+        except Http400 as ex:
+            counts[i] = ex
+            continue
+        elastic_search = elastic_search[0:0].sort()
+        multi_search = multi_search.add(
+            elastic_search.extra(track_total_hits=track_total_hits))
+        pending.append(i)
+
+    if not pending:
+        return counts
+
+    multi_search = multi_search.params(request_timeout=_get_timeout('msearch'))
+    with _convert_errors():
+        responses = multi_search.execute(raise_on_error=False)
+    for i, response in zip(pending, responses):
+        if response is None:
+            counts[i] = Http400("The search could not be run")
+            continue
+        counts[i] = (response.hits.total.value,
+                     RELATIONS.get(response.hits.total.relation, ''),
+                     response.took)
+    return counts
+
+
+def get_facets(context, facets=DEFAULT_FACETS):
+    """
+    Count the results for the values in the context, and the number of
+    results for each value of the facets.
+
+    The query is the same as for get_search_results but no hits are returned.
+    The counts are cached, keyed on the query without the paging parameters.
+
+    @param context (dict): the query parameters from the users request plus
+    defaults from the OSQuery. This only contains parameters for registered
+    OSParams.
+    @param facets (list): the names of the facets to count, from FACETS
+
+    @return a tuple containing a dict of the name of each facet to a list of
+        (value, count) tuples, a count of total results, and results relation
+
+    """
+    LOGGING.debug("get_facets(context, %s)", facets)
+    for name in facets:
+        if name not in FACETS:
+            raise Http400('Unknown facet {}, the facets are {}'.format(
+                name, ', '.join(sorted(FACETS))))
+
+    cache = CedaOpensearchMiddleware.get_facet_cache()
+    key = (_get_query_key(context), tuple(facets),
+           context.get('totals') or ELASTIC_TOTALS)
+    trace_context(canonical_context(context))
+    results = cache.get(key)
+    if results is not None:
+        return results
+    return _single_flight(('facets',) + key, lambda: _run_facets(
+        context, facets, key))
+
+
+def _run_facets(context, facets, key):
+    """
+    Run the aggregations for get_facets in elastic search and cache the
+    counts.
+
+    """
+    cache = CedaOpensearchMiddleware.get_facet_cache()
+    track_total_hits = _get_track_total_hits(context)
+    if facets:
+        # the aggregations visit every result, so counting them all costs
+        # little more
+        track_total_hits = True
+    elif track_total_hits is False:
+        # a count is needed even if the totals policy is to estimate
+        track_total_hits = ELASTIC_TRACK_TOTAL_HITS
+
     client = CedaOpensearchMiddleware.get_elasticsearch()
-    elastic_search = Search(using=client)
+    elastic_search = Search(using=client).from_dict(
+        {'query': compile_query(context),
+         'aggs': {name: FACETS[name] for name in facets}})
+    elastic_search = elastic_search.extra(track_total_hits=track_total_hits)
+    elastic_search = _add_deadline(elastic_search[0:0]).index(ELASTIC_INDEX)
+    response = _execute_search(elastic_search)
+
+    aggregations = response.to_dict().get('aggregations', {})
+    counts = {}
+    for name in facets:
+        counts[name] = [(bucket.get('key_as_string', bucket['key']),
+                         bucket['doc_count'])
+                        for bucket in aggregations[name]['buckets']]
+    # this also caches the total for searches that do not count the results
+    total, relation = _get_total(context, response.hits.total.value,
+                                 response.hits.total.relation, 0)
+    results = (counts, total, relation)
+    cache.set(key, results, _get_response_size(response))
+    return results
+
+
+def get_parameter_values(names):
+    """
+    Get the values found in elastic search for some parameters, from the
+    terms facets of all of the documents.
 
-    bool_query = {}
-    must_list = _get_must_list(context)
-    if must_list:
-        bool_query['must'] = must_list
+    @param names (list): the names of the parameters, which must also be the
+        names of terms facets in FACETS
 
-    should_list = _get_should_list(context)
-    if should_list:
-        for should in should_list:
-            # N.B. This will only work when there is one attribute with a
-            # should (sensorMode)
-            bool_query['should'] = should
-            bool_query["minimum_should_match"] = 1
+    @return a dict of the name of each parameter to a sorted list of values
 
-    filter_list = _get_filter_list(context)
-    if filter_list:
-        bool_query['filter'] = filter_list
+    """
+    counts = get_facets({}, names)[0]
+    return {name: sorted(value for value, _ in counts[name])
+            for name in names}
 
-    query_dict = {'query': {'bool': bool_query}}
+
+def _get_query_key(context):
+    """
+    Get a key for the query in the context that does not depend on the
+    paging parameters.
+
+    """
+    return tuple((name, value) for name, value in canonical_context(context)
+                 if name not in PAGING_PARAMETERS)
+
+
+def _get_cache_key(context, source_fields, explain, raw):
+    """
+    Get the key of the search results in the search cache.
+
+    """
+    return (canonical_context(context),
+            None if source_fields is None else tuple(source_fields), explain,
+            raw)
+
+
+def _get_results(response, context):
+    """
+    Get the results of a search from the response.
+
+    @param response: an elasticsearch_dsl Response
+    @param context (dict): the query parameters of the search
+
+    @return a tuple containing an attribute list, a count of total results,
+        and results relation
+
+    """
+    _add_to_uid_cache(response.hits)
+
+    if context.get('cursor'):
+        # in the same way as total, attach the cursor to the hits so that it is
+        # available when the response is rendered
+        count, _, _ = import_count_and_page(context)
+        response.hits.next_cursor = _get_next_cursor(response.hits, count)
+
+    total = getattr(response.hits, 'total', None)
+    if total is None:
+        total, relation = _get_total(context, None, None, len(response.hits))
+    else:
+        total, relation = _get_total(context, total.value, total.relation,
+                                     len(response.hits))
+    LOGGING.debug("get_search_results returning %s hits out of %s (%s)",
+                  len(response.hits), total, relation)
+    return response.hits, total, relation
+
+
+def _get_total(context, total, relation, hit_count):
+    """
+    Get the total number of results to report.
+
+    Totals from elastic search are cached, keyed on the query without the
+    paging parameters, so that when the total is not tracked the total from
+    an earlier search for the same query can be used. If there is none, the
+    total is estimated from the results of this search.
+
+    @param context (dict): the query parameters of the search
+    @param total (int): the total from elastic search, or None if the total
+    was not tracked
+    @param relation (str): the relation from elastic search, 'eq', 'gte' or
+    None
+    @param hit_count (int): the number of hits returned by the search
+
+    @return a tuple containing the total and its relation to the true number
+        of results, '' if it is the true number, '>=' if it is a lower bound
+        or '<=' if it is an upper bound
+
+    """
+    cache = CedaOpensearchMiddleware.get_search_cache()
+    key = ('totals',) + _get_query_key(context)
+    if total is not None:
+        relation = RELATIONS.get(relation, '')
+        cache.set(key, (total, relation))
+        return total, relation
+
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    # only the results up to the end of this page are known about
+    count, start_index, start_page = import_count_and_page(context)
+    if context.get('cursor'):
+        return hit_count, '>='
+    offset = _get_offset(count, start_index, start_page)
+    if hit_count == 0 and offset > 0:
+        return offset, '<='
+    if hit_count < count:
+        return offset + hit_count, ''
+    return offset + hit_count, '>='
+
+
+def _get_track_total_hits(context):
+    """
+    Get the value of track_total_hits for the totals policy of the search.
+
+    @param context (dict): the query parameters of the search
+
+    @return True, False or the number of results to count accurately up to
+
+    """
+    totals = context.get('totals') or ELASTIC_TOTALS
+    if totals == TOTALS_EXACT:
+        return True
+    if totals == TOTALS_ESTIMATE:
+        return False
+    if totals == TOTALS_CAPPED:
+        return ELASTIC_TRACK_TOTAL_HITS
+    raise Http400('totals must be one of {}, {} or {}'.format(
+        TOTALS_EXACT, TOTALS_CAPPED, TOTALS_ESTIMATE))
+
+
+def _get_search(context, source_fields=None, explain=ELASTIC_EXPLAIN):
+    """
+    Construct the elastic search Search for the values in the context.
+
+    @param context (dict): the query parameters from the users request plus
+    defaults from the OSQuery. This only contains parameters for registered
+    OSParams.
+    @param source_fields (list): the paths of the _source fields to return, if
+    None the whole _source is returned
+    @param explain (bool): if True include an explanation of the score of each
+    hit
+
+    @return an elasticsearch_dsl Search
+
+    """
+    client = CedaOpensearchMiddleware.get_elasticsearch()
+    elastic_search = Search(using=client)
+
+    with timed('compile'):
+        query_dict = {'query': compile_query(context)}
     elastic_search = elastic_search.from_dict(query_dict)
-    elastic_search = elastic_search.sort(
-        {'temporal.start_time': {'order': 'desc'}})
 
     count, start_index, start_page = import_count_and_page(context)
-    first_result = _get_offset(count, start_index, start_page)
-    last_result = first_result + count
-    if last_result < 0:
-        last_result = 0
-    if first_result < 0:
-        first_result = 0
-
-    # Elastic search will only let you page through the first 10,000 results
-    if last_result > 10000:
-        raise Http400("This server is currently only able to page through the "
-                      "first 10,000 results. You could try additional "
-                      "constraints on the query.")
-
-    elastic_search = elastic_search[first_result:last_result]
-    elastic_search = elastic_search.extra(explain=True)
-    elastic_search = elastic_search.index(ELASTIC_INDEX)
+    cursor = context.get('cursor')
+    if cursor:
+        # search_after costs the same for every page, so there is no limit on
+        # how far through the results a cursor can go
+        elastic_search = elastic_search.sort(*CURSOR_SORT_ORDER)
+        elastic_search = elastic_search[0:max(count, 0)]
+        if cursor != CURSOR_START:
+            elastic_search = elastic_search.extra(
+                search_after=decode_cursor(cursor))
+    else:
+        elastic_search = elastic_search.sort(*SORT_ORDER)
+        first_result = _get_offset(count, start_index, start_page)
+        last_result = first_result + count
+        if last_result < 0:
+            last_result = 0
+        if first_result < 0:
+            first_result = 0
+
+        if last_result > MAX_RESULT_WINDOW:
+            raise Http400("This server is currently only able to page through "
+                          "the first 10,000 results. You could try additional "
+                          "constraints on the query or page through the "
+                          "results using cursor={}.".format(CURSOR_START))
+
+        elastic_search = elastic_search[first_result:last_result]
+
+    elastic_search = elastic_search.extra(
+        track_total_hits=_get_track_total_hits(context))
+    if source_fields is not None:
+        elastic_search = elastic_search.source(includes=source_fields)
+    if explain:
+        elastic_search = elastic_search.extra(explain=True)
+    # the version of each hit is used in the etag of the results
+    elastic_search = elastic_search.extra(version=True)
+    return _add_deadline(elastic_search).index(ELASTIC_INDEX)
+
+
+def _add_deadline(elastic_search):
+    """
+    Add the time left before the deadline of the current request, if there
+    is one, as the timeout of a search.
 
-    try:
+    @param elastic_search: an elasticsearch_dsl Search
+
+    @return an elasticsearch_dsl Search
+
+    """
+    remaining = _get_remaining_time()
+    if remaining is None:
+        return elastic_search
+    # elastic search stops at the deadline and returns the hits found so far,
+    # rather than carrying on after the request has given up
+    return elastic_search.extra(timeout='{}ms'.format(int(remaining * 1000)))
+
+
+def _execute_search(elastic_search):
+    """
+    Execute the search, converting errors from elastic search.
+
+    @param elastic_search: an elasticsearch_dsl Search
+
+    @return an elasticsearch_dsl Response
+
+    """
+    elastic_search = elastic_search.params(
+        request_timeout=_get_timeout('search'))
+    with _convert_errors(admit=True):
+        start = time.monotonic()
         response = elastic_search.execute()
-    except ConnectionError:
-        LOGGING.error("ConnectionError while connecting to the elastic search "
-                      "service")
-        raise Http503("Error while connecting to the elastic search service")
-    except TransportError as ex:
-        if 'invalid_shape_exception' in str(ex):
-            msg = str(ex).split('invalid_shape_exception: ')[1].split("'")[0]
-            raise Http400(msg)
-        LOGGING.error("TransportError while connecting to the elastic search "
-                      "service. {}".format(ex))
-        raise (ex)
+    wall = time.monotonic() - start
+    _observe_search('search', wall, response.took)
+    body = response.to_dict()
+    hits = body.get('hits', {})
+    trace_search('search', elastic_search, wall, body.get('took'),
+                 len(hits.get('hits', ())),
+                 hits.get('total', {}).get('value'), body.get('timed_out'))
+    return response
 
-    LOGGING.debug("get_search_results returning %s hits out of %s (%s)",
-                  len(response.hits), response.hits.total.value, response.hits.total.relation)
 
-    return response.hits, response.hits.total.value, {'gte':'>=', 'lte': '<='}.get(response.hits.total.relation, '')
+def _observe_search(operation, wall, took):
+    """
+    Record the time a search took, as seen by this service and as reported
+    by elastic search.
+
+    @param operation (str): the kind of search
+    @param wall (float): the number of seconds until the response was read
+    @param took (int): the number of milliseconds elastic search took, or
+        None if it is not known
+
+    """
+    observe('elasticsearch_seconds', wall, operation=operation,
+            measure='wall')
+    if took is not None:
+        observe('elasticsearch_seconds', took / 1000, operation=operation,
+                measure='took')
+
+
+def _get_timeout(operation):
+    """
+    Get the timeout for a kind of request to elastic search, no later than
+    the deadline of the current request plus DEADLINE_GRACE.
+
+    @param operation (str): 'search', 'msearch', 'mget' or 'get'
+
+    @return the number of seconds from ELASTIC_TIMEOUTS, or None to use the
+        timeout of the client
+
+    """
+    timeout = ELASTIC_TIMEOUTS.get(operation)
+    remaining = _get_remaining_time()
+    if remaining is None:
+        return timeout
+    # leave time for elastic search to return partial results after the
+    # timeout in the search body
+    return min(timeout or ELASTIC_TIMEOUT, remaining + DEADLINE_GRACE)
+
+
+def _get_remaining_time():
+    """
+    Get the time left before the deadline of the current request, set in the
+    search options.
+
+    @return the number of seconds left, or None if there is no deadline
+
+    @raise Http503Deadline if the deadline has passed
+
+    """
+    deadline = get_search_options().get('deadline')
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise Http503Deadline("The time allowed for the request has run out")
+    return remaining
+
+
+def _is_past_deadline():
+    """
+    Check if the deadline of the current request has passed.
+
+    @return True if there is a deadline and it has passed
+
+    """
+    deadline = get_search_options().get('deadline')
+    return deadline is not None and time.monotonic() >= deadline
+
+
+def _execute_raw_search(elastic_search):
+    """
+    Execute the search, returning the _source of the hits without parsing
+    them.
+
+    The request is made by the transport of the client, so that it is retried
+    in the same way as other requests, but the response is returned as text.
+
+    @param elastic_search: an elasticsearch_dsl Search
+
+    @return a tuple containing RawHits, a count of total results, results
+        relation, and True if the search timed out
+
+    """
+    client = CedaOpensearchMiddleware.get_elasticsearch()
+    body = json.dumps(elastic_search.to_dict())
+    params = {'filter_path': RAW_FILTER_PATH}
+    timeout = _get_timeout('search')
+    if timeout is not None:
+        params['request_timeout'] = timeout
+    with _convert_errors(admit=True):
+        start = time.monotonic()
+        data = client.transport.perform_raw_request(
+            'POST', '/{}/_search'.format(ELASTIC_INDEX), params=params,
+            body=body)
+    wall = time.monotonic() - start
+    match = RAW_TOOK_RE.match(data)
+    took = None if match is None else int(match.group(1))
+    _observe_search('raw_search', wall, took)
+    results = _split_raw_response(data)
+    hits, total, _, timed_out = results
+    trace_search('raw_search', elastic_search, wall, took, len(hits), total,
+                 timed_out)
+    return results
+
+
+def _split_raw_response(data):
+    """
+    Get the hits from the body of a response to a search made with the
+    RAW_FILTER_PATH.
+
+    The body is of the form
+    {"took":1,"timed_out":false,"hits":{"total":{...},"hits":[{"_source":{...}}
+    ,{"_source":{...}}]}},
+    without the total if it was not tracked, so the _source of each hit can be
+    cut out of the text. Elastic search does not allow _source as a field name
+    in a document, so '},{"_source":' only occurs between hits. If the body is
+    not in the expected form it is parsed.
+
+    @param data (str): the body of the response
+
+    @return a tuple containing RawHits, a count of total results, the relation
+        from elastic search, the count and relation are None if the total was
+        not tracked, and True if the search timed out
+
+    """
+    total = relation = start = None
+    timed_out = False
+    match = RAW_PREFIX_RE.match(data)
+    if match is not None:
+        timed_out = match.group(1) == 'true'
+        if match.group(2) is not None:
+            total = int(match.group(2))
+            relation = match.group(3)
+        start = match.end()
+
+    if start is not None and start == len(data) - len('}}'):
+        text, count = '', 0
+    elif (start is not None and data.startswith(RAW_HITS_START, start) and
+            data.endswith('}]}}')):
+        text = data[start + len(RAW_HITS_START):-len('}]}}')]
+        count = text.count('},{"_source":') + 1
+        text = text.replace('},{"_source":', ',')
+    else:
+        response = json.loads(data)
+        if response.get('hits'):
+            LOGGING.warning("Unexpected raw search response, parsing it")
+        timed_out = response.get('timed_out', False)
+        response = response.get('hits', {})
+        total = response.get('total', {}).get('value')
+        relation = response.get('total', {}).get('relation')
+        sources = [json.dumps(hit['_source'], separators=(',', ':'))
+                   for hit in response.get('hits', [])]
+        text, count = ','.join(sources), len(sources)
+
+    return RawHits(text, count), total, relation, timed_out
+
+
+@contextmanager
+def _admitted():
+    """
+    Wait for the admission limiter, if there is one, to let a search be sent
+    to elastic search.
+
+    @raise Http503Busy if the search is rejected
+
+    """
+    limiter = CedaOpensearchMiddleware.get_admission_limiter()
+    if limiter is None:
+        yield
+        return
+    with limiter.admit():
+        yield
+
+
+@contextmanager
+def _convert_errors(admit=False):
+    """
+    Convert errors from elastic search into Http400 and Http503, and record
+    whether elastic search was available in the circuit breaker.
+
+    The circuit breaker is checked before waiting for the admission limiter,
+    so that the requests it rejects do not take a slot or lower the limit.
+
+    @param admit (bool): if True wait for the admission limiter to let the
+        request through
+
+    @raise Http503 if the circuit breaker is open, Http503Busy if the
+        request is not admitted, or Http503Deadline if the request timed out
+        after the deadline of the current request
+
+    """
+    breaker = CedaOpensearchMiddleware.get_circuit_breaker()
+    with breaker.call() if breaker is not None else nullcontext(), \
+            _admitted() if admit else nullcontext():
+        try:
+            yield
+        except ConnectionTimeout:
+            if _is_past_deadline():
+                # the timeout came from the time allowed for the request, not
+                # from elastic search being slow to answer
+                LOGGING.warning("Timed out after the deadline of the request")
+                raise Http503Deadline(
+                    "The time allowed for the request has run out")
+            LOGGING.error("ConnectionTimeout while connecting to the elastic "
+                          "search service")
+            raise Http503(
+                "Error while connecting to the elastic search service")
+        except ConnectionError:
+            LOGGING.error("ConnectionError while connecting to the elastic "
+                          "search service")
+            raise Http503(
+                "Error while connecting to the elastic search service")
+        except TransportError as ex:
+            if 'invalid_shape_exception' in str(ex):
+                msg = str(ex).split(
+                    'invalid_shape_exception: ')[1].split("'")[0]
+                raise Http400(msg)
+            LOGGING.error("TransportError while connecting to the elastic "
+                          "search service. {}".format(ex))
+            if ex.status_code in UNAVAILABLE_STATUS:
+                raise Http503("The elastic search service is unavailable")
+            raise (ex)
+
+
+def _get_response_size(response):
+    """
+    Estimate the memory used by a response from the size of the json of its
+    first hit and the number of hits and aggregation buckets, without
+    serialising the whole response.
+
+    @param response: an elasticsearch_dsl Response
+
+    @return an int containing the size in bytes
+
+    """
+    body = response.to_dict()
+    hits = body.get('hits', {}).get('hits', [])
+    size = RESPONSE_SIZE
+    if hits:
+        size += len(json.dumps(hits[0], default=str)) * len(hits)
+    for aggregation in body.get('aggregations', {}).values():
+        size += BUCKET_SIZE * len(aggregation.get('buckets', ()))
+    return size
+
+
+def get_results_etag(hits, total_count):
+    """
+    Get a strong etag for a page of results, based on the id and version of
+    each hit, or for RawHits on their content.
+
+    @param hits: the hits returned by get_search_results
+    @param total_count (int): the total number of possible results
+
+    @return a str containing a quoted etag
+
+    """
+    digest = hashlib.sha1(str(total_count).encode('utf-8'))
+    if isinstance(hits, RawHits):
+        # there is no metadata, so use the content
+        digest.update(hits.text.encode('utf-8'))
+        return '"{}"'.format(digest.hexdigest())
+    for hit in hits:
+        digest.update('\n{}:{}'.format(
+            hit.meta.id, getattr(hit.meta, 'version', '')).encode('utf-8'))
+    return '"{}"'.format(digest.hexdigest())
+
+
+def get_document(uid, source_fields=None, raw=False):
+    """
+    Get the document for a uid.
+
+    The index and id of the document for the uid are looked up once and
+    cached, after which the document is fetched directly from the shard that
+    holds it rather than by searching every shard. Fetched documents are also
+    cached.
+
+    @param uid (str): the uid of the document
+    @param source_fields (list): the paths of the _source fields to return, if
+    None the whole _source is returned
+    @param raw (bool): if True return the json text of the _source
+
+    @return the _source of the document as an AttrDict, or as a str if raw is
+        True, or None if there is no document for the uid
+
+    """
+    LOGGING.debug("get_document(%s)", uid)
+    if not uid:
+        return None
+    location = _get_document_locations([uid]).get(uid)
+    if location is None:
+        return None
+
+    cache = CedaOpensearchMiddleware.get_document_cache()
+    key = (location, None if source_fields is None else tuple(source_fields))
+    text = cache.get(key)
+    if text is None:
+        text = _get_source(location, source_fields)
+        if text is None:
+            # the document has gone, it may have been reindexed
+            CedaOpensearchMiddleware.get_uid_cache().delete(uid)
+            location = _get_document_locations([uid]).get(uid)
+            if location is None:
+                return None
+            text = _get_source(location, source_fields)
+            if text is None:
+                return None
+            key = (location, key[1])
+        cache.set(key, text, len(text))
+
+    if raw:
+        return text
+    return AttrDict(json.loads(text))
+
+
+def get_documents(uids, source_fields=None, raw=False):
+    """
+    Get the documents for a list of uids using a single multi get.
+
+    @param uids (list): the uids of the documents
+    @param source_fields (list): the paths of the _source fields to return, if
+    None the whole _source is returned
+    @param raw (bool): if True return the json text of each _source
+
+    @return a list containing the _source of each document as an AttrDict, or
+        as a str if raw is True, or None where there is no document for the
+        uid, in the order of the uids
+
+    """
+    LOGGING.debug("get_documents(%s uids)", len(uids))
+    locations = _get_document_locations(uids)
+    cache = CedaOpensearchMiddleware.get_document_cache()
+    fields = None if source_fields is None else tuple(source_fields)
+    texts = {}
+    missing = []
+    for location in set(locations.values()):
+        text = cache.get((location, fields))
+        if text is None:
+            missing.append(location)
+        else:
+            texts[location] = text
+
+    if missing:
+        client = CedaOpensearchMiddleware.get_elasticsearch()
+        params = {'request_timeout': _get_timeout('mget')}
+        if source_fields is not None:
+            params['_source_includes'] = ','.join(source_fields)
+        body = {'docs': [{'_index': index, '_id': doc_id}
+                         for index, doc_id in missing]}
+        with _convert_errors():
+            response = client.mget(body=body, params=params)
+        for doc in response['docs']:
+            if not doc.get('found'):
+                continue
+            location = (doc['_index'], doc['_id'])
+            text = json.dumps(doc['_source'], separators=(',', ':'))
+            cache.set((location, fields), text, len(text))
+            texts[location] = text
+
+    documents = []
+    for uid in uids:
+        text = texts.get(locations.get(uid))
+        if text is not None and not raw:
+            text = AttrDict(json.loads(text))
+        documents.append(text)
+    return documents
+
+
+def _get_document_locations(uids):
+    """
+    Get the index and id of the documents for a list of uids, from the uid
+    cache if possible.
+
+    The uids that are not cached are looked up with a single search. If more
+    than one document has the same uid the most recent is used, as it would
+    be first in the search results.
+
+    @param uids (list): the uids of the documents
+
+    @return a dict of uid to a tuple of the index and id of the document, uids
+        with no document are left out
+
+    """
+    cache = CedaOpensearchMiddleware.get_uid_cache()
+    locations = {}
+    missing = []
+    for uid in uids:
+        location = cache.get(uid)
+        if location is None:
+            missing.append(uid)
+        else:
+            locations[uid] = location
+    if not missing:
+        return locations
+
+    client = CedaOpensearchMiddleware.get_elasticsearch()
+    elastic_search = (Search(using=client)
+                      .filter('terms', **{UID_FIELD: missing})
+                      .sort(*SORT_ORDER)
+                      .source(False)
+                      .extra(collapse={'field': UID_FIELD})
+                      .index(ELASTIC_INDEX))[0:len(missing)]
+    response = _execute_search(elastic_search)
+    for hit in response.hits:
+        # the value of the collapse field is returned in the fields
+        uid = hit[UID_FIELD][0]
+        locations[uid] = (hit.meta.index, hit.meta.id)
+        cache.set(uid, locations[uid])
+    return locations
+
+
+def _add_to_uid_cache(hits):
+    """
+    Add the index and id of each hit to the uid cache, so that following
+    requests for the hits, for example from the links in an atom feed, do not
+    need to look them up.
+
+    @param hits: the hits from a search response
+
+    """
+    cache = CedaOpensearchMiddleware.get_uid_cache()
+    for hit in hits:
+        uid = hit
+        try:
+            for name in UID_SOURCE_PATH:
+                uid = uid[name]
+        except KeyError:
+            # the uid is not in the _source fields of this search
+            return
+        cache.set(uid, (hit.meta.index, hit.meta.id))
+
+
+def _get_source(location, source_fields):
+    """
+    Get the json text of the _source of a document.
+
+    @param location (tuple): the index and id of the document
+    @param source_fields (list): the paths of the _source fields to return, if
+    None the whole _source is returned
+
+    @return the _source as a str, or None if the document does not exist
+
+    """
+    client = CedaOpensearchMiddleware.get_elasticsearch()
+    params = {}
+    if source_fields is not None:
+        params['_source_includes'] = ','.join(source_fields)
+    timeout = _get_timeout('get')
+    if timeout is not None:
+        params['request_timeout'] = timeout
+    with _convert_errors():
+        try:
+            return client.transport.perform_raw_request(
+                'GET', _make_path(location[0], '_source', location[1]),
+                params=params)
+        except NotFoundError:
+            return None
+
+
+def encode_cursor(sort_values):
+    """
+    Encode the sort values of a hit as an opaque cursor.
+
+    @param sort_values (list): the sort values of the last hit on a page
+
+    @return a str containing a URL safe cursor
+
+    """
+    cursor = json.dumps(list(sort_values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode(
+        'ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor created by encode_cursor.
+
+    @param cursor (str): the cursor from the users request
+
+    @return a list containing the sort values to search after
+
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        sort_values = json.loads(
+            base64.urlsafe_b64decode((cursor + padding).encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise Http400("Invalid cursor, {}".format(cursor))
+    if (type(sort_values) != list or
+            len(sort_values) != len(CURSOR_SORT_ORDER) or
+            not all(_is_sort_value(value) for value in sort_values)):
+        raise Http400("Invalid cursor, {}".format(cursor))
+    return sort_values
+
+
+def _is_sort_value(value):
+    """
+    Check if a value from a cursor could be a sort value, a finite number or a
+    str.
+
+    """
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, str)):
+        return True
+    return isinstance(value, float) and math.isfinite(value)
+
+
+def _get_next_cursor(hits, count):
+    """
+    Get the cursor for the page following these hits.
+
+    @param hits: the hits returned by elastic search
+    @param count (int): the number of search results per page desired
+
+    @return a str containing the cursor or None if this is the last page
+
+    """
+    if count < 1 or len(hits) < count:
+        return None
+    return encode_cursor(hits[-1].meta.sort)
 
 
 def _get_offset(count, index, page):
@@ -159,56 +1347,51 @@ def _get_offset(count, index, page):
     return get_index(count, index, page) - 1
 
 
-def _get_must_list(context):
+def compile_query(context):
     """
-    Construct a list of queries based on the values in the context.
+    Construct the elastic search query for the values in the context.
+
+    All of the clauses are in the filter context.
 
     @param context (dict): the query parameters from the users request plus
     defaults from the OSQuery. This only contains parameters for registered
     OSParams.
 
-    @returns a list of strings containing queries
+    @returns a dict containing a bool query
 
     """
-    query_list = []
-    for key in SEARCH_TERMS.keys():
-        attr = context.get(key)
-        if attr:
-            if key == 'dataOnline':
-                if attr.upper() == 'TRUE':
-                    attr = 'on_disk'
-                elif attr.upper() == 'FALSE':
-                    attr = 'on_tape'
-            if type(SEARCH_TERMS[key]) == str:
-                query_list.append({"match_phrase":
-                                   {SEARCH_TERMS[key]: attr}
-                                   })
-    return query_list
+    filter_list = _get_filter_list(context)
+    if filter_list:
+        return {'bool': {'filter': filter_list}}
+    return {'bool': {}}
 
 
-def _get_should_list(context):
+def _get_term_list(context):
     """
-    Construct a list of queries based on the values in the context.
+    Construct a list of queries based on the values in the context and the
+    SEARCH_TERMS.
 
     @param context (dict): the query parameters from the users request plus
     defaults from the OSQuery. This only contains parameters for registered
     OSParams.
 
-    @returns a list of strings containing queries
+    @returns a list of dicts containing queries
 
     """
     query_list = []
-    for key in SEARCH_TERMS.keys():
+    for key in sorted(SEARCH_TERMS.keys()):
         attr = context.get(key)
-        if attr:
-            if type(SEARCH_TERMS[key]) == list:
-                should_list = []
-                for term in SEARCH_TERMS[key]:
-                    should_list.append({"match_phrase":
-                                        {term: attr}
-                                        })
-                query_list.append(should_list)
-
+        if not attr:
+            continue
+        search_term = SEARCH_TERMS[key]
+        attr = search_term.get('values', {}).get(attr.upper(), attr)
+        queries = [{search_term['query']: {field: attr}}
+                   for field in search_term['fields']]
+        if len(queries) == 1:
+            query_list.append(queries[0])
+        else:
+            query_list.append({'bool': {'should': queries,
+                                        'minimum_should_match': 1}})
     return query_list
 
 
@@ -223,7 +1406,7 @@ def _get_filter_list(context):
     @returns a list of strings containing queries
 
     """
-    filter_list = []
+    filter_list = _get_term_list(context)
     bbox = _get_bbox_query(context)
     if bbox:
         filter_list.append(bbox)
@@ -48,6 +48,34 @@ class ServiceUnavailable(HttpResponse):
     """
     status_code = 503
 
+    def __init__(self, *args, retry_after=None, **kwargs):
+        """
+        Init the ServiceUnavailable.
+
+        @param retry_after (int): if set, the number of seconds in the
+            Retry-After header
+
+        """
+        super(ServiceUnavailable, self).__init__(*args, **kwargs)
+        if retry_after is not None:
+            self['Retry-After'] = str(retry_after)
+
+
+class Http304(Exception):
+    """
+    Not modified, the client already has the results of the request.
+
+    """
+
+    def __init__(self, etag):
+        """
+        Init the Http304.
+
+        @param etag (str): the etag of the results
+
+        """
+        self.etag = etag
+
 
 class Http400(Exception):
     """
@@ -71,11 +99,30 @@ class Http503(Exception):
 
     """
 
-    def __init__(self, message=None):
+    def __init__(self, message=None, retry_after=None):
         """
         Init the Http503.
 
         @param message (str): a message about the error
+        @param retry_after (int): the number of seconds the client should wait
+            before trying again, if known
 
         """
         self.message = message
+        self.retry_after = retry_after
+
+
+class Http503Busy(Http503):
+    """
+    Service unavailable, as the request was not sent to elastic search
+    because this service is too busy.
+
+    """
+
+
+class Http503Deadline(Http503):
+    """
+    Service unavailable, as the time allowed for the request ran out. This is
+    set by the request rather than caused by elastic search.
+
+    """
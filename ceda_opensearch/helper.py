@@ -30,16 +30,25 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
+from contextlib import contextmanager
+from contextvars import ContextVar
+import math
 import mimetypes
 from posixpath import join as path_urljoin
 import socket
+import time
 from urllib.parse import urljoin, urlparse
 from urllib.parse import urlsplit, urlunsplit
+from urllib.parse import parse_qsl, urlencode
+
+from django.utils.http import parse_etags
 
 from ceda_opensearch.constants import COUNT_DEFAULT, COUNT_MAX, \
     START_PAGE_DEFAULT, OS_DESCRIPTION, OS_DESCRIPTION_TYPE, \
     START_INDEX_DEFAULT, GML_PREFIX, GML_TYPE
 from ceda_opensearch.middleware import CedaOpensearchMiddleware
+from ceda_opensearch.settings import ELASTIC_TIMEOUT, REQUEST_TIME_BUDGET, \
+    REQUEST_TIME_BUDGET_HEADER
 
 
 if not mimetypes.inited:
@@ -49,6 +58,13 @@ if ('.%s' % OS_DESCRIPTION) not in getattr(mimetypes, 'types_map').keys():
 if ('.%s' % GML_PREFIX) not in getattr(mimetypes, 'types_map').keys():
     mimetypes.add_type(GML_TYPE, '.%s' % GML_PREFIX)
 
+# Options for the searches made while handling the current request. These are
+# set by the views and read by the code called from the OSEngine, which only
+# passes on the context. The same dict is used to pass information about the
+# searches, such as the etag of the results, back to the view. There is no
+# default dict, as it would be shared by every request.
+SEARCH_OPTIONS = ContextVar('search_options', default=None)
+
 
 def build_host_url(request):
     hostname = socket.getfqdn()
@@ -72,12 +88,27 @@ def update_context(request):
 
     @return a dict containing the context
 
+    """
+    return get_context(request.GET)
+
+
+def get_context(params):
+    """
+    Add the parameters to the default parameters.
+
+    Only know parameters are added.
+
+    @param params (dict): the parameters, for example from the request GET
+        dictionary
+
+    @return a dict containing the context
+
     """
     context = CedaOpensearchMiddleware.get_osengine().create_query_dictionary()
-    if request.GET is not None:
+    if params is not None:
         for key in context.keys():
-            if key in request.GET.keys():
-                context[key] = request.GET.get(key)
+            if key in params.keys():
+                context[key] = params.get(key)
     if context.get('startPage') is None and context.get('startRecord') is None:
         context['startRecord'] = str(START_INDEX_DEFAULT)
     if int(context['maximumRecords']) > COUNT_MAX:
@@ -85,6 +116,66 @@ def update_context(request):
     return context
 
 
+def is_pretty(request):
+    """
+    Check if the request asks for the json to be pretty printed.
+
+    @param request: a HTTP request
+
+    @return True if the 'pretty' parameter is set to anything other than
+        'false' or '0'
+
+    """
+    pretty = request.GET.get('pretty')
+    return pretty is not None and pretty.lower() not in ['false', '0']
+
+
+def get_deadline(request):
+    """
+    Get the time by which the searches for a request should finish, from
+    REQUEST_TIME_BUDGET and the REQUEST_TIME_BUDGET_HEADER of the request,
+    which can only make the budget shorter. Without a REQUEST_TIME_BUDGET
+    the header is limited to ELASTIC_TIMEOUT. Values of the header that are
+    not positive finite numbers are ignored.
+
+    @param request: a HTTP request
+
+    @return a time from time.monotonic(), or None if there is no budget
+
+    """
+    budget = REQUEST_TIME_BUDGET or None
+    if REQUEST_TIME_BUDGET_HEADER:
+        header = request.META.get('HTTP_{}'.format(
+            REQUEST_TIME_BUDGET_HEADER.upper().replace('-', '_')))
+        try:
+            requested = float(header) if header else 0
+        except ValueError:
+            requested = 0
+        if requested > 0 and math.isfinite(requested):
+            limit = budget or ELASTIC_TIMEOUT
+            budget = min(limit, requested) if limit else requested
+    if budget is None:
+        return None
+    return time.monotonic() + budget
+
+
+def get_if_none_match(request):
+    """
+    Get the etags in the If-None-Match header of the request.
+
+    @param request: a HTTP request
+
+    @return a set of the quoted etags, without any weak indicator, which may
+        include '*', empty if there is no header
+
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return set()
+    return {etag[2:] if etag.startswith('W/') else etag
+            for etag in parse_etags(header)}
+
+
 def get_mime_type(iformat):
     return getattr(mimetypes, 'types_map')[(('.%s') % iformat)]
 
@@ -144,6 +235,105 @@ def import_count_and_page(context):
     return tuple(ret)
 
 
+def canonical_context(context):
+    """
+    Get a canonical form of the context, suitable for use as a cache key.
+
+    Parameters without a value are dropped and the paging parameters are
+    replaced by the number of results and the index of the first result.
+
+    @param context (dict): the query parameters from the users request plus
+    defaults from the OSQuery. This only contains parameters for registered
+    OSParams.
+
+    @return a tuple of sorted (key, value) tuples
+
+    """
+    params = {key: value for key, value in context.items()
+              if value is not None and value != ''}
+    count, start_index, start_page = import_count_and_page(context)
+    params.pop('startPage', None)
+    params['maximumRecords'] = str(count)
+    if params.get('cursor'):
+        params.pop('startRecord', None)
+    else:
+        params['startRecord'] = str(get_index(count, start_index, start_page))
+    return tuple(sorted(params.items()))
+
+
 def urljoin_path(site, path):
     segments = [s for s in path.split('/') if s]
     return urljoin(site, path_urljoin(urlparse(site).path, *segments))
+
+
+def get_path_joiner(site):
+    """
+    Get a function that joins a path to the site, giving the same result as
+    urljoin_path for a path without '.' or '..' segments.
+
+    The site is only parsed once, which makes this much faster when many paths
+    are joined to the same site.
+
+    @param site (str): a URL, i.e. FTP_SERVER
+
+    @return a function that takes a path and returns a URL
+
+    """
+    scheme, netloc, path, _, _ = urlsplit(site)
+    prefix = urlunsplit((scheme, netloc, path.rstrip('/'), '', ''))
+
+    def join(path):
+        return '%s/%s' % (prefix, '/'.join(s for s in path.split('/') if s))
+    return join
+
+
+def get_cursor_url(url, cursor):
+    """
+    Get a URL for the page of results identified by a cursor.
+
+    Any paging parameters in the URL are replaced by the cursor.
+
+    @param url (str): a search URL including any query parameters
+    @param cursor (str): the cursor for the page
+
+    @return a str containing the URL of the page
+
+    """
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    params = [(key, value) for key, value in parse_qsl(query)
+              if key not in ['cursor', 'startPage', 'startRecord']]
+    params.append(('cursor', cursor))
+    return urlunsplit((scheme, netloc, path, urlencode(params), fragment))
+
+
+def get_search_options():
+    """
+    Get the options for the searches made while handling the current request.
+
+    @return the dict of options set by search_options, or, outside of a
+        search_options block, a new empty dict so that nothing written to it
+        is shared
+
+    """
+    options = SEARCH_OPTIONS.get()
+    if options is None:
+        return {}
+    return options
+
+
+@contextmanager
+def search_options(**options):
+    """
+    Set options for the searches made within the with block.
+
+    @param options: the options, these are added to any already set
+
+    @return a dict of the options, which the searches may add to
+
+    """
+    current = dict(get_search_options(), **options)
+    token = SEARCH_OPTIONS.set(current)
+    try:
+        yield current
+    finally:
+        SEARCH_OPTIONS.reset(token)
@@ -0,0 +1,312 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+
+from ceda_opensearch.connection import get_pool_stats
+from ceda_opensearch.helper import get_search_options
+from ceda_opensearch.middleware import CedaOpensearchMiddleware
+from ceda_opensearch.slow_query import trace_stage
+
+
+# The upper bounds, in seconds, of the buckets of the latency histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   20)
+
+PREFIX = 'ceda_opensearch_'
+
+# The help text of each histogram
+HISTOGRAMS = {
+    'request_seconds': 'Time taken to handle a request, by view, format and '
+                       'status.',
+    'stage_seconds': 'Time taken by each stage of handling a request, by '
+                     'stage and format.',
+    'elasticsearch_seconds': 'Time taken by searches in elastic search, the '
+                             'wall time seen by this service and the time '
+                             'elastic search reports it took.',
+}
+
+
+class MetricsRegistry(object):
+    """
+    A thread safe set of latency histograms, rendered in the Prometheus text
+    exposition format.
+
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        Init the MetricsRegistry.
+
+        @param buckets (tuple): the sorted upper bounds of the buckets
+
+        """
+        self.buckets = buckets
+        self._histograms = {name: {} for name in HISTOGRAMS}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        """
+        Add a value to a histogram.
+
+        @param name (str): the name of the histogram, from HISTOGRAMS
+        @param value (float): the value, in seconds
+        @param labels: the labels of the series
+
+        """
+        key = tuple(sorted(labels.items()))
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._histograms[name].get(key)
+            if series is None:
+                series = [[0] * (len(self.buckets) + 1), 0.0]
+                self._histograms[name][key] = series
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        """
+        Render the histograms.
+
+        @return a list of lines in the Prometheus text format
+
+        """
+        lines = []
+        with self._lock:
+            for name in sorted(self._histograms):
+                lines.append('# HELP {}{} {}'.format(
+                    PREFIX, name, HISTOGRAMS[name]))
+                lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+                for key, (counts, total) in sorted(
+                        self._histograms[name].items()):
+                    labels = list(key)
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ('+Inf',),
+                                            counts):
+                        cumulative += count
+                        lines.append('{}{}_bucket{} {}'.format(
+                            PREFIX, name,
+                            _format_labels(labels + [('le', bound)]),
+                            cumulative))
+                    lines.append('{}{}_sum{} {}'.format(
+                        PREFIX, name, _format_labels(labels), total))
+                    lines.append('{}{}_count{} {}'.format(
+                        PREFIX, name, _format_labels(labels), cumulative))
+        return lines
+
+
+def observe(name, value, **labels):
+    """
+    Add a value to a histogram of the registry held by the
+    CedaOpensearchMiddleware.
+
+    @param name (str): the name of the histogram, from HISTOGRAMS
+    @param value (float): the value, in seconds
+    @param labels: the labels of the series
+
+    """
+    CedaOpensearchMiddleware.get_metrics().observe(name, value, **labels)
+
+
+@contextmanager
+def timed(stage, iformat=None):
+    """
+    Time the code in the with block as a stage of handling the request.
+
+    @param stage (str): the name of the stage
+    @param iformat (str): the requested format of data, if None the format in
+        the search options is used
+
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.monotonic() - start, iformat)
+
+
+def observe_stage(stage, seconds, iformat=None):
+    """
+    Record the time taken by a stage of handling the request, in the
+    histogram and in the slow query log record of the request.
+
+    @param stage (str): the name of the stage
+    @param seconds (float): the time taken
+    @param iformat (str): the requested format of data, if None the format in
+        the search options is used
+
+    """
+    if iformat is None:
+        iformat = get_search_options().get('iformat', '')
+    observe('stage_seconds', seconds, stage=stage, format=iformat)
+    trace_stage(stage, seconds)
+
+
+class MetricsMiddleware(object):
+    """
+    Django middleware that records the time taken to handle each request,
+    labelled with the name of the view class, the format and the status.
+
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.monotonic()
+        response = self.get_response(request)
+        view = getattr(request, '_metrics_view', None)
+        if view is not None:
+            observe('request_seconds', time.monotonic() - start,
+                    view=view[0], format=view[1],
+                    status=response.status_code)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, 'view_class', None)
+        if view_class is not None:
+            # the format is captured by an unnamed group in the url patterns
+            iformat = view_kwargs.get('iformat') or (
+                view_args[0] if view_args else '')
+            request._metrics_view = (view_class.__name__, iformat)
+
+
+def render_metrics():
+    """
+    Render the latency histograms and the statistics of the caches and the
+    protection of elastic search.
+
+    @return a str in the Prometheus text exposition format
+
+    """
+    lines = CedaOpensearchMiddleware.get_metrics().render()
+
+    caches = {
+        'search': CedaOpensearchMiddleware.get_search_cache(),
+        'response': CedaOpensearchMiddleware.get_response_cache(),
+        'uid': CedaOpensearchMiddleware.get_uid_cache(),
+        'document': CedaOpensearchMiddleware.get_document_cache(),
+        'facet': CedaOpensearchMiddleware.get_facet_cache(),
+        'description': CedaOpensearchMiddleware.get_description_cache(),
+        'stale': CedaOpensearchMiddleware.get_stale_cache(),
+    }
+    stats = {name: cache.stats() for name, cache in caches.items()}
+    for field, kind, text in (
+            ('hits', 'counter', 'Lookups that found a valid entry.'),
+            ('misses', 'counter', 'Lookups that found no valid entry.'),
+            ('evictions', 'counter', 'Entries removed to make space.'),
+            ('entries', 'gauge', 'Number of entries.'),
+            ('size', 'gauge', 'Total size of the entries.')):
+        name = 'cache_{}{}'.format(field,
+                                   '_total' if kind == 'counter' else '')
+        lines.extend(_render_series(
+            name, kind, text,
+            [({'cache': cache}, values[field])
+             for cache, values in sorted(stats.items())]))
+    lines.extend(_render_series(
+        'cache_hit_ratio', 'gauge',
+        'Fraction of lookups that found a valid entry.',
+        [({'cache': cache}, _ratio(values['hits'],
+                                   values['hits'] + values['misses']))
+         for cache, values in sorted(stats.items())]))
+
+    single_flight = CedaOpensearchMiddleware.get_single_flight().stats()
+    lines.extend(_render_series(
+        'single_flight_coalesced_total', 'counter',
+        'Searches that waited for an identical running search.',
+        [({}, single_flight['coalesced'])]))
+
+    limiter = CedaOpensearchMiddleware.get_admission_limiter()
+    if limiter is not None:
+        limits = limiter.stats()
+        lines.extend(_render_series(
+            'admission_limit', 'gauge',
+            'Searches allowed in elastic search at once.',
+            [({}, limits['limit'])]))
+        lines.extend(_render_series(
+            'admission_in_flight', 'gauge',
+            'Searches in elastic search.', [({}, limits['in_flight'])]))
+        lines.extend(_render_series(
+            'admission_rejected_total', 'counter',
+            'Searches rejected as elastic search was busy.',
+            [({}, limits['rejected'])]))
+
+    breaker = CedaOpensearchMiddleware.get_circuit_breaker()
+    if breaker is not None:
+        breaker_stats = breaker.stats()
+        lines.extend(_render_series(
+            'circuit_breaker_open', 'gauge',
+            '1 if requests to elastic search are being stopped.',
+            [({}, int(breaker_stats['state'] != 'closed'))]))
+        lines.extend(_render_series(
+            'circuit_breaker_rejected_total', 'counter',
+            'Requests stopped by the circuit breaker.',
+            [({}, breaker_stats['rejected'])]))
+
+    pools = get_pool_stats(CedaOpensearchMiddleware.get_elasticsearch())
+    for field, kind, text in (
+            ('in_use', 'gauge', 'Requests in progress to the node.'),
+            ('requests', 'counter', 'Requests made to the node.'),
+            ('overflows', 'counter',
+             'Requests made when all kept connections were in use.'),
+            ('new_connections', 'counter', 'Connections opened.')):
+        name = 'elasticsearch_connection_{}{}'.format(
+            field, '_total' if kind == 'counter' else '')
+        lines.extend(_render_series(
+            name, kind, text,
+            [({'host': pool['host']}, pool[field]) for pool in pools]))
+    return '\n'.join(lines) + '\n'
+
+
+def _render_series(name, kind, text, samples):
+    lines = ['# HELP {}{} {}'.format(PREFIX, name, text),
+             '# TYPE {}{} {}'.format(PREFIX, name, kind)]
+    for labels, value in samples:
+        lines.append('{}{}{} {}'.format(
+            PREFIX, name, _format_labels(sorted(labels.items())), value))
+    return lines
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels))
+
+
+def _ratio(part, whole):
+    return part / whole if whole else 0.0
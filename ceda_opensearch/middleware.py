@@ -34,7 +34,23 @@ import logging
 
 from elasticsearch_dsl.connections import connections
 
-from ceda_opensearch.settings import ELASTIC_HOST
+from ceda_opensearch.admission import AdmissionLimiter
+from ceda_opensearch.cache import LRUCache, SingleFlight
+from ceda_opensearch.circuit_breaker import CircuitBreaker
+from ceda_opensearch.connection import CountingConnection, RawTransport
+from ceda_opensearch.settings import ADMISSION_CONTROL, \
+    ADMISSION_INITIAL_LIMIT, ADMISSION_MAX_LIMIT, ADMISSION_MAX_QUEUE, \
+    ADMISSION_MIN_LIMIT, ADMISSION_QUEUE_TIMEOUT, ADMISSION_RETRY_AFTER, \
+    ADMISSION_TARGET_LATENCY, CIRCUIT_BREAKER_FAILURES, \
+    CIRCUIT_BREAKER_RESET_TIMEOUT, DESCRIPTION_CACHE_MAX_SIZE, \
+    DESCRIPTION_CACHE_TTL, DOCUMENT_CACHE_MAX_SIZE, DOCUMENT_CACHE_TTL, \
+    ELASTIC_HOST, ELASTIC_HOSTS, ELASTIC_HTTP_COMPRESS, \
+    ELASTIC_MAX_CONNECTIONS, ELASTIC_MAX_RETRIES, ELASTIC_RETRY_ON_STATUS, \
+    ELASTIC_RETRY_ON_TIMEOUT, ELASTIC_SNIFF, ELASTIC_SNIFF_INTERVAL, \
+    ELASTIC_TIMEOUT, FACET_CACHE_MAX_SIZE, FACET_CACHE_TTL, \
+    RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_TTL, SEARCH_CACHE_MAX_SIZE, \
+    SEARCH_CACHE_TTL, STALE_CACHE_MAX_SIZE, STALE_CACHE_TTL, \
+    STATUS_REFRESH_INTERVAL, UID_CACHE_MAX_ENTRIES, UID_CACHE_TTL
 
 
 LOGGING = logging.getLogger(__name__)
@@ -47,6 +63,18 @@ class CedaOpensearchMiddleware(object):
     """
     __elasticsearch = None
     __osEngine = None
+    __search_cache = None
+    __response_cache = None
+    __uid_cache = None
+    __document_cache = None
+    __status_runner = None
+    __facet_cache = None
+    __description_cache = None
+    __single_flight = None
+    __admission_limiter = None
+    __circuit_breaker = None
+    __stale_cache = None
+    __metrics = None
 
     @classmethod
     def __init_os_engine(cls):
@@ -68,7 +96,20 @@ class CedaOpensearchMiddleware(object):
     def __init_elasticsearch(cls):
         LOGGING.info("__init_os_engine - Elastic Search connection created")
         CedaOpensearchMiddleware.__elasticsearch = (
-            connections.create_connection(hosts=[ELASTIC_HOST], timeout=20))
+            connections.create_connection(
+                hosts=ELASTIC_HOSTS or [ELASTIC_HOST],
+                connection_class=CountingConnection,
+                transport_class=RawTransport,
+                timeout=ELASTIC_TIMEOUT,
+                maxsize=ELASTIC_MAX_CONNECTIONS,
+                http_compress=ELASTIC_HTTP_COMPRESS,
+                sniff_on_start=ELASTIC_SNIFF,
+                sniff_on_connection_fail=ELASTIC_SNIFF,
+                sniffer_timeout=(ELASTIC_SNIFF_INTERVAL if ELASTIC_SNIFF
+                                 else None),
+                max_retries=ELASTIC_MAX_RETRIES,
+                retry_on_status=ELASTIC_RETRY_ON_STATUS,
+                retry_on_timeout=ELASTIC_RETRY_ON_TIMEOUT))
 
     @classmethod
     def get_elasticsearch(cls, debug=False):
@@ -79,3 +120,217 @@ class CedaOpensearchMiddleware(object):
         if debug or CedaOpensearchMiddleware.__elasticsearch is None:
             CedaOpensearchMiddleware.__init_elasticsearch()
         return CedaOpensearchMiddleware.__elasticsearch
+
+    @classmethod
+    def __init_search_cache(cls):
+        LOGGING.info("__init_search_cache - search cache created")
+        CedaOpensearchMiddleware.__search_cache = LRUCache(
+            SEARCH_CACHE_MAX_SIZE, SEARCH_CACHE_TTL)
+
+    @classmethod
+    def get_search_cache(cls):
+        """
+        Get the cache of search results, create one if necessary.
+
+        """
+        if CedaOpensearchMiddleware.__search_cache is None:
+            CedaOpensearchMiddleware.__init_search_cache()
+        return CedaOpensearchMiddleware.__search_cache
+
+    @classmethod
+    def __init_response_cache(cls):
+        LOGGING.info("__init_response_cache - response cache created")
+        CedaOpensearchMiddleware.__response_cache = LRUCache(
+            RESPONSE_CACHE_MAX_SIZE, RESPONSE_CACHE_TTL)
+
+    @classmethod
+    def get_response_cache(cls):
+        """
+        Get the cache of rendered search responses, create one if necessary.
+
+        """
+        if CedaOpensearchMiddleware.__response_cache is None:
+            CedaOpensearchMiddleware.__init_response_cache()
+        return CedaOpensearchMiddleware.__response_cache
+
+    @classmethod
+    def __init_uid_cache(cls):
+        LOGGING.info("__init_uid_cache - uid cache created")
+        CedaOpensearchMiddleware.__uid_cache = LRUCache(
+            UID_CACHE_MAX_ENTRIES, UID_CACHE_TTL)
+
+    @classmethod
+    def get_uid_cache(cls):
+        """
+        Get the cache of the index and id of the document for each uid, create
+        one if necessary.
+
+        """
+        if CedaOpensearchMiddleware.__uid_cache is None:
+            CedaOpensearchMiddleware.__init_uid_cache()
+        return CedaOpensearchMiddleware.__uid_cache
+
+    @classmethod
+    def __init_document_cache(cls):
+        LOGGING.info("__init_document_cache - document cache created")
+        CedaOpensearchMiddleware.__document_cache = LRUCache(
+            DOCUMENT_CACHE_MAX_SIZE, DOCUMENT_CACHE_TTL)
+
+    @classmethod
+    def get_document_cache(cls):
+        """
+        Get the cache of documents fetched by uid, create one if necessary.
+
+        """
+        if CedaOpensearchMiddleware.__document_cache is None:
+            CedaOpensearchMiddleware.__init_document_cache()
+        return CedaOpensearchMiddleware.__document_cache
+
+    @classmethod
+    def __init_facet_cache(cls):
+        LOGGING.info("__init_facet_cache - facet cache created")
+        CedaOpensearchMiddleware.__facet_cache = LRUCache(
+            FACET_CACHE_MAX_SIZE, FACET_CACHE_TTL)
+
+    @classmethod
+    def get_facet_cache(cls):
+        """
+        Get the cache of facet counts, create one if necessary.
+
+        """
+        if CedaOpensearchMiddleware.__facet_cache is None:
+            CedaOpensearchMiddleware.__init_facet_cache()
+        return CedaOpensearchMiddleware.__facet_cache
+
+    @classmethod
+    def __init_description_cache(cls):
+        LOGGING.info("__init_description_cache - description cache created")
+        CedaOpensearchMiddleware.__description_cache = LRUCache(
+            DESCRIPTION_CACHE_MAX_SIZE, DESCRIPTION_CACHE_TTL)
+
+    @classmethod
+    def get_description_cache(cls):
+        """
+        Get the cache of rendered description documents, create one if
+        necessary.
+
+        """
+        if CedaOpensearchMiddleware.__description_cache is None:
+            CedaOpensearchMiddleware.__init_description_cache()
+        return CedaOpensearchMiddleware.__description_cache
+
+    @classmethod
+    def __init_single_flight(cls):
+        LOGGING.info("__init_single_flight - single flight created")
+        CedaOpensearchMiddleware.__single_flight = SingleFlight()
+
+    @classmethod
+    def get_single_flight(cls):
+        """
+        Get the SingleFlight that coalesces identical concurrent searches,
+        create one if necessary.
+
+        """
+        if CedaOpensearchMiddleware.__single_flight is None:
+            CedaOpensearchMiddleware.__init_single_flight()
+        return CedaOpensearchMiddleware.__single_flight
+
+    @classmethod
+    def __init_admission_limiter(cls):
+        LOGGING.info("__init_admission_limiter - admission limiter created")
+        CedaOpensearchMiddleware.__admission_limiter = AdmissionLimiter(
+            ADMISSION_INITIAL_LIMIT, ADMISSION_MIN_LIMIT, ADMISSION_MAX_LIMIT,
+            ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT,
+            ADMISSION_TARGET_LATENCY, retry_after=ADMISSION_RETRY_AFTER)
+
+    @classmethod
+    def get_admission_limiter(cls):
+        """
+        Get the limiter of the searches sent to elastic search, create one if
+        necessary.
+
+        @return an AdmissionLimiter, or None if ADMISSION_CONTROL is off
+
+        """
+        if not ADMISSION_CONTROL:
+            return None
+        if CedaOpensearchMiddleware.__admission_limiter is None:
+            CedaOpensearchMiddleware.__init_admission_limiter()
+        return CedaOpensearchMiddleware.__admission_limiter
+
+    @classmethod
+    def __init_circuit_breaker(cls):
+        LOGGING.info("__init_circuit_breaker - circuit breaker created")
+        CedaOpensearchMiddleware.__circuit_breaker = CircuitBreaker(
+            CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET_TIMEOUT)
+
+    @classmethod
+    def get_circuit_breaker(cls):
+        """
+        Get the circuit breaker of the requests to elastic search, create one
+        if necessary.
+
+        @return a CircuitBreaker, or None if CIRCUIT_BREAKER_FAILURES is 0
+
+        """
+        if not CIRCUIT_BREAKER_FAILURES:
+            return None
+        if CedaOpensearchMiddleware.__circuit_breaker is None:
+            CedaOpensearchMiddleware.__init_circuit_breaker()
+        return CedaOpensearchMiddleware.__circuit_breaker
+
+    @classmethod
+    def __init_stale_cache(cls):
+        LOGGING.info("__init_stale_cache - stale cache created")
+        CedaOpensearchMiddleware.__stale_cache = LRUCache(
+            STALE_CACHE_MAX_SIZE, STALE_CACHE_TTL)
+
+    @classmethod
+    def get_stale_cache(cls):
+        """
+        Get the cache of the last results of each search, create one if
+        necessary.
+
+        """
+        if CedaOpensearchMiddleware.__stale_cache is None:
+            CedaOpensearchMiddleware.__init_stale_cache()
+        return CedaOpensearchMiddleware.__stale_cache
+
+    @classmethod
+    def __init_metrics(cls):
+        from ceda_opensearch.metrics import MetricsRegistry
+        LOGGING.info("__init_metrics - metrics registry created")
+        CedaOpensearchMiddleware.__metrics = MetricsRegistry()
+
+    @classmethod
+    def get_metrics(cls):
+        """
+        Get the registry of the latency histograms, create one if necessary.
+
+        """
+        if CedaOpensearchMiddleware.__metrics is None:
+            CedaOpensearchMiddleware.__init_metrics()
+        return CedaOpensearchMiddleware.__metrics
+
+    @classmethod
+    def __init_status_runner(cls):
+        from ceda_opensearch.status import StatusRunner
+        LOGGING.info("__init_status_runner - status runner started")
+        CedaOpensearchMiddleware.__status_runner = StatusRunner(
+            STATUS_REFRESH_INTERVAL)
+        CedaOpensearchMiddleware.__status_runner.start()
+
+    @classmethod
+    def get_status_runner(cls):
+        """
+        Get the background runner of the status checks, start one if
+        necessary.
+
+        @return a StatusRunner, or None if STATUS_REFRESH_INTERVAL is 0
+
+        """
+        if not STATUS_REFRESH_INTERVAL:
+            return None
+        if CedaOpensearchMiddleware.__status_runner is None:
+            CedaOpensearchMiddleware.__init_status_runner()
+        return CedaOpensearchMiddleware.__status_runner
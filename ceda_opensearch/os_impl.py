@@ -31,8 +31,11 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import datetime
+import json
 import logging
 import os
+import time
+from urllib.parse import urlencode
 
 from ceda_markup.atom.atom import ATOM_NAMESPACE, ATOM_PREFIX, createID, \
     createUpdated, createPublished, createEntry, createLink
@@ -44,14 +47,19 @@ from ceda_opensearch.constants import CEDA_NAMESPACE, EO_NAMESPACE, \
     GEO_NAMESPACE, DCT_NAMESPACE, CEDA_PREFIX, EO_PREFIX, \
     GEO_PREFIX, DCT_PREFIX, TIME_NAMESPACE, TIME_PREFIX, OS_PATH, \
     COUNT_DEFAULT, PARAM_PREFIX, PARAM_NAMESPACE, SAFE_PREFIX, SAFE_NAMESPACE
-from ceda_opensearch.elastic_search import get_search_results
-from ceda_opensearch.helper import get_index, get_mime_type, \
-    import_count_and_page, urljoin_path
+from ceda_opensearch.elastic_search import RawHits, TOTALS_CAPPED, \
+    TOTALS_ESTIMATE, TOTALS_EXACT, get_results_etag, get_search_results
+from ceda_opensearch.errors import Http304
+from ceda_opensearch.helper import get_cursor_url, get_index, \
+    get_mime_type, get_path_joiner, get_search_options, import_count_and_page
 from ceda_opensearch.settings import ELASTIC_INDEX, FTP_SERVER, PYDAP_SERVER
 
 
 LOGGING = logging.getLogger(__name__)
 
+_ftp_url = get_path_joiner(FTP_SERVER)
+_pydap_url = get_path_joiner(PYDAP_SERVER)
+
 
 class COSAtomResponse(OSAtomResponse):
     """
@@ -67,6 +75,10 @@ class COSAtomResponse(OSAtomResponse):
         generate_entries
 
     """
+    # the _source fields read by generate_entries
+    SOURCE_FIELDS = ['misc.product_info.Name',
+                     'misc.product_info.Product Class Description',
+                     'temporal.start_time', 'temporal.end_time', 'file.*']
 
     def __init__(self):
         """
@@ -84,6 +96,8 @@ class COSAtomResponse(OSAtomResponse):
         @param results (dict): a dict with keys:
                             'results': a list of json objects
                             'total_count': the total number of possible results
+                            'relation': the relation of total_count to the
+                                true number of results
         @param context (dict): the query parameters from the users request plus
             defaults from the OSQuery. This only contains parameters for
             registered OSParams.
@@ -97,7 +111,11 @@ class COSAtomResponse(OSAtomResponse):
         count, start_index, start_page = import_count_and_page(context)
         index = get_index(count, start_index, start_page)
         subtitle = self._get_subtitle(
-            index, len(results['results']), results['total_count'], context)
+            index, len(results['results']), results['total_count'], context,
+            results.get('relation', ''))
+        if results.get('timed_out'):
+            subtitle = ('The search timed out, so these results may be '
+                        'incomplete. %s' % subtitle)
         authors = [Person("CEDA")]
         return Result(count, index, start_page, results['total_count'],
                       subresult=results['results'], title=title,
@@ -121,75 +139,149 @@ class COSAtomResponse(OSAtomResponse):
         if subresults is None:
             return
 
-        entries = []
+        self._set_cursor_links(atomroot, subresults)
+
+        options = get_search_options()
+        if options.get('stream'):
+            # the entries are serialised by the view as they are created, so
+            # declare their namespaces on the root now
+            if atomroot.get('xmlns:{}'.format(DCT_PREFIX)) is None:
+                atomroot.set('xmlns:{}'.format(DCT_PREFIX), DCT_NAMESPACE)
+            options['entries'] = self._generate_entry_elements(
+                atomroot, subresults, url)
+            return
+
+        for entry in self._generate_entry_elements(atomroot, subresults, url):
+            atomroot.append(entry)
+
+    def _generate_entry_elements(self, atomroot, subresults, url):
+        """
+        Generate an atom entry for each of the subresults.
+
+        @param atomroot (ElementTree.Element): the root tag of the document
+                containing the entries
+        @param subresults (list): a list of json objects
+        @param url (str): a URL including path
+
+        @return a generator of ElementTree.Element
+
+        """
+        template = self._get_entry_template(url)
         for subresult in subresults:
-            uid = subresult.misc.product_info.Name
-            _id = '%s?uid=%s' % (url, uid)
-            atom_id = createID(_id, root=atomroot)
+            yield self._create_entry(atomroot, subresult, template)
 
-            try:
-                title = subresult.misc.product_info[
-                    'Product Class Description']
-            except (AttributeError, KeyError):
-                title = uid
-            ititle = createTitle(root=atomroot, body=title, itype=TEXT_TYPE)
-            atom_content = None
-            time_doc = datetime.datetime.now().isoformat()
-            atom_updated = createUpdated(time_doc,
+    def _get_entry_template(self, url):
+        """
+        Get the values that are the same for every entry in a response.
+
+        @param url (str): a URL including path
+
+        @return a dict containing the prefixes of the id and resource links,
+            the mime types of the resource links and the time of the entries
+
+        """
+        resource_url = url.replace('/{}/'.format(OS_PATH), '/resource/')
+        return {
+            'id': '%s?uid=' % url,
+            'gml': '%s?uid=' % resource_url.replace('/atom', '/gml'),
+            'gml_type': get_mime_type('gml'),
+            'json': '%s?uid=' % resource_url.replace('atom', 'json'),
+            'json_type': get_mime_type('json'),
+            'time': datetime.datetime.now().isoformat(),
+            'mime_types': {},
+        }
+
+    def _create_entry(self, atomroot, subresult, template):
+        """
+        Create an atom entry for a subresult.
+
+        """
+        uid = subresult.misc.product_info.Name
+        atom_id = createID(template['id'] + uid, root=atomroot)
+
+        try:
+            title = subresult.misc.product_info[
+                'Product Class Description']
+        except (AttributeError, KeyError):
+            title = uid
+        ititle = createTitle(root=atomroot, body=title, itype=TEXT_TYPE)
+        atom_content = None
+        time_doc = template['time']
+        atom_updated = createUpdated(time_doc,
+                                     root=atomroot)
+        atom_published = createPublished(time_doc,
                                          root=atomroot)
-            atom_published = createPublished(time_doc,
-                                             root=atomroot)
-            entry = createEntry(atom_id, ititle, atom_updated,
-                                published=atom_published,
-                                content=atom_content, root=atomroot)
-            entry.append(
-                createSimpleMarkup(uid, atomroot, 'identifier',
-                                   DCT_NAMESPACE, DCT_PREFIX))
-            date_str = '{start}Z/{end}Z'.format(
-                start=subresult.temporal.start_time,
-                end=subresult.temporal.end_time)
-
-            entry.append(createSimpleMarkup(date_str, atomroot, 'date',
-                                            DCT_NAMESPACE, DCT_PREFIX))
-
-            resource_url = url.replace('/{}/'.format(OS_PATH), '/resource/')
-
-            gml_url = resource_url.replace('/atom', '/gml')
-            gml_uri = '%s?uid=%s' % (gml_url, uid)
-            entry.append(createLink(gml_uri, 'alternate',
-                                    get_mime_type('gml'), atomroot))
-
-            json_url = resource_url.replace('atom', 'json')
-            json_uri = '%s?uid=%s' % (json_url, uid)
-            entry.append(createLink(json_uri, 'alternate',
-                                    get_mime_type('json'), atomroot))
-
-            directory = subresult.file.directory
-
-            # data files
-            if subresult.file.location == "on_disk":
-                self._add_data_files(subresult, directory, atomroot, entry)
-
-            # metadata
-            file_name = subresult.file.metadata_file
-            self._add_file_links(file_name, directory, atomroot, entry, 'via')
-
-            # add quick look
-            try:
-                file_name = subresult.file.quicklook_file
-                if file_name != "":
-                    self._add_file_links(file_name, directory, atomroot, entry,
-                                         'icon')
-            except AttributeError:
-                # no quick look
-                pass
+        entry = createEntry(atom_id, ititle, atom_updated,
+                            published=atom_published,
+                            content=atom_content, root=atomroot)
+        entry.append(
+            createSimpleMarkup(uid, atomroot, 'identifier',
+                               DCT_NAMESPACE, DCT_PREFIX))
+        date_str = '{start}Z/{end}Z'.format(
+            start=subresult.temporal.start_time,
+            end=subresult.temporal.end_time)
+
+        entry.append(createSimpleMarkup(date_str, atomroot, 'date',
+                                        DCT_NAMESPACE, DCT_PREFIX))
+
+        entry.append(createLink(template['gml'] + uid, 'alternate',
+                                template['gml_type'], atomroot))
+        entry.append(createLink(template['json'] + uid, 'alternate',
+                                template['json_type'], atomroot))
+
+        directory = subresult.file.directory
+        mime_types = template['mime_types']
+
+        # data files
+        if subresult.file.location == "on_disk":
+            self._add_data_files(subresult, directory, atomroot, entry,
+                                 mime_types)
+
+        # metadata
+        file_name = subresult.file.metadata_file
+        self._add_file_links(file_name, directory, atomroot, entry, 'via',
+                             mime_types)
+
+        # add quick look
+        try:
+            file_name = subresult.file.quicklook_file
+            if file_name != "":
+                self._add_file_links(file_name, directory, atomroot, entry,
+                                     'icon', mime_types)
+        except AttributeError:
+            # no quick look
+            pass
 
-            entries.append(entry)
+        return entry
 
-        for entry in entries:
-            atomroot.append(entry)
+    def _set_cursor_links(self, atomroot, subresults):
+        """
+        In cursor mode replace the index based navigation links with a 'next'
+        link containing the cursor for the following page.
+
+        """
+        try:
+            next_cursor = subresults.next_cursor
+        except AttributeError:
+            # not in cursor mode
+            return
+
+        self_url = None
+        for link in list(atomroot):
+            if link.tag.split('}')[-1].split(':')[-1] != 'link':
+                continue
+            if link.get('rel') == 'self':
+                self_url = link.get('href')
+            elif link.get('rel') in ['first', 'previous', 'next', 'last']:
+                atomroot.remove(link)
+
+        if next_cursor is None or self_url is None:
+            return
+        atomroot.append(createLink(get_cursor_url(self_url, next_cursor),
+                                   'next', get_mime_type('atom'), atomroot))
 
-    def _add_data_files(self, subresult, directory, atomroot, entry):
+    def _add_data_files(self, subresult, directory, atomroot, entry,
+                        mime_types):
         """
         Update the 'entry' with links to the data file(s).
 
@@ -199,35 +291,42 @@ class COSAtomResponse(OSAtomResponse):
             file_names = subresult.file.data_files.split(',')
             for file_name in file_names:
                 self._add_file_links(file_name, directory, atomroot, entry,
-                                     'section')
+                                     'section', mime_types)
         except AttributeError:
             # no multiple data files, so add data file, but
             file_name = subresult.file.data_file
             self._add_file_links(file_name, directory, atomroot, entry,
-                                 'enclosure')
+                                 'enclosure', mime_types)
 
     def _add_file_links(self, file_name, directory, atomroot, entry,
-                        atom_type):
+                        atom_type, mime_types):
         """
         Update the 'entry' with links to a file.
 
+        @param mime_types (dict): the mime types already found for this
+            response, keyed on file type
+
         """
         full_path = os.path.join(directory, file_name)
         file_type = file_name.split('.')[-1].lower()
         try:
-            mime_type = get_mime_type(file_type)
+            mime_type = mime_types[file_type]
         except KeyError:
-            LOGGING.warn(
-                'Unable to discover mime type for {}'.
-                format(file_type))
-            mime_type = None
+            try:
+                mime_type = get_mime_type(file_type)
+            except KeyError:
+                LOGGING.warn(
+                    'Unable to discover mime type for {}'.
+                    format(file_type))
+                mime_type = None
+            mime_types[file_type] = mime_type
 
         # add data links
-        data_url = urljoin_path(FTP_SERVER, full_path)
+        data_url = _ftp_url(full_path)
         link = createLink(data_url, atom_type, mime_type, atomroot)
         link.set('title', 'ftp')
         entry.append(link)
-        data_url = urljoin_path(PYDAP_SERVER, full_path)
+        data_url = _pydap_url(full_path)
         link = createLink(data_url, atom_type, mime_type, atomroot)
         link.set('title', 'pydap')
         entry.append(link)
@@ -250,7 +349,8 @@ class COSAtomResponse(OSAtomResponse):
                       str(os_host_url))
         return "%s/%s" % (os_host_url, OS_PATH)
 
-    def _get_subtitle(self, index, result_count, total_count, context):
+    def _get_subtitle(self, index, result_count, total_count, context,
+                      relation=''):
         """
         Create the HTML containing a subtitle for the ATOM feed.
 
@@ -260,11 +360,15 @@ class COSAtomResponse(OSAtomResponse):
         @param context (dict): the query parameters from the users request plus
             defaults from the OSQuery. This only contains parameters for
             registered OSParams.
+        @param relation (str): the relation of total_count to the true number
+            of results, '', '>=' or '<='
 
         @return a string containing the subtitle
 
         """
-        subtitle = 'Found %s results.' % total_count
+        subtitle = 'Found %s%s results.' % (
+            {'>=': 'at least ', '<=': 'at most '}.get(relation, ''),
+            total_count)
         if total_count > 0:
             if index < 2:
                 if result_count == 1:
@@ -299,6 +403,11 @@ class COSJsonResponse(OSJsonResponse):
     OSEngineResponse.
 
     """
+    # the whole of the _source is returned in the rows
+    SOURCE_FIELDS = None
+
+    # placeholder for the rows when the raw hits are spliced into the document
+    RAW_ROWS_MARKER = '__ceda_opensearch_raw_rows__'
 
     def __init__(self):
         """
@@ -307,6 +416,57 @@ class COSJsonResponse(OSJsonResponse):
         """
         super(COSJsonResponse, self).__init__()
 
+    def generate_response(self, results, query, ospath, params_model,
+                          context):
+        """
+        Generate the json document, adding a 'next' link in cursor mode.
+
+        If the results contain RawHits the json text of the hits is spliced
+        into the document in place of the rows, and the document is only
+        pretty printed if the 'pretty' search option is set.
+
+        Overrides method from OSJsonResponse.
+
+        """
+        response = super(COSJsonResponse, self).generate_response(
+            results, query, ospath, params_model, context)
+        if isinstance(results.subresult, RawHits):
+            response = response.replace(
+                json.dumps(self.RAW_ROWS_MARKER), results.subresult.text, 1)
+            if get_search_options().get('pretty'):
+                return json.dumps(json.loads(response), indent=4,
+                                  separators=(',', ': '))
+            return response
+
+        try:
+            next_cursor = results.subresult.next_cursor
+        except AttributeError:
+            # not in cursor mode
+            return response
+
+        jsondoc = json.loads(response)
+        if next_cursor is not None:
+            params = [(key, value) for key, value in context.items()
+                      if value is not None and value != '']
+            url = '%s/json?%s' % (self.generate_url(ospath, context),
+                                  urlencode(params))
+            jsondoc['next'] = get_cursor_url(url, next_cursor)
+        return json.dumps(jsondoc)
+
+    def generate_url(self, os_host_url, context):
+        """
+        Returns the URL used to assemble the links.
+
+        @param os_host_url (str): the URL of the opensearch host
+        @param context (dict): the query parameters from the users request plus
+            defaults from the OSQuery. This only contains parameters for
+            registered OSParams.
+
+        @return a URL including path
+
+        """
+        return "%s/%s" % (os_host_url, OS_PATH)
+
     def digest_search_results(self, results, context):
         """
         Create a Result object.
@@ -339,11 +499,14 @@ class COSJsonResponse(OSJsonResponse):
 
         Overrides abstract method from OSJsonResponse.
 
-        @param subresults (list): a list of json objects
+        @param subresults (list): a list of json objects, or RawHits
 
-        @return a list containing the json results
+        @return a list containing the json results, for RawHits this only
+            contains a marker to be replaced by the hits
 
         """
+        if isinstance(subresults, RawHits):
+            return [self.RAW_ROWS_MARKER]
 
         subresult_list = []
         for subresult in subresults:
@@ -373,6 +536,10 @@ class COSQuery(OSQuery):
                               default=''))
         params.append(OSParam("startRecord", "startIndex",
                               namespace=OS_NAMESPACE, default=''))
+        params.append(OSParam("cursor", "cursor", namespace=CEDA_NAMESPACE,
+                              namespace_prefix=CEDA_PREFIX, default=''))
+        params.append(OSParam("totals", "totals", namespace=CEDA_NAMESPACE,
+                              namespace_prefix=CEDA_PREFIX, default=''))
         params.append(OSParam("q", "searchTerms", namespace=OS_NAMESPACE,
                               default=''))
         params.append(OSParam("uid", "uid", namespace=GEO_NAMESPACE,
@@ -451,11 +618,31 @@ class COSQuery(OSQuery):
         @return a dict with keys:
                     'results': a list of json objects
                     'total_count': the total number of possible results
+                    'relation': the relation of total_count to the true
+                        number of results, '', '>=' or '<='
+                    'timed_out': True if the search ran out of time and
+                        the results are partial
 
         """
         LOGGING.debug("do_search(query, context)")
-        results, total_results, relation = get_search_results(context)
-        return {'results': results, 'total_count': total_results}
+        options = get_search_options()
+        # the raw hits do not have the sort values needed for a cursor
+        raw = options.get('raw', False) and not context.get('cursor')
+        start = time.monotonic()
+        results, total_results, relation = get_search_results(
+            context, source_fields=options.get('source_fields'),
+            bypass_cache=options.get('bypass_cache', False), raw=raw)
+        # the view records the rest of the time of the OSEngine as rendering
+        options['search_seconds'] = time.monotonic() - start
+        options['etag'] = get_results_etag(results, total_results)
+        if_none_match = options.get('if_none_match', ())
+        if ((options['etag'] in if_none_match or '*' in if_none_match) and
+                not options.get('stale') and not options.get('timed_out')):
+            # the client already has these results, so do not render them
+            raise Http304(options['etag'])
+        return {'results': results, 'total_count': total_results,
+                'relation': relation,
+                'timed_out': options.get('timed_out', False)}
 
     def _get_query_signature(self, params_model):
         """
@@ -465,7 +652,7 @@ class COSQuery(OSQuery):
         _params = []
         for params in params_model:
             if params.par_name not in ['maximumRecords', 'startPage',
-                                       'startRecord']:
+                                       'startRecord', 'cursor', 'totals']:
                 _params.append(params.par_name)
         return _params
 
@@ -501,6 +688,32 @@ class COSQuery(OSQuery):
         markup.set("value", "{startPage}")
         root.append(markup)
 
+        markup = createMarkup(
+            'Parameter', PARAM_PREFIX, PARAM_NAMESPACE, root)
+        markup.set("name", "cursor")
+        markup.set("minimum", "0")
+        markup.set("title", "page through all of the results, use * for the "
+                   "first page then follow the 'next' link")
+        markup.set("value", "{ceda:cursor}")
+        root.append(markup)
+
+        markup = createMarkup(
+            'Parameter', PARAM_PREFIX, PARAM_NAMESPACE, root)
+        markup.set("name", "totals")
+        markup.set("minimum", "0")
+        markup.set("title", "how totalResults is counted: exact, capped, "
+                   "where large totals are a lower bound, or estimate, where "
+                   "the total may be from an earlier search or only count the "
+                   "results up to this page")
+        markup.set("value", "{ceda:totals}")
+        root.append(markup)
+        for totals in [TOTALS_EXACT, TOTALS_CAPPED, TOTALS_ESTIMATE]:
+            option = createMarkup(
+                'Option', PARAM_PREFIX, PARAM_NAMESPACE, root)
+            option.set("label", totals)
+            option.set("value", totals)
+            markup.append(option)
+
         markup = createMarkup(
             'Parameter', PARAM_PREFIX, PARAM_NAMESPACE, root)
         markup.set("name", "dataOnline")
@@ -567,7 +780,8 @@ class COSQuery(OSQuery):
         markup.set("name", "mission")
         markup.set("value", "{eo:mission}")
         root.append(markup)
-        missions = ['Landsat', 'Sentinel-1', 'Sentinel-2', 'Sentinel-3']
+        missions = _get_option_values(
+            'mission', ['Landsat', 'Sentinel-1', 'Sentinel-2', 'Sentinel-3'])
         for mission in missions:
             option = createMarkup(
                 'Option', PARAM_PREFIX, PARAM_NAMESPACE, root)
@@ -580,8 +794,9 @@ class COSQuery(OSQuery):
         markup.set("name", "platform")
         markup.set("value", "{eo:platform}")
         root.append(markup)
-        platforms = ['Landsat-5', 'Landsat-7', 'Landsat-8', 'Sentinel-1A',
-                     'Sentinel-2A', 'Sentinel-3A']
+        platforms = _get_option_values(
+            'platform', ['Landsat-5', 'Landsat-7', 'Landsat-8', 'Sentinel-1A',
+                         'Sentinel-2A', 'Sentinel-3A'])
         for platform in platforms:
             option = createMarkup(
                 'Option', PARAM_PREFIX, PARAM_NAMESPACE, root)
@@ -623,12 +838,45 @@ class COSQuery(OSQuery):
         markup.set("name", "polarisationChannels")
         markup.set("value", "{eo:polarisationChannels}")
         root.append(markup)
-        polarisations = ['HH', 'HV', 'VH', 'VV', 'HH,VV', 'HH,VH', 'HH,HV',
-                         'VH,VV', 'VH,HV', 'VV,HV', 'VV,VH', 'HV,VH',
-                         'UNDEFINED']
+        polarisations = _get_option_values(
+            'polarisationChannels',
+            ['HH', 'HV', 'VH', 'VV', 'HH,VV', 'HH,VH', 'HH,HV', 'VH,VV',
+             'VH,HV', 'VV,HV', 'VV,VH', 'HV,VH', 'UNDEFINED'])
         for polar in polarisations:
             option = createMarkup(
                 'Option', PARAM_PREFIX, PARAM_NAMESPACE, root)
             option.set("label", polar)
             option.set("value", polar)
             markup.append(option)
+
+
+def _get_option_values(name, default):
+    """
+    Get the values to list as the options of a parameter in the description
+    document.
+
+    @param name (str): the name of the parameter
+    @param default (list): the values to use if none were read from elastic
+        search
+
+    @return a list of str
+
+    """
+    values = get_search_options().get('parameter_values') or {}
+    return values.get(name) or default
+
+
+def get_source_fields(iformat):
+    """
+    Get the _source fields needed to render a response.
+
+    @param iformat (str): the requested format of data
+
+    @return a list of the paths of the fields, or None for the whole _source
+
+    """
+    responses = {'atom': COSAtomResponse, 'json': COSJsonResponse}
+    try:
+        return responses[iformat].SOURCE_FIELDS
+    except KeyError:
+        return None
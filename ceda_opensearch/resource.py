@@ -30,11 +30,12 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
+from collections import OrderedDict
+import datetime
+from itertools import count
 import json
 import logging
 import os
-from xml.dom import minidom
-from xml.etree.ElementTree import tostring
 
 from ceda_markup.markup import createMarkup, createSimpleMarkup
 from django.http.response import Http404
@@ -42,29 +43,46 @@ from django.http.response import Http404
 from ceda_opensearch.constants import EOP_PREFIX, EOP_NAMESPACE, OM_PREFIX,\
     OM_NAMESPACE, XLINK_PREFIX, XLINK_NAMESPACE, OWS_PREFIX, OWS_NAMESPACE,\
     XSI_PREFIX, SCHEMA_LOCATION, XSI_NAMESPACE, GML_PREFIX, GML_NAMESPACE,\
-    SAFE_NAMESPACE, SAFE_PREFIX, SAR_NAMESPACE, SAR_PREFIX
-from ceda_opensearch.elastic_search import get_search_results
-from ceda_opensearch.helper import urljoin_path
+    SAFE_NAMESPACE, SAFE_PREFIX, SAR_NAMESPACE, SAR_PREFIX, WFS_PREFIX, \
+    WFS_NAMESPACE, COUNT_MAX
+from ceda_opensearch.elastic_search import get_document, get_documents
+from ceda_opensearch.errors import Http400
+from ceda_opensearch.helper import get_path_joiner, is_pretty
+from ceda_opensearch.metrics import timed
 from ceda_opensearch.settings import FTP_SERVER, PYDAP_SERVER
 
 
 LOGGING = logging.getLogger(__name__)
 
-next_id = 0
-poly_count = 10000
+_ftp_url = get_path_joiner(FTP_SERVER)
+_pydap_url = get_path_joiner(PYDAP_SERVER)
+
+# the _source fields read when building the xml
+XML_SOURCE_FIELDS = ['temporal', 'spatial.geometries.display', 'misc.platform',
+                     'misc.orbit_info', 'misc.product_info.Polarisation',
+                     'file.*']
 
 
 def get_resource(request, iformat):
     """
     Get the resource formated according to the value of iformat.
 
+    If more than one uid is given, or the request is a POST, the resources for
+    all of the uids are returned in one document.
+
     @param request: a HTTP request
     @param iformat: the requested format of data
 
     """
+    if request.method == 'GET' and len(request.GET.getlist('uid')) < 2:
+        if iformat == 'json':
+            return _get_json(request)
+        return _get_xml(request)
+
+    uids = _get_uids(request)
     if iformat == 'json':
-        return _get_json(request)
-    return _get_xml(request)
+        return _get_json_batch(request, uids)
+    return _get_xml_batch(uids)
 
 
 def _get_json(request):
@@ -74,12 +92,12 @@ def _get_json(request):
     @param request: a HTTP request
 
     """
-    results, _, _ = get_search_results({'uid': request.GET.get('uid')})
-    try:
-        jsondoc = results.pop().to_dict()
-    except IndexError:
+    text = get_document(request.GET.get('uid'), raw=True)
+    if text is None:
         raise Http404
-    return json.dumps(jsondoc, indent=4, separators=(',', ': '))
+    if is_pretty(request):
+        return json.dumps(json.loads(text), indent=4, separators=(',', ': '))
+    return text
 
 
 def _get_xml(request):
@@ -89,420 +107,593 @@ def _get_xml(request):
     @param request: a HTTP request
 
     """
-    global next_id, poly_count
-    next_id = 0
-    poly_count = 10000
-    results, _, _ = get_search_results({'uid': request.GET.get('uid')})
-    try:
-        result = results[0]
-    except IndexError:
+    result = get_document(request.GET.get('uid'),
+                          source_fields=XML_SOURCE_FIELDS)
+    if result is None:
         raise Http404
-    root = createMarkup('EarthObservation', EOP_PREFIX, EOP_NAMESPACE, None)
-    root.set('xmlns:{}'.format(XSI_PREFIX), XSI_NAMESPACE)
-    root.set('{}:schemaLocation'.format(XSI_PREFIX), SCHEMA_LOCATION)
-    root.set('{}:id'.format(GML_PREFIX), _get_id())
-
-    _add_phenomenonTime(root, result)
-    _add_resultTime(root, result)
-    _add_procedure(root, result)
-    _add_observedProperty(root, result)
-    _add_featureOfInterest(root, result)
-    _add_result(root, result)
-    _add_metaDataProperty(root, result)
-    xml = ('<?xml version="1.0" encoding="utf-8"?>%s' %
-           tostring(root, encoding='unicode'))
-
-    reparsed = minidom.parseString(xml)
-    return reparsed.toprettyxml()
-
-
-def _add_phenomenonTime(root, result):
-    start_time = None
-    end_time = None
-    try:
-        start_time = str(result.temporal.start_time)
-    except AttributeError:
-        LOGGING.debug('start_time not found')
-    try:
-        end_time = str(result.temporal.end_time)
-    except AttributeError:
-        LOGGING.debug('end_time not found')
-    if start_time is None and end_time is None:
-        return
-
-    phenomenonTime = createMarkup(
-        'phenomenonTime', OM_PREFIX, OM_NAMESPACE, root)
-    root.append(phenomenonTime)
-
-    TimePeriod = createMarkup('TimePeriod', GML_PREFIX, GML_NAMESPACE, root)
-    TimePeriod.set('{}:id'.format(GML_PREFIX), _get_id())
-    phenomenonTime.append(TimePeriod)
-
-    if start_time is not None:
-        beginPosition = createSimpleMarkup(
-            start_time, root, 'beginPosition', GML_NAMESPACE, GML_PREFIX)
-        TimePeriod.append(beginPosition)
-
-    if end_time is not None:
-        endPosition = createSimpleMarkup(
-            end_time, root, 'endPosition', GML_NAMESPACE, GML_PREFIX)
-        TimePeriod.append(endPosition)
-
-
-def _add_resultTime(root, result):
-    resultTime = createMarkup(
-        'resultTime', OM_PREFIX, OM_NAMESPACE, root)
-    root.append(resultTime)
-
-
-def _add_observedProperty(root, result):
-    observedProperty = createMarkup(
-        'observedProperty', OM_PREFIX, OM_NAMESPACE, root)
-    observedProperty.set('nilReason', 'inapplicable')
-    root.append(observedProperty)
-
-
-def _add_featureOfInterest(root, result):
-    try:
-        search = result.spatial.geometries.display
-    except AttributeError:
-        LOGGING.debug('spatial.geometries.display not found')
-        return
-    featureOfInterest = createMarkup(
-        'featureOfInterest', OM_PREFIX, OM_NAMESPACE, root)
-    root.append(featureOfInterest)
-
-    Footprint = createMarkup(
-        'Footprint', EOP_PREFIX, EOP_NAMESPACE, root)
-    Footprint.set('{}:id'.format(GML_PREFIX), _get_id())
-    featureOfInterest.append(Footprint)
-
-    multiExtentOf = createMarkup(
-        'multiExtentOf', EOP_PREFIX, EOP_NAMESPACE, root)
-    Footprint.append(multiExtentOf)
-
-    MultiSurface = createMarkup(
-        'MultiSurface', GML_PREFIX, GML_NAMESPACE, root)
-    MultiSurface.set('{}:id'.format(GML_PREFIX), _get_id())
-#     MultiSurface.set('{}:srsName'.format(GML_PREFIX), 'EPSG:4326')
-    multiExtentOf.append(MultiSurface)
-
-    surfaceMembers = createMarkup(
-        'surfaceMembers', GML_PREFIX, GML_NAMESPACE, root)
-    MultiSurface.append(surfaceMembers)
-
-    if search.type == 'polygon':
-        _add_polygon(root, surfaceMembers, search.coordinates)
-    elif search.type == 'MultiPolygon':
-        _add_multi_polygon(root, surfaceMembers, search.coordinates)
-    elif search.type == 'LineString':
-        _add_line_string(root, surfaceMembers, search.coordinates)
-    else:
-        LOGGING.error('geometry type {}, found in result, is not currently '
-                      'supported'.format(search.type))
-
-
-def _add_polygon(root, parent, result):
-    global poly_count
-    for polygon in result:
-        exterior_pos_list = _get_pos_list(polygon)
-        poly_count = poly_count + 1
-        poly_id = 'POLN{}'.format(poly_count)
-        Polygon = createMarkup(
-            'Polygon', GML_PREFIX, GML_NAMESPACE, root)
-        Polygon.set('{}:id'.format(GML_PREFIX), poly_id)
-        parent.append(Polygon)
-
-        exterior = createMarkup(
-            'exterior', GML_PREFIX, GML_NAMESPACE, root)
-        Polygon.append(exterior)
-
-        LinearRing = createMarkup(
-            'LinearRing', GML_PREFIX, GML_NAMESPACE, root)
-        exterior.append(LinearRing)
-
-        Polygon = createMarkup(
-            'Polygon', GML_PREFIX, GML_NAMESPACE, root)
-        posList = createSimpleMarkup(
-            exterior_pos_list, root, 'posList', GML_NAMESPACE, GML_PREFIX)
-        LinearRing.append(posList)
-
-
-def _add_multi_polygon(root, parent, result):
-    global poly_count
-    for polygon in result:
-        poly_count = poly_count + 1
-        poly_id = 'POLN{}'.format(poly_count)
-        Polygon = createMarkup(
-            'Polygon', GML_PREFIX, GML_NAMESPACE, root)
-        Polygon.set('{}:id'.format(GML_PREFIX), poly_id)
-        parent.append(Polygon)
-
-        exterior = createMarkup(
-            'exterior', GML_PREFIX, GML_NAMESPACE, root)
-        Polygon.append(exterior)
-
-        LinearRing = createMarkup(
-            'LinearRing', GML_PREFIX, GML_NAMESPACE, root)
-        exterior.append(LinearRing)
-
-        exterior_pos_list = _get_pos_list(polygon[0])
-        Polygon = createMarkup(
-            'Polygon', GML_PREFIX, GML_NAMESPACE, root)
-        posList = createSimpleMarkup(
-            exterior_pos_list, root, 'posList', GML_NAMESPACE, GML_PREFIX)
-        LinearRing.append(posList)
-
-        if len(polygon) > 1:
-            interior_pos_list = _get_pos_list(polygon[1])
-            if interior_pos_list != "":
-                # add the hole
-                interior = createMarkup(
-                    'interior', GML_PREFIX, GML_NAMESPACE, root)
-                Polygon.append(interior)
-
-                LinearRing = createMarkup(
-                    'LinearRing', GML_PREFIX, GML_NAMESPACE, root)
-                interior.append(LinearRing)
-
-                Polygon = createMarkup(
-                    'Polygon', GML_PREFIX, GML_NAMESPACE, root)
-                posList = createSimpleMarkup(
-                    interior_pos_list, root, 'posList', GML_NAMESPACE,
-                    GML_PREFIX)
-                LinearRing.append(posList)
+    with timed('render'):
+        root = GmlDocumentBuilder().build(result)
+        return serialise(root)
 
 
-def _get_pos_list(polygon):
-    pos_list = ""
-    for coordinates in polygon:
-        pos_list = '{pos_list} {coord0} {coord1}'.format(
-            pos_list=pos_list, coord0=coordinates[0],
-            coord1=coordinates[1])
-
-    return pos_list
-
-
-def _add_line_string(root, parent, result):
-    # TODO
-    pass
-
-
-def _add_procedure(root, result):
-    procedure = createMarkup('procedure', OM_PREFIX, OM_NAMESPACE, root)
-    root.append(procedure)
-    EarthObservationEquipment = createMarkup(
-        'EarthObservationEquipment', EOP_PREFIX, EOP_NAMESPACE, root)
-    EarthObservationEquipment.set('{}:id'.format(GML_PREFIX), _get_id())
-    procedure.append(EarthObservationEquipment)
-    _add_platform(root, EarthObservationEquipment, result)
-    _add_instrument(root, EarthObservationEquipment, result)
-    _add_acquisitionParameters(root, EarthObservationEquipment, result)
-
-
-def _add_platform(root, parent, result):
-    try:
-        platform_name = result.misc.platform['Satellite']
-    except (AttributeError, KeyError):
-        LOGGING.debug('Satellite not found')
-        return
-    platform = createMarkup('platform', EOP_PREFIX, EOP_NAMESPACE, root)
-    parent.append(platform)
-    Platform = createMarkup('Platform', EOP_PREFIX, EOP_NAMESPACE, root)
-    platform.append(Platform)
-    shortName = createSimpleMarkup(
-        platform_name, root, 'shortName', EOP_NAMESPACE, EOP_PREFIX)
-    Platform.append(shortName)
-
-
-def _add_instrument(root, parent, result):
-    try:
-        instrument_name = result.misc.platform['Instrument Abbreviation']
-    except (AttributeError, KeyError):
-        LOGGING.debug('Instrument Abbreviation not found')
-        return
-    instrument = createMarkup('instrument', EOP_PREFIX, EOP_NAMESPACE, root)
-    parent.append(instrument)
-    Instrument = createMarkup('Instrument', EOP_PREFIX, EOP_NAMESPACE, root)
-    instrument.append(Instrument)
-    shortName = createSimpleMarkup(
-        instrument_name, root, 'shortName', EOP_NAMESPACE, EOP_PREFIX)
-    Instrument.append(shortName)
-
-
-def _add_acquisitionParameters(root, parent, result):
-    orbit_number = None
-    last_orbit_number = None
-    relative_orbit_number = None
-    orbit_direction = None
-    polarisation = None
-    try:
-        orbit_number = result.misc.orbit_info['Start Orbit Number']
-    except (AttributeError, KeyError):
-        LOGGING.debug('Start Orbit Number not found')
-    try:
-        last_orbit_number = result.misc.orbit_info['Stop Orbit Number']
-    except (AttributeError, KeyError):
-        LOGGING.debug('Last Orbit Number not found')
-    try:
-        relative_orbit_number = result.misc.orbit_info['Start Relative Orbit Number']
-    except (AttributeError, KeyError):
-        LOGGING.debug('Start Relative Orbit Number not found')
-    try:
-        orbit_direction = result.misc.orbit_info['Pass Direction']
-    except (AttributeError, KeyError):
-        LOGGING.debug('Orbit Direction not found')
-    try:
-        polarisation = result.misc.product_info.Polarisation
-    except AttributeError:
-        LOGGING.debug('Polarisation not found')
-    if orbit_number is None and polarisation is None:
-        return
-
-    acquisitionParameters = createMarkup(
-        'acquisitionParameters', EOP_PREFIX, EOP_NAMESPACE, root)
-    parent.append(acquisitionParameters)
-    if orbit_number is not None:
-        Acquisition = createMarkup(
-            'Acquisition', EOP_PREFIX, EOP_NAMESPACE, root)
-        acquisitionParameters.append(Acquisition)
-        orbitNumber = createSimpleMarkup(
-            orbit_number, root, 'orbitNumber', EOP_NAMESPACE, EOP_PREFIX)
-        Acquisition.append(orbitNumber)
-        if last_orbit_number is not None:
-            lastOrbitNumber = createSimpleMarkup(
-                last_orbit_number, root, 'lastOrbitNumber', EOP_NAMESPACE,
-                EOP_PREFIX)
-            Acquisition.append(lastOrbitNumber)
-        if relative_orbit_number is not None:
-            relativeOrbitNumber = createSimpleMarkup(
-                relative_orbit_number, root, 'relativeOrbitNumber', SAFE_NAMESPACE,
-                SAFE_PREFIX)
-            Acquisition.append(relativeOrbitNumber)
-        if orbit_direction is not None:
-            orbitDirection = createSimpleMarkup(
-                orbit_direction, root, 'orbitDirection', EOP_NAMESPACE,
-                EOP_PREFIX)
-            Acquisition.append(orbitDirection)
-
-    if polarisation is not None:
-        Acquisition = createMarkup(
-            'Acquisition', SAR_PREFIX, SAR_NAMESPACE, root)
-        acquisitionParameters.append(Acquisition)
-        polarisationMarkup = createSimpleMarkup(
-            polarisation, root, 'polarisationChannels', SAR_NAMESPACE,
-            SAR_PREFIX)
-        Acquisition.append(polarisationMarkup)
-
-
-def _add_result(root, result):
-    if result.file.location == "on_tape":
-        LOGGING.debug('data is on tape')
-        return
-    try:
-        file_names = result.file.data_files.split(',')
-        sizes = result.file.data_file_sizes.split(',')
-        earthObservationResult = _add_eo_result(root, result)
-
-        for i in range(0, len(file_names) - 1):
-            file_name = os.path.join(result.file.directory, file_names[i])
-            _add_file(root, earthObservationResult, file_name, sizes[i])
-    except AttributeError:
-        # not multiple files, add single file
-        try:
-            file_name = os.path.join(result.file.directory,
-                                     result.file.data_file)
-            file_size = str(result.file.data_file_size)
-            earthObservationResult = _add_eo_result(root, result)
-            _add_file(root, earthObservationResult, file_name, file_size)
-        except AttributeError:
-            LOGGING.debug('file.directory or file.data_file not found')
-            return
+def _get_json_batch(request, uids):
+    """
+    Get the results for a list of uids as a json array. Uids with no result
+    are left out.
+
+    @param request: a HTTP request
+    @param uids (list): the uids of the results
+
+    """
+    texts = [text for text in get_documents(uids, raw=True)
+             if text is not None]
+    text = '[%s]' % ','.join(texts)
+    if is_pretty(request):
+        return json.dumps(json.loads(text), indent=4, separators=(',', ': '))
+    return text
+
+
+def _get_xml_batch(uids):
+    """
+    Get the results for a list of uids as a wfs:FeatureCollection with an
+    EarthObservation member for each result. Uids with no result are left out.
+
+    @param uids (list): the uids of the results
+
+    """
+    results = [result for result in
+               get_documents(uids, source_fields=XML_SOURCE_FIELDS)
+               if result is not None]
+    with timed('render'):
+        return _build_feature_collection(results)
 
 
-def _add_eo_result(root, result):
+def _build_feature_collection(results):
+    """
+    Build and serialise a wfs:FeatureCollection of the results.
 
-    result_ = createMarkup('result', OM_PREFIX, OM_NAMESPACE, root)
-    root.append(result_)
+    @param results (list): the _source of each document
 
-    EarthObservationResult = createMarkup(
-        'EarthObservationResult', EOP_PREFIX, EOP_NAMESPACE, root)
-    EarthObservationResult.set('{}:id'.format(GML_PREFIX), _get_id())
-    result_.append(EarthObservationResult)
-    return EarthObservationResult
+    """
+    root = createMarkup('FeatureCollection', WFS_PREFIX, WFS_NAMESPACE, None)
+    root.set('timeStamp', datetime.datetime.utcnow().strftime(
+        '%Y-%m-%dT%H:%M:%SZ'))
+    root.set('numberMatched', str(len(results)))
+    root.set('numberReturned', str(len(results)))
+
+    # share one builder so that the gml:ids are unique in the document
+    builder = GmlDocumentBuilder()
+    for result in results:
+        member = createMarkup('member', WFS_PREFIX, WFS_NAMESPACE, root)
+        member.append(builder.build(result))
+        root.append(member)
+    return serialise(root)
+
+
+def _get_uids(request):
+    """
+    Get the uids from the request. They may be given as repeated uid
+    parameters in the query string or, in a POST, as form data or as a json
+    body containing either a list of uids or an object with a 'uid' list.
+
+    @param request: a HTTP request
 
+    @return a list of the uids, without duplicates
 
-def _add_file(root, earthObservationResult, file_name, file_size):
-    _add_product(root, earthObservationResult, file_name, 'ftp', file_size)
-    _add_product(root, earthObservationResult, file_name, 'pydap', file_size)
+    """
+    uids = request.GET.getlist('uid')
+    if request.method == 'POST':
+        if request.content_type == 'application/json':
+            try:
+                body = json.loads(request.body.decode('utf-8'))
+            except ValueError:
+                raise Http400('The body of the request is not valid json')
+            if isinstance(body, dict):
+                body = body.get('uid', [])
+            if not isinstance(body, list):
+                body = [body]
+            uids.extend(str(uid) for uid in body)
+        else:
+            uids.extend(request.POST.getlist('uid'))
+
+    uids = list(OrderedDict.fromkeys(uid for uid in uids if uid))
+    if len(uids) > COUNT_MAX:
+        raise Http400('A maximum of {} uids can be requested at once'.format(
+            COUNT_MAX))
+    return uids
+
+
+def serialise(root, indent=True):
+    """
+    Serialise an element tree as an xml document in a single pass.
 
+    When indenting, the layout is the same as that of minidom's toprettyxml.
 
-def _add_product(root, parent, file_name, link_type, file_size):
+    @param root: the root element of the document
+    @param indent (bool): if True put each element on its own line, indented
+        with tabs
 
-    product = createMarkup('product', EOP_PREFIX, EOP_NAMESPACE, root)
-    parent.append(product)
+    @return the xml document as a str
 
-    ProductInformation = createMarkup(
-        'ProductInformation', EOP_PREFIX, EOP_NAMESPACE, root)
-    product.append(ProductInformation)
+    """
+    parts = ['<?xml version="1.0" ?>']
+    if indent:
+        parts.append('\n')
+        _write_element(parts.append, root, '', '\t', '\n')
+    else:
+        _write_element(parts.append, root, '', '', '')
+    return ''.join(parts)
 
-    fileName = createMarkup('fileName', EOP_PREFIX, EOP_NAMESPACE, root)
-    ProductInformation.append(fileName)
 
-    root.set("xmlns:%s" % (XLINK_PREFIX), XLINK_NAMESPACE)
-    ServiceReference = createMarkup(
-        'ServiceReference', OWS_PREFIX, OWS_NAMESPACE, root)
+def _write_element(write, element, prefix, indent, newline):
+    """
+    Write an element and its children.
 
-    if link_type == 'ftp':
-        data_url = urljoin_path(FTP_SERVER, file_name)
-        ServiceReference.set('{}:href'.format(XLINK_PREFIX), data_url)
+    @param write: a function that takes a str
+    @param element: the element to write
+    @param prefix (str): the indentation of the element
+    @param indent (str): the additional indentation of each child
+    @param newline (str): written after each line
+
+    """
+    write(prefix)
+    write('<')
+    write(element.tag)
+    attributes = element.items()
+    # namespace declarations come first, as they do from minidom
+    for name, value in attributes:
+        if name.startswith('xmlns'):
+            write(' %s="%s"' % (name, _escape(value)))
+    for name, value in attributes:
+        if not name.startswith('xmlns'):
+            write(' %s="%s"' % (name, _escape(value)))
+    if len(element):
+        write('>')
+        write(newline)
+        child_prefix = prefix + indent
+        for child in element:
+            _write_element(write, child, child_prefix, indent, newline)
+        write('%s</%s>%s' % (prefix, element.tag, newline))
+    elif element.text:
+        write('>%s</%s>%s' % (_escape(element.text), element.tag, newline))
     else:
-        data_url = urljoin_path(PYDAP_SERVER, file_name)
-        ServiceReference.set('{}:href'.format(XLINK_PREFIX), data_url)
-
-    ServiceReference.set('{}:title'.format(XLINK_PREFIX), link_type)
-    fileName.append(ServiceReference)
-
-    RequestMessage = createMarkup(
-        'RequestMessage', OWS_PREFIX, OWS_NAMESPACE, root)
-    ServiceReference.append(RequestMessage)
-
-    size = createSimpleMarkup(
-        file_size, root, 'size', EOP_NAMESPACE, EOP_PREFIX)
-    size.set('uom', 'byte')
-    ProductInformation.append(size)
-
-
-def _add_metaDataProperty(root, result):
-    try:
-        file_name = result.file.filename
-    except AttributeError:
-        LOGGING.debug('file.filename not found')
-        return
-    metaDataProperty = createMarkup(
-        'metaDataProperty', EOP_PREFIX, EOP_NAMESPACE, root)
-    root.append(metaDataProperty)
-
-    EarthObservationMetaData = createMarkup(
-        'EarthObservationMetaData', EOP_PREFIX, EOP_NAMESPACE, root)
-    metaDataProperty.append(EarthObservationMetaData)
-
-    identifier = createSimpleMarkup(
-        file_name, root, 'identifier', EOP_NAMESPACE, EOP_PREFIX)
-    EarthObservationMetaData.append(identifier)
-
-    identifier = createSimpleMarkup(
-        'NOMINAL', root, 'acquisitionType', EOP_NAMESPACE, EOP_PREFIX)
-    EarthObservationMetaData.append(identifier)
-
-    identifier = createSimpleMarkup(
-        'ARCHIVED', root, 'status', EOP_NAMESPACE, EOP_PREFIX)
-    EarthObservationMetaData.append(identifier)
-
-
-def _get_id():
-    global next_id
-    next_id = next_id + 1
-    if next_id < 10:
-        return 'ID0{}N10001'.format(next_id)
-    return 'ID{}N10001'.format(next_id)
+        write('/>')
+        write(newline)
+
+
+def _escape(text):
+    """
+    Escape text for use in element content or an attribute value.
+
+    """
+    text = str(text)
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+class GmlDocumentBuilder(object):
+    """
+    Build EarthObservation xml elements.
+
+    The gml:id counters belong to the builder, so a new builder should be used
+    for each document. The ids are unique across all of the elements built by
+    one builder.
+
+    """
+
+    def __init__(self):
+        """
+        Init the GmlDocumentBuilder.
+
+        """
+        self._next_id = count(1)
+        self._next_poly_id = count(10001)
+
+    def build(self, result):
+        """
+        Build the EarthObservation element for a result.
+
+        @param result: the result to describe, an AttrDict of its _source
+
+        @return the EarthObservation element
+
+        """
+        root = createMarkup('EarthObservation', EOP_PREFIX, EOP_NAMESPACE,
+                            None)
+        root.set('xmlns:{}'.format(XSI_PREFIX), XSI_NAMESPACE)
+        root.set('{}:schemaLocation'.format(XSI_PREFIX), SCHEMA_LOCATION)
+        root.set('{}:id'.format(GML_PREFIX), self._get_id())
+
+        self._add_phenomenonTime(root, result)
+        self._add_resultTime(root, result)
+        self._add_procedure(root, result)
+        self._add_observedProperty(root, result)
+        self._add_featureOfInterest(root, result)
+        self._add_result(root, result)
+        self._add_metaDataProperty(root, result)
+        return root
+
+    def _get_id(self):
+        next_id = next(self._next_id)
+        if next_id < 10:
+            return 'ID0{}N10001'.format(next_id)
+        return 'ID{}N10001'.format(next_id)
+
+    def _get_poly_id(self):
+        return 'POLN{}'.format(next(self._next_poly_id))
+
+    def _add_phenomenonTime(self, root, result):
+        start_time = None
+        end_time = None
+        try:
+            start_time = str(result.temporal.start_time)
+        except AttributeError:
+            LOGGING.debug('start_time not found')
+        try:
+            end_time = str(result.temporal.end_time)
+        except AttributeError:
+            LOGGING.debug('end_time not found')
+        if start_time is None and end_time is None:
+            return
+
+        phenomenonTime = createMarkup(
+            'phenomenonTime', OM_PREFIX, OM_NAMESPACE, root)
+        root.append(phenomenonTime)
+
+        TimePeriod = createMarkup(
+            'TimePeriod', GML_PREFIX, GML_NAMESPACE, root)
+        TimePeriod.set('{}:id'.format(GML_PREFIX), self._get_id())
+        phenomenonTime.append(TimePeriod)
+
+        if start_time is not None:
+            beginPosition = createSimpleMarkup(
+                start_time, root, 'beginPosition', GML_NAMESPACE, GML_PREFIX)
+            TimePeriod.append(beginPosition)
+
+        if end_time is not None:
+            endPosition = createSimpleMarkup(
+                end_time, root, 'endPosition', GML_NAMESPACE, GML_PREFIX)
+            TimePeriod.append(endPosition)
+
+    def _add_resultTime(self, root, result):
+        resultTime = createMarkup(
+            'resultTime', OM_PREFIX, OM_NAMESPACE, root)
+        root.append(resultTime)
+
+    def _add_observedProperty(self, root, result):
+        observedProperty = createMarkup(
+            'observedProperty', OM_PREFIX, OM_NAMESPACE, root)
+        observedProperty.set('nilReason', 'inapplicable')
+        root.append(observedProperty)
+
+    def _add_featureOfInterest(self, root, result):
+        try:
+            search = result.spatial.geometries.display
+        except AttributeError:
+            LOGGING.debug('spatial.geometries.display not found')
+            return
+        featureOfInterest = createMarkup(
+            'featureOfInterest', OM_PREFIX, OM_NAMESPACE, root)
+        root.append(featureOfInterest)
+
+        Footprint = createMarkup(
+            'Footprint', EOP_PREFIX, EOP_NAMESPACE, root)
+        Footprint.set('{}:id'.format(GML_PREFIX), self._get_id())
+        featureOfInterest.append(Footprint)
+
+        multiExtentOf = createMarkup(
+            'multiExtentOf', EOP_PREFIX, EOP_NAMESPACE, root)
+        Footprint.append(multiExtentOf)
+
+        MultiSurface = createMarkup(
+            'MultiSurface', GML_PREFIX, GML_NAMESPACE, root)
+        MultiSurface.set('{}:id'.format(GML_PREFIX), self._get_id())
+    #     MultiSurface.set('{}:srsName'.format(GML_PREFIX), 'EPSG:4326')
+        multiExtentOf.append(MultiSurface)
+
+        surfaceMembers = createMarkup(
+            'surfaceMembers', GML_PREFIX, GML_NAMESPACE, root)
+        MultiSurface.append(surfaceMembers)
+
+        if search.type == 'polygon':
+            self._add_polygon(root, surfaceMembers, search.coordinates)
+        elif search.type == 'MultiPolygon':
+            self._add_multi_polygon(root, surfaceMembers, search.coordinates)
+        elif search.type == 'LineString':
+            self._add_line_string(root, surfaceMembers, search.coordinates)
+        else:
+            LOGGING.error('geometry type {}, found in result, is not '
+                          'currently supported'.format(search.type))
+
+    def _add_polygon(self, root, parent, result):
+        for polygon in result:
+            exterior_pos_list = _get_pos_list(polygon)
+            poly_id = self._get_poly_id()
+            Polygon = createMarkup(
+                'Polygon', GML_PREFIX, GML_NAMESPACE, root)
+            Polygon.set('{}:id'.format(GML_PREFIX), poly_id)
+            parent.append(Polygon)
+
+            exterior = createMarkup(
+                'exterior', GML_PREFIX, GML_NAMESPACE, root)
+            Polygon.append(exterior)
+
+            LinearRing = createMarkup(
+                'LinearRing', GML_PREFIX, GML_NAMESPACE, root)
+            exterior.append(LinearRing)
+
+            Polygon = createMarkup(
+                'Polygon', GML_PREFIX, GML_NAMESPACE, root)
+            posList = createSimpleMarkup(
+                exterior_pos_list, root, 'posList', GML_NAMESPACE, GML_PREFIX)
+            LinearRing.append(posList)
+
+    def _add_multi_polygon(self, root, parent, result):
+        for polygon in result:
+            poly_id = self._get_poly_id()
+            Polygon = createMarkup(
+                'Polygon', GML_PREFIX, GML_NAMESPACE, root)
+            Polygon.set('{}:id'.format(GML_PREFIX), poly_id)
+            parent.append(Polygon)
+
+            exterior = createMarkup(
+                'exterior', GML_PREFIX, GML_NAMESPACE, root)
+            Polygon.append(exterior)
+
+            LinearRing = createMarkup(
+                'LinearRing', GML_PREFIX, GML_NAMESPACE, root)
+            exterior.append(LinearRing)
+
+            exterior_pos_list = _get_pos_list(polygon[0])
+            Polygon = createMarkup(
+                'Polygon', GML_PREFIX, GML_NAMESPACE, root)
+            posList = createSimpleMarkup(
+                exterior_pos_list, root, 'posList', GML_NAMESPACE, GML_PREFIX)
+            LinearRing.append(posList)
+
+            if len(polygon) > 1:
+                interior_pos_list = _get_pos_list(polygon[1])
+                if interior_pos_list != "":
+                    # add the hole
+                    interior = createMarkup(
+                        'interior', GML_PREFIX, GML_NAMESPACE, root)
+                    Polygon.append(interior)
+
+                    LinearRing = createMarkup(
+                        'LinearRing', GML_PREFIX, GML_NAMESPACE, root)
+                    interior.append(LinearRing)
+
+                    Polygon = createMarkup(
+                        'Polygon', GML_PREFIX, GML_NAMESPACE, root)
+                    posList = createSimpleMarkup(
+                        interior_pos_list, root, 'posList', GML_NAMESPACE,
+                        GML_PREFIX)
+                    LinearRing.append(posList)
+
+    def _add_line_string(self, root, parent, result):
+        # TODO
+        pass
+
+    def _add_procedure(self, root, result):
+        procedure = createMarkup('procedure', OM_PREFIX, OM_NAMESPACE, root)
+        root.append(procedure)
+        EarthObservationEquipment = createMarkup(
+            'EarthObservationEquipment', EOP_PREFIX, EOP_NAMESPACE, root)
+        EarthObservationEquipment.set(
+            '{}:id'.format(GML_PREFIX), self._get_id())
+        procedure.append(EarthObservationEquipment)
+        self._add_platform(root, EarthObservationEquipment, result)
+        self._add_instrument(root, EarthObservationEquipment, result)
+        self._add_acquisitionParameters(
+            root, EarthObservationEquipment, result)
+
+    def _add_platform(self, root, parent, result):
+        try:
+            platform_name = result.misc.platform['Satellite']
+        except (AttributeError, KeyError):
+            LOGGING.debug('Satellite not found')
+            return
+        platform = createMarkup('platform', EOP_PREFIX, EOP_NAMESPACE, root)
+        parent.append(platform)
+        Platform = createMarkup('Platform', EOP_PREFIX, EOP_NAMESPACE, root)
+        platform.append(Platform)
+        shortName = createSimpleMarkup(
+            platform_name, root, 'shortName', EOP_NAMESPACE, EOP_PREFIX)
+        Platform.append(shortName)
+
+    def _add_instrument(self, root, parent, result):
+        try:
+            instrument_name = result.misc.platform['Instrument Abbreviation']
+        except (AttributeError, KeyError):
+            LOGGING.debug('Instrument Abbreviation not found')
+            return
+        instrument = createMarkup(
+            'instrument', EOP_PREFIX, EOP_NAMESPACE, root)
+        parent.append(instrument)
+        Instrument = createMarkup(
+            'Instrument', EOP_PREFIX, EOP_NAMESPACE, root)
+        instrument.append(Instrument)
+        shortName = createSimpleMarkup(
+            instrument_name, root, 'shortName', EOP_NAMESPACE, EOP_PREFIX)
+        Instrument.append(shortName)
+
+    def _add_acquisitionParameters(self, root, parent, result):
+        orbit_number = None
+        last_orbit_number = None
+        relative_orbit_number = None
+        orbit_direction = None
+        polarisation = None
+        try:
+            orbit_number = result.misc.orbit_info['Start Orbit Number']
+        except (AttributeError, KeyError):
+            LOGGING.debug('Start Orbit Number not found')
+        try:
+            last_orbit_number = result.misc.orbit_info['Stop Orbit Number']
+        except (AttributeError, KeyError):
+            LOGGING.debug('Last Orbit Number not found')
+        try:
+            relative_orbit_number = \
+                result.misc.orbit_info['Start Relative Orbit Number']
+        except (AttributeError, KeyError):
+            LOGGING.debug('Start Relative Orbit Number not found')
+        try:
+            orbit_direction = result.misc.orbit_info['Pass Direction']
+        except (AttributeError, KeyError):
+            LOGGING.debug('Orbit Direction not found')
+        try:
+            polarisation = result.misc.product_info.Polarisation
+        except AttributeError:
+            LOGGING.debug('Polarisation not found')
+        if orbit_number is None and polarisation is None:
+            return
+
+        acquisitionParameters = createMarkup(
+            'acquisitionParameters', EOP_PREFIX, EOP_NAMESPACE, root)
+        parent.append(acquisitionParameters)
+        if orbit_number is not None:
+            Acquisition = createMarkup(
+                'Acquisition', EOP_PREFIX, EOP_NAMESPACE, root)
+            acquisitionParameters.append(Acquisition)
+            orbitNumber = createSimpleMarkup(
+                orbit_number, root, 'orbitNumber', EOP_NAMESPACE, EOP_PREFIX)
+            Acquisition.append(orbitNumber)
+            if last_orbit_number is not None:
+                lastOrbitNumber = createSimpleMarkup(
+                    last_orbit_number, root, 'lastOrbitNumber', EOP_NAMESPACE,
+                    EOP_PREFIX)
+                Acquisition.append(lastOrbitNumber)
+            if relative_orbit_number is not None:
+                relativeOrbitNumber = createSimpleMarkup(
+                    relative_orbit_number, root, 'relativeOrbitNumber',
+                    SAFE_NAMESPACE, SAFE_PREFIX)
+                Acquisition.append(relativeOrbitNumber)
+            if orbit_direction is not None:
+                orbitDirection = createSimpleMarkup(
+                    orbit_direction, root, 'orbitDirection', EOP_NAMESPACE,
+                    EOP_PREFIX)
+                Acquisition.append(orbitDirection)
+
+        if polarisation is not None:
+            Acquisition = createMarkup(
+                'Acquisition', SAR_PREFIX, SAR_NAMESPACE, root)
+            acquisitionParameters.append(Acquisition)
+            polarisationMarkup = createSimpleMarkup(
+                polarisation, root, 'polarisationChannels', SAR_NAMESPACE,
+                SAR_PREFIX)
+            Acquisition.append(polarisationMarkup)
+
+    def _add_result(self, root, result):
+        if result.file.location == "on_tape":
+            LOGGING.debug('data is on tape')
+            return
+        try:
+            file_names = result.file.data_files.split(',')
+            sizes = result.file.data_file_sizes.split(',')
+            earthObservationResult = self._add_eo_result(root, result)
+
+            for i in range(0, len(file_names) - 1):
+                file_name = os.path.join(result.file.directory, file_names[i])
+                self._add_file(root, earthObservationResult, file_name,
+                               sizes[i])
+        except AttributeError:
+            # not multiple files, add single file
+            try:
+                file_name = os.path.join(result.file.directory,
+                                         result.file.data_file)
+                file_size = str(result.file.data_file_size)
+                earthObservationResult = self._add_eo_result(root, result)
+                self._add_file(root, earthObservationResult, file_name,
+                               file_size)
+            except AttributeError:
+                LOGGING.debug('file.directory or file.data_file not found')
+                return
+
+    def _add_eo_result(self, root, result):
+
+        result_ = createMarkup('result', OM_PREFIX, OM_NAMESPACE, root)
+        root.append(result_)
+
+        EarthObservationResult = createMarkup(
+            'EarthObservationResult', EOP_PREFIX, EOP_NAMESPACE, root)
+        EarthObservationResult.set('{}:id'.format(GML_PREFIX), self._get_id())
+        result_.append(EarthObservationResult)
+        return EarthObservationResult
+
+    def _add_file(self, root, earthObservationResult, file_name, file_size):
+        self._add_product(root, earthObservationResult, file_name, 'ftp',
+                          file_size)
+        self._add_product(root, earthObservationResult, file_name, 'pydap',
+                          file_size)
+
+    def _add_product(self, root, parent, file_name, link_type, file_size):
+
+        product = createMarkup('product', EOP_PREFIX, EOP_NAMESPACE, root)
+        parent.append(product)
+
+        ProductInformation = createMarkup(
+            'ProductInformation', EOP_PREFIX, EOP_NAMESPACE, root)
+        product.append(ProductInformation)
+
+        fileName = createMarkup('fileName', EOP_PREFIX, EOP_NAMESPACE, root)
+        ProductInformation.append(fileName)
+
+        root.set("xmlns:%s" % (XLINK_PREFIX), XLINK_NAMESPACE)
+        ServiceReference = createMarkup(
+            'ServiceReference', OWS_PREFIX, OWS_NAMESPACE, root)
+
+        if link_type == 'ftp':
+            data_url = _ftp_url(file_name)
+            ServiceReference.set('{}:href'.format(XLINK_PREFIX), data_url)
+        else:
+            data_url = _pydap_url(file_name)
+            ServiceReference.set('{}:href'.format(XLINK_PREFIX), data_url)
+
+        ServiceReference.set('{}:title'.format(XLINK_PREFIX), link_type)
+        fileName.append(ServiceReference)
+
+        RequestMessage = createMarkup(
+            'RequestMessage', OWS_PREFIX, OWS_NAMESPACE, root)
+        ServiceReference.append(RequestMessage)
+
+        size = createSimpleMarkup(
+            file_size, root, 'size', EOP_NAMESPACE, EOP_PREFIX)
+        size.set('uom', 'byte')
+        ProductInformation.append(size)
+
+    def _add_metaDataProperty(self, root, result):
+        try:
+            file_name = result.file.filename
+        except AttributeError:
+            LOGGING.debug('file.filename not found')
+            return
+        metaDataProperty = createMarkup(
+            'metaDataProperty', EOP_PREFIX, EOP_NAMESPACE, root)
+        root.append(metaDataProperty)
+
+        EarthObservationMetaData = createMarkup(
+            'EarthObservationMetaData', EOP_PREFIX, EOP_NAMESPACE, root)
+        metaDataProperty.append(EarthObservationMetaData)
+
+        identifier = createSimpleMarkup(
+            file_name, root, 'identifier', EOP_NAMESPACE, EOP_PREFIX)
+        EarthObservationMetaData.append(identifier)
+
+        identifier = createSimpleMarkup(
+            'NOMINAL', root, 'acquisitionType', EOP_NAMESPACE, EOP_PREFIX)
+        EarthObservationMetaData.append(identifier)
+
+        identifier = createSimpleMarkup(
+            'ARCHIVED', root, 'status', EOP_NAMESPACE, EOP_PREFIX)
+        EarthObservationMetaData.append(identifier)
+
+
+def _get_pos_list(polygon):
+    return ''.join([' {} {}'.format(coordinates[0], coordinates[1])
+                    for coordinates in polygon])
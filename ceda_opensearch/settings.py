@@ -37,6 +37,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'ceda_opensearch.metrics.MetricsMiddleware',
+    'ceda_opensearch.slow_query.SlowQueryMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -128,6 +130,9 @@ LOGGING = {
         'simple': {
             'format': '%(levelname)s %(message)s'
         },
+        'message': {
+            'format': '%(message)s'
+        },
     },
     'handlers': {
         'file': {
@@ -146,6 +151,14 @@ LOGGING = {
             'maxBytes': 1024 * 1024 * 100,  # 100 MB
             'backupCount': 10,
         },
+        'slow_query_file': {
+            'level': 'INFO',
+            'class': 'logging.handlers.RotatingFileHandler',
+            'formatter': 'message',
+            'filename': '/var/log/ceda_opensearch/slow_query.log',
+            'maxBytes': 1024 * 1024 * 100,  # 100 MB
+            'backupCount': 10,
+        },
     },
     'loggers': {
         'django': {
@@ -160,10 +173,212 @@ LOGGING = {
             'handlers': ['file', 'error_file'],
             'level': os.getenv('DJANGO_LOG_LEVEL', 'DEBUG'),
         },
+        'slow_query': {
+            'handlers': ['slow_query_file'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 
 
+# Elastic search
+# The number of seconds to wait for a response from elastic search. Requests
+# are served synchronously through wsgi.py, there is no ASGI or async serving
+# path, so each request to elastic search holds a server thread until it
+# returns. This bounds how long a slow search can occupy a thread, it does not
+# let more searches run than there are threads.
+ELASTIC_TIMEOUT = 20
+# The number of seconds to wait for each kind of request to elastic search,
+# 'search', 'msearch', 'mget' or 'get', the others use ELASTIC_TIMEOUT, e.g.
+# {'get': 5, 'msearch': 30}
+ELASTIC_TIMEOUTS = {}
+
+# A list of elastic search hosts, used instead of ELASTIC_HOST if it is not
+# empty. Requests are spread across the hosts.
+ELASTIC_HOSTS = []
+# The maximum number of connections kept open to each elastic search node.
+# This should be at least the number of server threads, otherwise extra
+# connections are opened, and closed again, when they are all in use.
+ELASTIC_MAX_CONNECTIONS = 10
+# Ask the cluster for its nodes, when the first request is made, when a
+# connection fails and every ELASTIC_SNIFF_INTERVAL seconds, and spread the
+# requests across them
+ELASTIC_SNIFF = False
+ELASTIC_SNIFF_INTERVAL = 60
+# Compress the bodies of the requests to elastic search
+ELASTIC_HTTP_COMPRESS = False
+# The number of times a request is retried on another connection, after a
+# connection error or one of the ELASTIC_RETRY_ON_STATUS status codes
+ELASTIC_MAX_RETRIES = 3
+ELASTIC_RETRY_ON_STATUS = (502, 503, 504)
+# Also retry requests that time out
+ELASTIC_RETRY_ON_TIMEOUT = False
+
+# A keyword field, with doc values, used to break ties when sorting the results
+# of cursor searches with the same start time. This is not unique, the same
+# product may be indexed more than once.
+ELASTIC_TIEBREAKER_FIELD = 'misc.product_info.Name.keyword'
+
+# Fields that together are unique for each document, the last sort keys of
+# cursor searches so that each result is on exactly one page. _id is only
+# unique within an index, so it follows _index. Sorting on _id loads it into
+# fielddata, if the documents have a unique keyword id with doc values use it
+# instead.
+ELASTIC_UNIQUE_SORT_FIELDS = ['_index', '_id']
+
+# Ask elastic search to explain how the score of each hit was computed, this is
+# expensive and should only be used for debugging.
+ELASTIC_EXPLAIN = False
+
+# The default policy for counting the total number of results, 'exact',
+# 'capped' or 'estimate', which can be changed by the totals parameter of a
+# request. Counting every result is a large part of the cost of broad
+# searches.
+ELASTIC_TOTALS = 'capped'
+# When capped, the number of results that are counted accurately
+ELASTIC_TRACK_TOTAL_HITS = 10000
+
+# Replacements for entries in elastic_search.SEARCH_TERMS, keyed on the name of
+# the OpenSearch parameter, e.g. to use a term query on a keyword field
+# {'platform': {'fields': ['misc.platform.Satellite.keyword'],
+#               'query': 'term'}}
+ELASTIC_SEARCH_TERMS = {}
+
+# Replacements for entries in elastic_search.FACETS, keyed on the name of the
+# facet, e.g. to count the values of a different field
+ELASTIC_FACETS = {}
+
+
+# Request time budget
+# The number of seconds the searches for a request may take, 0 for no limit.
+# This is sent to elastic search as the timeout of each search, so that it
+# stops and returns the results found so far, which are marked as partial,
+# rather than running on after the request has been given up.
+REQUEST_TIME_BUDGET = 20
+# Clients may ask for a shorter budget, in seconds, with this header
+REQUEST_TIME_BUDGET_HEADER = 'X-Request-Timeout'
+
+# Slow query log
+# Requests that take longer than this number of seconds, and run a search, are
+# written to the slow query log as a line of json, with the elastic search
+# query and the time taken by each stage. 0 disables the log. The log can be
+# summarised with python -m ceda_opensearch.slow_query.
+SLOW_QUERY_THRESHOLD = 2.0
+# The fraction of the slow requests that are logged, to keep the size of the
+# log down when many requests are slow
+SLOW_QUERY_SAMPLE_RATE = 1.0
+
+# Admission control
+# Limit the number of searches sent to elastic search at once. The limit
+# rises while searches finish within ADMISSION_TARGET_LATENCY seconds and
+# falls when they are slower or fail. Searches that cannot get a slot are
+# rejected with a 503 response.
+ADMISSION_CONTROL = True
+ADMISSION_INITIAL_LIMIT = 10
+ADMISSION_MIN_LIMIT = 1
+ADMISSION_MAX_LIMIT = 100
+ADMISSION_TARGET_LATENCY = 2.0
+# The maximum number of searches waiting for a slot, and the number of seconds
+# each one waits
+ADMISSION_MAX_QUEUE = 50
+ADMISSION_QUEUE_TIMEOUT = 2.0
+# The number of seconds in the Retry-After header of a rejected search
+ADMISSION_RETRY_AFTER = 1
+
+# Circuit breaker
+# The number of failed requests to elastic search in a row after which no more
+# are sent, so that requests fail at once, 0 disables the breaker
+CIRCUIT_BREAKER_FAILURES = 5
+# The number of seconds before a request is sent to check if elastic search
+# has recovered
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+# Stale cache
+# While elastic search is unavailable, searches are answered with the last
+# results found for the same query, with a Warning header. The maximum size,
+# in bytes of the elastic search responses, of the cache of those results, 0
+# disables it.
+STALE_CACHE_MAX_SIZE = 64 * 1024 * 1024  # 64 MB
+# The number of seconds the last results of a search are kept for
+STALE_CACHE_TTL = 24 * 60 * 60
+
+# Search cache
+# The maximum size, in bytes of the elastic search responses, of the search
+# results cache, 0 disables the cache
+SEARCH_CACHE_MAX_SIZE = 64 * 1024 * 1024  # 64 MB
+# The number of seconds a cached search result is used for
+SEARCH_CACHE_TTL = 300
+# Requests with the X-Search-Cache-Bypass header set to this value skip the
+# cache, and refresh the cached result. An empty value disables the header.
+SEARCH_CACHE_BYPASS_KEY = ''
+# Identical searches that arrive while one is running wait for its result,
+# rather than each sending a query to elastic search
+SEARCH_SINGLE_FLIGHT = True
+
+# Response cache
+# The maximum size, in bytes, of the cache of rendered search responses, 0
+# disables the cache
+RESPONSE_CACHE_MAX_SIZE = 64 * 1024 * 1024  # 64 MB
+# The number of seconds a rendered response is used for
+RESPONSE_CACHE_TTL = 300
+# The max-age, in seconds, in the Cache-Control header of search responses
+RESPONSE_CACHE_MAX_AGE = 300
+# The maximum size, in bytes, of a streamed response that will be cached
+RESPONSE_CACHE_MAX_ENTRY_SIZE = 1024 * 1024  # 1 MB
+# Send each atom entry to the client as soon as it has been created, rather
+# than building the whole document first
+RESPONSE_STREAM_ATOM = True
+# Copy the _source of the hits from the elastic search response into json
+# responses without parsing them. Json responses are only indented if the
+# request has a 'pretty' parameter.
+RESPONSE_RAW_JSON = True
+
+# Document lookup
+# The maximum number of uids for which the id of the document is cached
+UID_CACHE_MAX_ENTRIES = 100000
+# The number of seconds the id of the document for a uid is cached for
+UID_CACHE_TTL = 3600
+# The maximum size, in bytes, of the cache of documents fetched by uid, 0
+# disables the cache
+DOCUMENT_CACHE_MAX_SIZE = 16 * 1024 * 1024  # 16 MB
+# The number of seconds a fetched document is cached for
+DOCUMENT_CACHE_TTL = 300
+
+# Facets
+# The maximum size, in bytes of the elastic search responses, of the cache of
+# facet counts, 0 disables the cache
+FACET_CACHE_MAX_SIZE = 8 * 1024 * 1024  # 8 MB
+# The number of seconds cached facet counts are used for
+FACET_CACHE_TTL = 600
+# The maximum number of values counted for each terms facet
+FACET_SIZE = 100
+
+# Description document
+# The maximum size, in bytes, of the cache of rendered description documents,
+# one for each host URL, 0 disables the cache
+DESCRIPTION_CACHE_MAX_SIZE = 1024 * 1024  # 1 MB
+# The number of seconds a rendered description document is used for, after
+# which the options of its parameters are read again from elastic search
+DESCRIPTION_CACHE_TTL = 3600
+# The max-age, in seconds, in the Cache-Control header of the description
+DESCRIPTION_CACHE_MAX_AGE = 3600
+# List the values found in elastic search as the options of the mission,
+# platform and polarisationChannels parameters, rather than fixed lists
+DESCRIPTION_DYNAMIC_OPTIONS = True
+
+# Batch search
+# The maximum number of searches in one request to the batch search endpoint
+BATCH_SEARCH_MAX_QUERIES = 20
+
+# Status
+# The number of seconds between runs of the status checks in the background,
+# 0 runs the checks for each request to the status page instead
+STATUS_REFRESH_INTERVAL = 0
+# The status checks count the results accurately up to this number
+STATUS_TRACK_TOTAL_HITS = 10000
+
+
 try:
     from ceda_opensearch.local_settings import *
 except ImportError:
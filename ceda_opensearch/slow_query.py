@@ -0,0 +1,334 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import argparse
+from collections import defaultdict
+import datetime
+import json
+import logging
+import random
+import sys
+import time
+
+from ceda_opensearch.helper import get_search_options, search_options
+from ceda_opensearch.settings import SLOW_QUERY_SAMPLE_RATE, \
+    SLOW_QUERY_THRESHOLD
+
+
+LOGGING = logging.getLogger(__name__)
+
+# The records are written to their own logger, so that the log only holds
+# records
+SLOW_QUERY_LOG = logging.getLogger('slow_query')
+
+# The value recorded in place of each value in a query, when finding its shape
+PLACEHOLDER = '?'
+
+# The parameters that do not change the shape of a query
+PAGING_PARAMETERS = ('maximumRecords', 'startRecord', 'cursor')
+
+
+def get_trace():
+    """
+    Get the dict in which the slow query log record of the current request is
+    collected.
+
+    @return a dict, or None if slow queries are not being logged
+
+    """
+    return get_search_options().get('slow_query')
+
+
+def trace_context(context):
+    """
+    Record the canonical form of the context of the first search of the
+    request.
+
+    @param context (tuple): the canonical context, from
+        helper.canonical_context
+
+    """
+    trace = get_trace()
+    if trace is not None and 'context' not in trace:
+        trace['context'] = dict(context)
+
+
+def trace_search(operation, elastic_search, seconds, took, hits, total,
+                 timed_out):
+    """
+    Record a search sent to elastic search. The query is compiled to a dict
+    only if the record is logged.
+
+    @param operation (str): the kind of search
+    @param elastic_search: the elasticsearch_dsl Search that was executed
+    @param seconds (float): the number of seconds until the response was read
+    @param took (int): the number of milliseconds elastic search took, or
+        None if it is not known
+    @param hits (int): the number of hits returned
+    @param total (int): the total number of results, or None if they were not
+        counted
+    @param timed_out (bool): True if the search timed out
+
+    """
+    trace = get_trace()
+    if trace is not None:
+        trace['searches'].append({
+            'operation': operation, 'query': elastic_search,
+            'seconds': seconds, 'took': took, 'hits': hits, 'total': total,
+            'timed_out': timed_out})
+
+
+def trace_stage(stage, seconds):
+    """
+    Add the time taken by a stage of handling the request.
+
+    @param stage (str): the name of the stage
+    @param seconds (float): the time taken
+
+    """
+    trace = get_trace()
+    if trace is not None:
+        trace['stages'][stage] = trace['stages'].get(stage, 0) + seconds
+
+
+class SlowQueryMiddleware(object):
+    """
+    Django middleware that writes a json record of each request that takes
+    longer than SLOW_QUERY_THRESHOLD seconds, and ran a search, to the slow
+    query log. Only SLOW_QUERY_SAMPLE_RATE of the slow requests are logged.
+
+    Streamed responses are timed until the last of the body has been sent, as
+    that is when the atom entries are rendered.
+
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not SLOW_QUERY_THRESHOLD:
+            return self.get_response(request)
+
+        start = time.monotonic()
+        trace = {'stages': {}, 'searches': []}
+        with search_options(slow_query=trace):
+            response = self.get_response(request)
+        if response.streaming:
+            response.streaming_content = _stream_and_log(
+                response.streaming_content, request, response, trace, start)
+        else:
+            _log(request, response, trace, time.monotonic() - start,
+                 len(response.content))
+        return response
+
+
+def _stream_and_log(content, request, response, trace, start):
+    """
+    Yield the chunks of a streamed response then log the request if it was
+    slow.
+
+    """
+    size = 0
+    try:
+        for chunk in content:
+            size += len(chunk)
+            yield chunk
+    finally:
+        _log(request, response, trace, time.monotonic() - start, size)
+
+
+def _log(request, response, trace, seconds, size):
+    """
+    Write the record of a request to the slow query log, if it ran a search,
+    took longer than the threshold and is in the sample.
+
+    """
+    if 'context' not in trace or seconds < SLOW_QUERY_THRESHOLD:
+        return
+    if (SLOW_QUERY_SAMPLE_RATE < 1 and
+            random.random() >= SLOW_QUERY_SAMPLE_RATE):
+        return
+
+    try:
+        record = {
+            'time': datetime.datetime.utcnow().isoformat() + 'Z',
+            'path': request.path,
+            'status': response.status_code,
+            'seconds': round(seconds, 4),
+            'bytes': size,
+            'context': trace['context'],
+            'stages': {stage: round(value, 4)
+                       for stage, value in trace['stages'].items()},
+            'searches': [dict(search, query=search['query'].to_dict(),
+                              seconds=round(search['seconds'], 4))
+                         for search in trace['searches']],
+        }
+        SLOW_QUERY_LOG.info(json.dumps(record, sort_keys=True, default=str))
+    except Exception as ex:
+        LOGGING.warning('Unable to write to the slow query log. %s', ex)
+
+
+def get_query_shape(record, by_parameters=False):
+    """
+    Get the shape of the query of a slow query log record, which is the same
+    for queries that differ only in their values.
+
+    @param record (dict): a record from the slow query log
+    @param by_parameters (bool): if True the shape is the names of the
+        parameters in the request, otherwise it is the elastic search query
+        with the values removed
+
+    @return a str
+
+    """
+    if by_parameters or not record.get('searches'):
+        return ' '.join(sorted(name for name in record.get('context', {})
+                               if name not in PAGING_PARAMETERS))
+    return json.dumps([{key: _strip_values(search['query'][key])
+                        for key in ('query', 'aggs') if key in search['query']}
+                       for search in record['searches']], sort_keys=True)
+
+
+def _strip_values(value):
+    """
+    Replace the values in a query with a placeholder. Lists of the same
+    shape, such as the terms of a parameter with several values, are
+    reduced to one entry.
+
+    """
+    if isinstance(value, dict):
+        return {key: _strip_values(item) for key, item in value.items()}
+    if isinstance(value, list):
+        shapes = []
+        for item in value:
+            shape = _strip_values(item)
+            if shape not in shapes:
+                shapes.append(shape)
+        return shapes
+    return PLACEHOLDER
+
+
+def summarise(lines, by_parameters=False):
+    """
+    Group the records of the slow query log by the shape of their query.
+
+    @param lines (iterable): the lines of the slow query log
+    @param by_parameters (bool): if True group the records by the names of the
+        parameters in the request, rather than by the elastic search query
+
+    @return a list of dicts, one for each shape, with the number of records,
+        the total, mean and maximum seconds of the requests, the mean
+        milliseconds elastic search took, the mean number of results and an
+        example of the parameters, sorted by the total seconds
+
+    """
+    groups = defaultdict(list)
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        groups[get_query_shape(record, by_parameters)].append(record)
+
+    summary = []
+    for shape, records in groups.items():
+        seconds = [record['seconds'] for record in records]
+        took = [sum(search['took'] or 0 for search in record['searches'])
+                for record in records if record.get('searches')]
+        totals = [record['searches'][0]['total'] for record in records
+                  if record.get('searches')
+                  and record['searches'][0]['total'] is not None]
+        slowest = records[seconds.index(max(seconds))]
+        summary.append({
+            'shape': shape,
+            'count': len(records),
+            'total_seconds': sum(seconds),
+            'mean_seconds': sum(seconds) / len(seconds),
+            'max_seconds': max(seconds),
+            'mean_took': sum(took) / len(took) if took else None,
+            'mean_total': sum(totals) / len(totals) if totals else None,
+            'example': slowest.get('context', {}),
+        })
+    summary.sort(key=lambda group: group['total_seconds'], reverse=True)
+    return summary
+
+
+def main(args=None):
+    """
+    Print the query shapes that took the most time from slow query log files.
+
+    @param args (list): the command line arguments, by default sys.argv
+
+    """
+    parser = argparse.ArgumentParser(
+        description='Summarise the slow query log by the shape of the query.')
+    parser.add_argument('files', nargs='*', metavar='FILE',
+                        help='slow query log files, by default read stdin')
+    parser.add_argument('-n', '--top', type=int, default=10,
+                        help='the number of shapes to show (default 10)')
+    parser.add_argument('-p', '--parameters', action='store_true',
+                        help='group by the names of the request parameters '
+                        'rather than by the elastic search query')
+    options = parser.parse_args(args)
+
+    lines = []
+    for name in options.files or ['-']:
+        if name == '-':
+            lines.extend(sys.stdin)
+        else:
+            with open(name) as log_file:
+                lines.extend(log_file)
+
+    summary = summarise(lines, options.parameters)
+    for rank, group in enumerate(summary[:options.top], 1):
+        print('{}. {} requests, {:.1f}s total, {:.2f}s mean, {:.2f}s max, '
+              'elastic search took {} ms mean, {} results mean'.format(
+                  rank, group['count'], group['total_seconds'],
+                  group['mean_seconds'], group['max_seconds'],
+                  _format_mean(group['mean_took']),
+                  _format_mean(group['mean_total'])))
+        print('   shape:   {}'.format(group['shape']))
+        print('   slowest: {}'.format(json.dumps(group['example'],
+                                                 sort_keys=True)))
+    if not summary:
+        print('No slow queries found')
+
+
+def _format_mean(value):
+    return '-' if value is None else '{:.0f}'.format(value)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import logging
+import threading
+import time
+
+from ceda_opensearch.elastic_search import get_multi_search_counts
+from ceda_opensearch.errors import Http400, Http503
+from ceda_opensearch.example_queries import BASE_CONTEXT, EXAMPLE_PARAMETERS
+from ceda_opensearch.settings import STATUS_TRACK_TOTAL_HITS
+
+
+LOGGING = logging.getLogger(__name__)
+
+
+def run_status_checks():
+    """
+    Run the example queries, with a single request to elastic search, and
+    get the status of each one.
+
+    @return a dict with keys:
+                'status': a list containing a dict for each example query,
+                    with the keys 'test', 'status', 'message' and 'latency',
+                    the time in milliseconds elastic search took to run it
+                'time': the time the queries were run
+                'took': the time in milliseconds taken to run all of the
+                    queries
+
+    """
+    contexts = []
+    for example_parameters in EXAMPLE_PARAMETERS:
+        context = dict(BASE_CONTEXT)
+        for param in example_parameters.split('&'):
+            key, value = param.split('=')
+            context[key] = value
+        contexts.append(context)
+
+    start = time.monotonic()
+    counts = get_multi_search_counts(contexts, STATUS_TRACK_TOTAL_HITS)
+    took = int((time.monotonic() - start) * 1000)
+
+    results = []
+    for example_parameters, count in zip(EXAMPLE_PARAMETERS, counts):
+        if isinstance(count, Http400):
+            LOGGING.error(count.message)
+            results.append({'test': example_parameters, 'status': 'ERROR',
+                            'message': count.message, 'latency': None})
+            continue
+        total_hits, relation, latency = count
+        if total_hits > 0:
+            results.append({'test': example_parameters, 'status': 'OK',
+                            'message': '{} {} results found'.
+                            format(relation, total_hits),
+                            'latency': latency})
+        else:
+            results.append({'test': example_parameters, 'status': 'WARNING',
+                            'message': ' No results returned',
+                            'latency': latency})
+    return {'status': results, 'time': time.time(), 'took': took}
+
+
+class StatusRunner(threading.Thread):
+    """
+    A daemon thread that runs the status checks at a fixed interval, keeping
+    the latest results.
+
+    """
+
+    def __init__(self, interval):
+        """
+        Init the StatusRunner.
+
+        @param interval (float): the number of seconds between the start of
+            each run of the checks
+
+        """
+        super(StatusRunner, self).__init__(name='status-runner', daemon=True)
+        self.interval = interval
+        self._snapshot = None
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            start = time.monotonic()
+            try:
+                self._snapshot = run_status_checks()
+            except Http503 as ex:
+                LOGGING.error("Status checks failed. %s", ex.message)
+                self._snapshot = {'error': ex.message, 'time': time.time()}
+            except Exception:
+                LOGGING.exception("Status checks failed")
+            self._ready.set()
+            self._stopped.wait(
+                max(self.interval - (time.monotonic() - start), 0))
+
+    def get_snapshot(self, timeout=None):
+        """
+        Get the results of the latest run of the checks, waiting for the
+        first run to finish if necessary.
+
+        @param timeout (float): the maximum number of seconds to wait
+
+        @return a dict as returned by run_status_checks, or a dict with the
+            keys 'error' and 'time' if elastic search could not be reached, or
+            None if there are no results yet
+
+        """
+        self._ready.wait(timeout)
+        return self._snapshot
+
+    def stop(self):
+        """
+        Stop running the checks.
+
+        """
+        self._stopped.set()
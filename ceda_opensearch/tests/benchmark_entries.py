@@ -0,0 +1,117 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+"""
+Time the creation of the atom entries for a full page of results, as it is
+done now and as it was done before the per-response entry template and path
+joiners.
+
+Run with python -m ceda_opensearch.tests.benchmark_entries
+
+"""
+
+from contextlib import contextmanager
+import timeit
+from xml.etree.ElementTree import Element
+
+from elasticsearch_dsl.utils import AttrDict
+
+from ceda_opensearch import os_impl
+from ceda_opensearch.constants import COUNT_MAX
+from ceda_opensearch.helper import urljoin_path
+from ceda_opensearch.settings import FTP_SERVER, PYDAP_SERVER
+
+
+URL = 'http://localhost/opensearch/atom'
+
+# The number of times each page is built
+RUNS = 200
+
+
+class _UrljoinAtomResponse(os_impl.COSAtomResponse):
+    """
+    Builds each entry from the URL, joining the file paths with urljoin_path.
+
+    """
+
+    def _generate_entry_elements(self, atomroot, subresults, url):
+        for subresult in subresults:
+            yield self._create_entry(atomroot, subresult,
+                                     self._get_entry_template(url))
+
+
+@contextmanager
+def _urljoin_paths():
+    ftp_url, pydap_url = os_impl._ftp_url, os_impl._pydap_url
+    os_impl._ftp_url = lambda path: urljoin_path(FTP_SERVER, path)
+    os_impl._pydap_url = lambda path: urljoin_path(PYDAP_SERVER, path)
+    try:
+        yield
+    finally:
+        os_impl._ftp_url, os_impl._pydap_url = ftp_url, pydap_url
+
+
+def _get_result(i):
+    name = 'S1A_IW_GRDH_1SDV_20160101T{:06d}'.format(i)
+    return AttrDict({
+        'misc': {'product_info': {'Name': name}},
+        'file': {'location': 'on_disk',
+                 'directory': '/neodc/sentinel1a/data/IW/L1_GRD/h/2016/01/01',
+                 'data_file': name + '.zip',
+                 'metadata_file': name + '.manifest',
+                 'quicklook_file': name + '.png'},
+        'temporal': {'start_time': '2016-01-01T00:00:00',
+                     'end_time': '2016-01-01T00:00:25'},
+    })
+
+
+def _time_page(response, subresults):
+    def build():
+        atomroot = Element('feed')
+        for entry in response._generate_entry_elements(atomroot, subresults,
+                                                        URL):
+            atomroot.append(entry)
+    return timeit.timeit(build, number=RUNS) / RUNS / len(subresults)
+
+
+def main():
+    subresults = [_get_result(i) for i in range(COUNT_MAX)]
+    with _urljoin_paths():
+        before = _time_page(_UrljoinAtomResponse(), subresults)
+    after = _time_page(os_impl.COSAtomResponse(), subresults)
+    print('{} entries per page, {} pages'.format(COUNT_MAX, RUNS))
+    print('urljoin_path:     {:.1f} us per entry'.format(before * 1e6))
+    print('entry template:   {:.1f} us per entry'.format(after * 1e6))
+
+
+if __name__ == '__main__':
+    main()
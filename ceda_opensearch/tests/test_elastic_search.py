@@ -0,0 +1,184 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import time
+
+from elasticsearch.exceptions import ConnectionError, ConnectionTimeout
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.response import Response
+import pytest
+
+from ceda_opensearch import elastic_search
+from ceda_opensearch.admission import AdmissionLimiter
+from ceda_opensearch.circuit_breaker import CLOSED, CircuitBreaker, OPEN
+from ceda_opensearch.errors import Http503, Http503Busy, Http503Deadline
+from ceda_opensearch.helper import search_options
+from ceda_opensearch.middleware import CedaOpensearchMiddleware
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    limiter = AdmissionLimiter(initial_limit=10, min_limit=1, max_limit=100,
+                               max_queue=0, queue_timeout=0,
+                               target_latency=2.0)
+    monkeypatch.setattr(CedaOpensearchMiddleware, 'get_admission_limiter',
+                        lambda: limiter)
+    return limiter
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+    monkeypatch.setattr(CedaOpensearchMiddleware, 'get_circuit_breaker',
+                        lambda: breaker)
+    return breaker
+
+
+def _fail(self):
+    raise ConnectionError('N/A', 'connection refused', None)
+
+
+def _time_out(self):
+    time.sleep(0.1)
+    raise ConnectionTimeout('TIMEOUT', 'read timed out', None)
+
+
+def test_breaker_rejections_leave_the_admission_limit(monkeypatch, limiter,
+                                                      breaker):
+    monkeypatch.setattr(Search, 'execute', _fail)
+    with pytest.raises(Http503):
+        elastic_search._execute_search(Search())
+    assert breaker.state == OPEN
+    limit = limiter.limit
+    admitted = limiter.admitted
+
+    for _ in range(20):
+        with pytest.raises(Http503):
+            elastic_search._execute_search(Search())
+    assert limiter.limit == limit
+    assert limiter.admitted == admitted
+    assert breaker.stats()['rejected'] == 20
+
+
+def test_admission_rejections_do_not_open_the_breaker(limiter, breaker):
+    limiter.limit = 1
+    with limiter.admit():
+        with pytest.raises(Http503Busy):
+            elastic_search._execute_search(Search())
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+
+
+def test_timeouts_after_the_deadline_do_not_open_the_breaker(monkeypatch,
+                                                             breaker):
+    monkeypatch.setattr(Search, 'execute', _time_out)
+    with search_options(deadline=time.monotonic() + 0.05):
+        with pytest.raises(Http503Deadline):
+            elastic_search._execute_search(Search())
+    assert breaker.state == CLOSED
+    assert breaker.failures == 0
+
+    with pytest.raises(Http503) as info:
+        elastic_search._execute_search(Search())
+    assert not isinstance(info.value, Http503Deadline)
+    assert breaker.state == OPEN
+
+
+def test_timeouts_after_the_deadline_do_not_return_stale_results(monkeypatch,
+                                                                 breaker):
+    class StaleCache(object):
+        def get(self, key):
+            return 'stale results'
+
+    monkeypatch.setattr(CedaOpensearchMiddleware, 'get_stale_cache',
+                        StaleCache)
+    monkeypatch.setattr(Search, 'execute', _time_out)
+    with search_options(deadline=time.monotonic() + 0.05) as options:
+        with pytest.raises(Http503Deadline):
+            elastic_search.get_search_results({}, bypass_cache=True)
+        assert 'stale' not in options
+
+    monkeypatch.setattr(Search, 'execute', _fail)
+    with search_options() as options:
+        assert elastic_search.get_search_results(
+            {}, bypass_cache=True) == 'stale results'
+        assert options['stale']
+
+
+def _get_sort_value(hit, field):
+    if field in ('_index', '_id'):
+        return hit[field]
+    if field == 'temporal.start_time':
+        return hit['_source']['temporal']['start_time']
+    return hit['_source']['misc']['product_info']['Name']
+
+
+def _search_after(hits):
+    """
+    Get a Search.execute that sorts the hits, all in descending order, and
+    returns the page after search_after, as elastic search does.
+
+    """
+    def execute(self):
+        body = self.to_dict()
+        fields = [list(clause)[0] for clause in body['sort']]
+        page = []
+        for hit in hits:
+            page.append(dict(
+                hit, sort=[_get_sort_value(hit, field) for field in fields]))
+        page.sort(key=lambda hit: hit['sort'], reverse=True)
+        if 'search_after' in body:
+            page = [hit for hit in page if hit['sort'] < body['search_after']]
+        return Response(self, {'took': 1, 'timed_out': False,
+                               'hits': {'hits': page[:body['size']]}})
+    return execute
+
+
+def test_cursor_pages_through_hits_with_equal_sort_values(monkeypatch):
+    source = {'temporal': {'start_time': '2016-01-01T00:00:00'},
+              'misc': {'product_info': {'Name': 'S1A_PRODUCT'}}}
+    hits = [{'_index': 'ceda-eo-1', '_id': '1', '_source': source},
+            {'_index': 'ceda-eo-1', '_id': '2', '_source': source},
+            {'_index': 'ceda-eo-2', '_id': '1', '_source': source}]
+    monkeypatch.setattr(Search, 'execute', _search_after(hits))
+
+    found = []
+    cursor = elastic_search.CURSOR_START
+    while cursor is not None:
+        search = elastic_search._get_search(
+            {'maximumRecords': 1, 'cursor': cursor})
+        response = elastic_search._execute_search(search)
+        found.extend((hit.meta.index, hit.meta.id) for hit in response.hits)
+        cursor = elastic_search._get_next_cursor(response.hits, 1)
+
+    assert sorted(found) == sorted((hit['_index'], hit['_id'])
+                                   for hit in hits)
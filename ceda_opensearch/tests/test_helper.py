@@ -0,0 +1,77 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from ceda_opensearch.helper import get_if_none_match, get_path_joiner, \
+    urljoin_path
+
+
+SITES = ['ftp://ftp.ceda.ac.uk', 'ftp://ftp.ceda.ac.uk/',
+         'http://data.ceda.ac.uk', 'http://data.ceda.ac.uk/',
+         'http://data.ceda.ac.uk/thredds/dodsC/']
+
+# The directory and file names of documents, as they are joined to the sites
+PATHS = [
+    ('/neodc/sentinel1a/data/IW/L1_GRD/h/IPF_v2/2016/01/01',
+     'S1A_IW_GRDH_1SDV_20160101T001534_20160101T001559_009284_00D6B6_0F62'
+     '.zip'),
+    ('/neodc/sentinel2a/data/L1C_MSI/2016/01/01/',
+     'S2A_OPER_PRD_MSIL1C_PDMC_20160101T104356_R008_V20160101T103355.xml'),
+    ('/neodc/sentinel3a/data/OLCI/L1_EFR/2016/01/01',
+     'S3A_OL_1_EFR____20160101T000000.SEN3.zip'),
+    ('/neodc//landsat8/data/', 'LC08_L1TP_201024_20160101_01_T1.tar.gz'),
+    ('neodc/sentinel1b/data', 'S1B_quicklook.png'),
+]
+
+
+@pytest.mark.parametrize('site', SITES)
+@pytest.mark.parametrize('directory,file_name', PATHS)
+def test_path_joiner_matches_urljoin_path(site, directory, file_name):
+    path = os.path.join(directory, file_name)
+    assert get_path_joiner(site)(path) == urljoin_path(site, path)
+
+
+@pytest.mark.parametrize('header,etags', [
+    (None, set()),
+    ('"abc"', {'"abc"'}),
+    ('W/"abc", "def"', {'"abc"', '"def"'}),
+    ('*', {'*'}),
+])
+def test_get_if_none_match(header, etags):
+    request = SimpleNamespace(META={} if header is None else {
+        'HTTP_IF_NONE_MATCH': header})
+    assert get_if_none_match(request) == etags
@@ -0,0 +1,72 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+
+from elasticsearch_dsl.utils import AttrDict, AttrList
+import pytest
+
+from ceda_opensearch import os_impl
+from ceda_opensearch.elastic_search import get_results_etag
+from ceda_opensearch.errors import Http304
+from ceda_opensearch.helper import search_options
+
+
+HITS = AttrList([AttrDict({'meta': {'id': str(i), 'version': 1}})
+                 for i in range(3)])
+ETAG = get_results_etag(HITS, 3)
+
+
+@pytest.fixture
+def query(monkeypatch):
+    monkeypatch.setattr(os_impl, 'get_search_results',
+                        lambda context, **kwargs: (HITS, 3, 'eq'))
+    return os_impl.COSQuery()
+
+
+def test_matching_etag_raises_not_modified_before_rendering(query):
+    with search_options(if_none_match={'"other"', ETAG}):
+        with pytest.raises(Http304) as info:
+            query.do_search(None, {})
+    assert info.value.etag == ETAG
+
+
+def test_other_etags_return_the_results(query):
+    with search_options(if_none_match={'"other"'}) as options:
+        results = query.do_search(None, {})
+    assert results['results'] is HITS
+    assert options['etag'] == ETAG
+
+
+def test_stale_results_are_not_reported_as_not_modified(query):
+    with search_options(if_none_match={ETAG}, stale=True):
+        results = query.do_search(None, {})
+    assert results['results'] is HITS
@@ -0,0 +1,125 @@
+""""
+BSD Licence Copyright (c) 2016, Science & Technology Facilities Council (STFC)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+    this list of conditions and the following disclaimer.
+
+    * Redistributions in binary form must reproduce the above copyright notice,
+    this list of conditions and the following disclaimer in the documentation
+    and/or other materials provided with the distribution.
+
+    * Neither the name of the Science & Technology Facilities Council (STFC)
+    nor the names of its contributors may be used to endorse or promote
+    products derived from this software without specific prior written
+    permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import re
+import threading
+from types import SimpleNamespace
+
+from elasticsearch_dsl.utils import AttrDict
+
+from ceda_opensearch import resource
+
+
+# The number of documents built at once, and of results in each document
+THREADS = 8
+RESULTS = 20
+
+GML_ID_RE = re.compile(r'gml:id="([^"]+)"')
+
+
+def _get_result(i):
+    return AttrDict({
+        'misc': {'product_info': {'Name': 'PRODUCT{}'.format(i)},
+                 'platform': {'Satellite': 'Sentinel-1A'}},
+        'file': {'location': 'on_disk', 'directory': '/neodc/sentinel1a',
+                 'data_file': 'PRODUCT{}.zip'.format(i),
+                 'data_file_size': 10,
+                 'metadata_file': 'PRODUCT{}.xml'.format(i)},
+        'temporal': {'start_time': '2016-01-01T00:00:00',
+                     'end_time': '2016-01-01T01:00:00'},
+        'spatial': {'geometries': {'display': {
+            'type': 'MultiPolygon',
+            'coordinates': [[[[0, 0], [1, 0], [1, 1], [0, 0]]],
+                            [[[2, 2], [3, 2], [3, 3], [2, 2]]]]}}},
+    })
+
+
+def _build_concurrently(build):
+    """
+    Call build from THREADS threads at once.
+
+    @return a list containing the document built by each thread
+
+    """
+    barrier = threading.Barrier(THREADS)
+    documents = [None] * THREADS
+    errors = []
+
+    def run(index):
+        try:
+            barrier.wait()
+            documents[index] = build()
+        except Exception as ex:
+            errors.append(ex)
+
+    threads = [threading.Thread(target=run, args=(i,))
+               for i in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    return documents
+
+
+def test_gml_ids_are_unique_when_built_concurrently():
+    results = [_get_result(i) for i in range(RESULTS)]
+    documents = _build_concurrently(
+        lambda: resource._build_feature_collection(results))
+
+    ids = [GML_ID_RE.findall(document) for document in documents]
+    for document_ids in ids:
+        assert len(document_ids) > RESULTS
+        assert len(set(document_ids)) == len(document_ids)
+    # each document has its own counters, so they all have the same ids
+    for document_ids in ids[1:]:
+        assert document_ids == ids[0]
+    assert ids[0][0] == 'ID01N10001'
+    assert 'POLN10001' in ids[0]
+
+
+def test_gml_ids_are_unique_when_single_documents_built_concurrently(
+        monkeypatch):
+    monkeypatch.setattr(resource, 'get_document',
+                        lambda uid, source_fields: _get_result(uid))
+    request = SimpleNamespace(GET={'uid': 0})
+    documents = _build_concurrently(lambda: resource._get_xml(request))
+
+    ids = [GML_ID_RE.findall(document) for document in documents]
+    for document_ids in ids:
+        assert len(document_ids) > 1
+        assert len(set(document_ids)) == len(document_ids)
+    for document_ids in ids[1:]:
+        assert document_ids == ids[0]
+    assert ids[0][0] == 'ID01N10001'
+    assert 'POLN10001' in ids[0]
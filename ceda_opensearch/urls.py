@@ -49,7 +49,8 @@ from django.urls import path, re_path
 from django.contrib import admin
 
 from ceda_opensearch.constants import OS_PATH
-from ceda_opensearch.views import Description, OpenSearch, Index, Resource, Status
+from ceda_opensearch.views import BatchSearch, Description, Facets, \
+    OpenSearch, Index, Metrics, Resource, Status
 
 IFORMAT = ["atom", "json"]
 IFORMATS_RE = '(' + '|'.join(IFORMAT) + ')'
@@ -63,6 +64,9 @@ urlpatterns = [
     # status
     path('status/', Status.as_view()),
 
+    # metrics
+    path('metrics', Metrics.as_view(), name='metrics'),
+
     # Resource
     re_path(r'resource/{IFORMATS_RE2}'.format(IFORMATS_RE2=IFORMATS_RE2), Resource.as_view(), name='resource'),
 
@@ -70,6 +74,12 @@ urlpatterns = [
     path(f'{OS_PATH}/description.xml', Description.as_view(),
          name='os_description'),
 
+    # Facet counts
+    path(f'{OS_PATH}/facets', Facets.as_view(), name='os_facets'),
+
+    # Batch search
+    path(f'{OS_PATH}/batch', BatchSearch.as_view(), name='os_batch'),
+
     # Opensearch search
     re_path(r'{OS_PATH}/{IFORMATS_RE}'.format(OS_PATH=OS_PATH, IFORMATS_RE=IFORMATS_RE), OpenSearch.as_view(), name='os_search'),
     path(f'{OS_PATH}/atom', OpenSearch.as_view(), name='os_search_atom'),
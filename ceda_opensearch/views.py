@@ -30,31 +30,115 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
 
+import datetime
+import hashlib
+import json
 import logging
+import time
+from xml.etree.ElementTree import tostring
 
-from django.http import HttpResponse, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseBadRequest, \
+    HttpResponseNotModified, StreamingHttpResponse
 from django.shortcuts import render_to_response
-from django.template.context_processors import csrf
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.decorators import method_decorator
+from django.utils.http import http_date
 from django.utils.safestring import mark_safe
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 from django.views.generic.base import TemplateView
-from elasticsearch.exceptions import RequestError
+from elasticsearch.exceptions import TransportError
 
 from ceda_opensearch import elastic_search
+from ceda_opensearch.connection import get_pool_stats
 from ceda_opensearch.constants import OS_DESCRIPTION_TYPE
-from ceda_opensearch.errors import Http400, Http503, ServiceUnavailable
-from ceda_opensearch.example_queries import EXAMPLE_PARAMETERS, BASE_CONTEXT
-from ceda_opensearch.helper import build_host_url, update_context, \
-    get_mime_type
+from ceda_opensearch.errors import Http304, Http400, Http503, \
+    ServiceUnavailable
+from ceda_opensearch.helper import build_host_url, canonical_context, \
+    get_context, get_deadline, get_if_none_match, get_index, get_mime_type, \
+    import_count_and_page, is_pretty, search_options, update_context
+from ceda_opensearch.metrics import observe_stage, render_metrics, timed
 from ceda_opensearch.middleware import CedaOpensearchMiddleware
+from ceda_opensearch.os_impl import get_source_fields
 from ceda_opensearch.resource import get_resource
-from ceda_opensearch.settings import ELASTIC_INDEX
+from ceda_opensearch.settings import BATCH_SEARCH_MAX_QUERIES, \
+    DESCRIPTION_CACHE_MAX_AGE, DESCRIPTION_DYNAMIC_OPTIONS, ELASTIC_INDEX, \
+    RESPONSE_CACHE_MAX_AGE, RESPONSE_CACHE_MAX_ENTRY_SIZE, \
+    RESPONSE_RAW_JSON, RESPONSE_STREAM_ATOM, SEARCH_CACHE_BYPASS_KEY
+from ceda_opensearch.status import run_status_checks
 
 
 LOGGING = logging.getLogger(__name__)
 
+# The number of seconds the status page waits for the first background run of
+# the status checks
+STATUS_SNAPSHOT_TIMEOUT = 30
+
+# The content type of the Prometheus text exposition format
+METRICS_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# The Warning header of a response made from stale search results
+STALE_WARNING = '110 - "Response is Stale"'
+# The Warning header of a response made from the partial results of a search
+# that ran out of time
+PARTIAL_WARNING = '199 - "Partial results, the search timed out"'
+
+# The parameters of the description document whose options are the values
+# found in elastic search
+DESCRIPTION_OPTION_PARAMETERS = ('mission', 'platform', 'polarisationChannels')
+
+
+def _bypass_cache(request):
+    """
+    Check if the request has the admin header to bypass the search cache.
+
+    @param request: a HTTP request
+
+    @return True if the cache should be bypassed
+
+    """
+    if not SEARCH_CACHE_BYPASS_KEY:
+        return False
+    return (request.META.get('HTTP_X_SEARCH_CACHE_BYPASS') ==
+            SEARCH_CACHE_BYPASS_KEY)
+
+
+def _stream_entries(document, entries, cache, key, etag, last_modified):
+    """
+    Generate the bytes of an atom document, serialising each entry as it is
+    created.
+
+    The complete document is added to the response cache if it is no larger
+    than RESPONSE_CACHE_MAX_ENTRY_SIZE.
+
+    @param document (bytes): the serialised feed without any entries
+    @param entries: an iterator of the entry elements
+    @param cache (LRUCache): the response cache, or None to not cache the
+        document
+    @param key: the key of the response in the cache
+    @param etag (str): the etag of the response
+    @param last_modified (int): the time the response was rendered
+
+    """
+    split = document.rindex(b'</')
+    chunks = [document[:split]]
+    size = len(chunks[0])
+    yield chunks[0]
+    for entry in entries:
+        chunk = tostring(entry, encoding='utf-8')
+        size = size + len(chunk)
+        if chunks is not None:
+            chunks.append(chunk)
+            if size > RESPONSE_CACHE_MAX_ENTRY_SIZE:
+                chunks = None
+        yield chunk
+    yield document[split:]
+    if chunks is not None and cache is not None:
+        chunks.append(document[split:])
+        body = b''.join(chunks)
+        cache.set(key, (body, etag, last_modified), len(body))
+
 
 class OpenSearch(View):
     """
@@ -78,11 +162,19 @@ class OpenSearch(View):
 
         """
         host_url = build_host_url(request)
-        context = update_context(request)
+        with timed('context', iformat):
+            context = update_context(request)
         try:
-            response = (CedaOpensearchMiddleware.get_osengine()
-                        .do_search(host_url, iformat, context))
-            return HttpResponse(response, content_type=get_mime_type(iformat))
+            body, etag, last_modified, warning = self._get_rendered(
+                request, iformat, host_url, context)
+        except Http304 as ex:
+            # the results of the search match the If-None-Match header, so
+            # they were not rendered
+            response = HttpResponseNotModified()
+            response['ETag'] = ex.etag
+            patch_cache_control(response, public=True,
+                                max_age=RESPONSE_CACHE_MAX_AGE)
+            return response
         except Http400 as ex:
             LOGGING.debug(ex.message)
             if 'text/html' in request.META.get('HTTP_ACCEPT'):
@@ -91,7 +183,89 @@ class OpenSearch(View):
             else:
                 return HttpResponseBadRequest(reason=ex.message)
         except Http503 as ex:
-            return ServiceUnavailable(reason=ex.message)
+            return ServiceUnavailable(reason=ex.message,
+                                      retry_after=ex.retry_after)
+
+        if isinstance(body, bytes):
+            response = HttpResponse(body, content_type=get_mime_type(iformat))
+        else:
+            response = StreamingHttpResponse(
+                body, content_type=get_mime_type(iformat))
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        if warning is not None:
+            response['Warning'] = warning
+            patch_cache_control(response, public=True, max_age=0)
+        else:
+            patch_cache_control(response, public=True,
+                                max_age=RESPONSE_CACHE_MAX_AGE)
+        return get_conditional_response(request, etag=etag,
+                                        last_modified=last_modified,
+                                        response=response)
+
+    def _get_rendered(self, request, iformat, host_url, context):
+        """
+        Get the rendered search response, from the response cache if possible.
+
+        @param request: a HTTP request
+        @param iformat: the requested format of data
+        @param host_url (str): the URL of the opensearch host
+        @param context (dict): the query parameters from the users request plus
+            defaults from the OSQuery.
+
+        @return a tuple containing the body, the etag, the time the body
+            was rendered and the value of a Warning header if the results are
+            stale or partial, otherwise None. The body is either bytes or,
+            when the atom entries are streamed, an iterator of bytes.
+            Responses with a warning are not cached.
+
+        @raise Http304 if the results found match the If-None-Match header of
+            the request, before they are rendered
+
+        """
+        cache = CedaOpensearchMiddleware.get_response_cache()
+        raw = RESPONSE_RAW_JSON and iformat == 'json'
+        pretty = raw and is_pretty(request)
+        key = (iformat, host_url, canonical_context(context), pretty)
+        bypass_cache = _bypass_cache(request)
+        if not bypass_cache:
+            rendered = cache.get(key)
+            if rendered is not None:
+                return rendered + (None,)
+
+        stream = RESPONSE_STREAM_ATOM and iformat == 'atom'
+        with search_options(source_fields=get_source_fields(iformat),
+                            bypass_cache=bypass_cache,
+                            stream=stream, raw=raw, pretty=pretty,
+                            deadline=get_deadline(request),
+                            if_none_match=get_if_none_match(request),
+                            iformat=iformat) as options:
+            start = time.monotonic()
+            body = (CedaOpensearchMiddleware.get_osengine()
+                    .do_search(host_url, iformat, context))
+            observe_stage('render', time.monotonic() - start -
+                          options.get('search_seconds', 0))
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        last_modified = int(time.time())
+
+        warning = None
+        if options.get('stale'):
+            warning = STALE_WARNING
+        elif options.get('timed_out'):
+            warning = PARTIAL_WARNING
+        if warning is not None:
+            cache = None
+
+        if options.get('entries') is not None:
+            return (_stream_entries(body, options['entries'], cache, key,
+                                    options['etag'], last_modified),
+                    options['etag'], last_modified, warning)
+
+        rendered = (body, options['etag'], last_modified)
+        if cache is not None:
+            cache.set(key, rendered, len(body))
+        return rendered + (warning,)
 
     def options(self, request, iformat):
         """
@@ -107,6 +281,181 @@ class OpenSearch(View):
         return response
 
 
+class BatchSearch(View):
+    """
+    Handle requests for several searches at once.
+
+    """
+    @method_decorator(csrf_exempt)
+    def dispatch(self, *args, **kwargs):
+        """
+        Override View.dspatch in order to use decorator.
+
+        """
+        return super(BatchSearch, self).dispatch(*args, **kwargs)
+
+    def post(self, request):
+        """
+        Run the searches in the body of the request, with a single request to
+        elastic search.
+
+        The body is json, either a list of objects of search parameters or an
+        object with a 'queries' list. The response is a json object with a
+        'responses' list, in the same order, containing the results of each
+        search or an 'error' message. The results of a search that timed
+        out, or that are stale as elastic search is unavailable, are marked
+        and the response has a Warning header.
+
+        @param request: a HTTP request
+
+        """
+        try:
+            contexts = self._get_contexts(request)
+            with search_options(deadline=get_deadline(request)):
+                results = elastic_search.get_multi_search_results(
+                    [context for context in contexts
+                     if not isinstance(context, Http400)],
+                    bypass_cache=_bypass_cache(request))
+        except Http400 as ex:
+            LOGGING.debug(ex.message)
+            return HttpResponseBadRequest(reason=ex.message)
+        except Http503 as ex:
+            return ServiceUnavailable(reason=ex.message,
+                                      retry_after=ex.retry_after)
+
+        results = iter(results)
+        responses = []
+        warning = None
+        for context in contexts:
+            result = context if isinstance(context, Http400) else next(results)
+            if isinstance(result, (Http400, Http503)):
+                responses.append({'error': result.message})
+                continue
+            hits, timed_out, stale = result
+            response = self._get_response(context, hits)
+            response['timedOut'] = timed_out
+            if stale:
+                response['stale'] = True
+                warning = STALE_WARNING
+            elif timed_out and warning is None:
+                warning = PARTIAL_WARNING
+            responses.append(response)
+        response = HttpResponse(json.dumps({'responses': responses}),
+                                content_type=get_mime_type('json'))
+        if warning is not None:
+            response['Warning'] = warning
+        return response
+
+    def _get_contexts(self, request):
+        """
+        Get the context of each search in the body of the request.
+
+        @param request: a HTTP request
+
+        @return a list containing the context of each search, or an Http400
+            if the parameters of a search are not valid
+
+        """
+        try:
+            body = json.loads(request.body.decode('utf-8'))
+        except ValueError:
+            raise Http400('The body of the request is not valid json')
+        if isinstance(body, dict):
+            body = body.get('queries')
+        if not isinstance(body, list):
+            raise Http400('The body of the request must contain a list of '
+                          'queries')
+        if len(body) > BATCH_SEARCH_MAX_QUERIES:
+            raise Http400('A maximum of {} queries can be requested at '
+                          'once'.format(BATCH_SEARCH_MAX_QUERIES))
+
+        contexts = []
+        for params in body:
+            if not isinstance(params, dict):
+                contexts.append(Http400('Each query must be an object'))
+                continue
+            try:
+                contexts.append(get_context(
+                    {key: str(value) for key, value in params.items()
+                     if value is not None}))
+            except ValueError:
+                contexts.append(Http400('maximumRecords must be an integer'))
+        return contexts
+
+    def _get_response(self, context, result):
+        """
+        Get the json serializable response for the results of one search.
+
+        @param context (dict): the query parameters of the search
+        @param result (tuple): the results as returned by get_search_results
+
+        @return a dict
+
+        """
+        hits, total_count, relation = result
+        count, start_index, start_page = import_count_and_page(context)
+        response = {'totalResults': total_count,
+                    'relation': relation,
+                    'startIndex': get_index(count, start_index, start_page),
+                    'itemsPerPage': count,
+                    'rows': [hit.to_dict() for hit in hits]}
+        if context.get('cursor'):
+            response['cursor'] = hits.next_cursor
+        return response
+
+
+class Facets(View):
+    """
+    Handle requests for the number of results for each value of a parameter.
+
+    """
+    @method_decorator(csrf_exempt)
+    def dispatch(self, *args, **kwargs):
+        """
+        Override View.dspatch in order to use decorator.
+
+        """
+        return super(Facets, self).dispatch(*args, **kwargs)
+
+    def get(self, request):
+        """
+        Count the results of the search, and the results for each value of the
+        facets, in json.
+
+        The facets are given as a comma separated list in the 'facets'
+        parameter, an empty value only counts the results.
+
+        @param request: a HTTP request
+
+        """
+        context = update_context(request)
+        facets = request.GET.get('facets')
+        if facets is None:
+            facets = elastic_search.DEFAULT_FACETS
+        else:
+            facets = [facet for facet in facets.split(',') if facet]
+        try:
+            with search_options(deadline=get_deadline(request)):
+                counts, total, relation = elastic_search.get_facets(
+                    context, facets)
+        except Http400 as ex:
+            LOGGING.debug(ex.message)
+            return HttpResponseBadRequest(reason=ex.message)
+        except Http503 as ex:
+            return ServiceUnavailable(reason=ex.message,
+                                      retry_after=ex.retry_after)
+
+        jsondoc = {'totalResults': total, 'relation': relation,
+                   'facets': {name: [{'value': value, 'count': count}
+                                     for value, count in values]
+                              for name, values in counts.items()}}
+        response = HttpResponse(json.dumps(jsondoc),
+                                content_type=get_mime_type('json'))
+        patch_cache_control(response, public=True,
+                            max_age=RESPONSE_CACHE_MAX_AGE)
+        return response
+
+
 class Description(View):
     """
     Handle requests for the description document.
@@ -128,13 +477,65 @@ class Description(View):
 
         """
         host_url = build_host_url(request)
-        response = (CedaOpensearchMiddleware.get_osengine()
-                    .get_description(host_url))
-        context = {}
-        context['response'] = mark_safe(response)
-        context.update(csrf(request))
-        return render_to_response('responseTemplate.html', context,
-                                  content_type=OS_DESCRIPTION_TYPE)
+        body, etag, last_modified = self._get_rendered(request, host_url)
+        response = HttpResponse(body, content_type=OS_DESCRIPTION_TYPE)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, public=True,
+                            max_age=DESCRIPTION_CACHE_MAX_AGE)
+        return get_conditional_response(request, etag=etag,
+                                        last_modified=last_modified,
+                                        response=response)
+
+    def _get_rendered(self, request, host_url):
+        """
+        Get the rendered description document, from the description cache if
+        possible.
+
+        The document is only cached if the parameter options could be read
+        from elastic search, so that it is not stuck with the default options
+        after an outage.
+
+        @param request: a HTTP request
+        @param host_url (str): the URL of the opensearch host
+
+        @return a tuple containing the body, the etag and the time the body
+            was rendered
+
+        """
+        cache = CedaOpensearchMiddleware.get_description_cache()
+        rendered = cache.get(host_url)
+        if rendered is not None:
+            return rendered
+
+        parameter_values = None
+        if DESCRIPTION_DYNAMIC_OPTIONS:
+            try:
+                with search_options(deadline=get_deadline(request)):
+                    parameter_values = elastic_search.get_parameter_values(
+                        DESCRIPTION_OPTION_PARAMETERS)
+            except (Http400, Http503) as ex:
+                LOGGING.warning("Using the default parameter options. %s",
+                                ex.message)
+            except (TransportError, KeyError, AttributeError, TypeError,
+                    ValueError) as ex:
+                # e.g. a facet field missing from the mapping, or a response
+                # without the expected aggregations
+                LOGGING.warning("Using the default parameter options. %r",
+                                ex)
+        with search_options(parameter_values=parameter_values):
+            description = (CedaOpensearchMiddleware.get_osengine()
+                           .get_description(host_url))
+        body = render_to_string('responseTemplate.html',
+                                {'response': mark_safe(description)})
+        body = body.encode('utf-8')
+        # the etag only changes when the content does, even though the
+        # document is rendered again when it expires from the cache
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        rendered = (body, etag, int(time.time()))
+        if parameter_values is not None or not DESCRIPTION_DYNAMIC_OPTIONS:
+            cache.set(host_url, rendered, len(body))
+        return rendered
 
     def options(self, request):
         """
@@ -169,9 +570,28 @@ class Resource(View):
         @param iformat: the requested format of data
 
         """
-        response = get_resource(request, iformat)
+        try:
+            with search_options(deadline=get_deadline(request),
+                                iformat=iformat):
+                response = get_resource(request, iformat)
+        except Http400 as ex:
+            LOGGING.debug(ex.message)
+            return HttpResponseBadRequest(reason=ex.message)
+        except Http503 as ex:
+            return ServiceUnavailable(reason=ex.message,
+                                      retry_after=ex.retry_after)
         return HttpResponse(response, content_type=get_mime_type(iformat))
 
+    def post(self, request, iformat):
+        """
+        Get the resources for a list of uids given in the body.
+
+        @param request: a HTTP request
+        @param iformat: the requested format of data
+
+        """
+        return self.get(request, iformat)
+
     def options(self, request, iformat):
         """
         Handles responding to requests for the OPTIONS HTTP verb.
@@ -186,6 +606,23 @@ class Resource(View):
         return response
 
 
+class Metrics(View):
+    """
+    Handle requests for the metrics of this process.
+
+    """
+
+    def get(self, request):
+        """
+        Get the latency histograms and statistics in the Prometheus text
+        exposition format.
+
+        @param request: a HTTP request
+
+        """
+        return HttpResponse(render_metrics(), content_type=METRICS_TYPE)
+
+
 class Index(View):
     """
     Handle requests for the index page.
@@ -220,35 +657,28 @@ class Status(TemplateView):
         """
         Present the results of the example queries on a test page.
 
+        If the checks are run in the background the latest results are shown,
+        otherwise the checks are run now.
+
         """
-        results = []
-        for example_parameters in EXAMPLE_PARAMETERS:
-            params = example_parameters.split('&')
-            context = dict(BASE_CONTEXT)
-            for param in params:
-                key, value = param.split('=')
-                context[key] = value
+        runner = CedaOpensearchMiddleware.get_status_runner()
+        snapshot = None
+        if runner is not None:
+            snapshot = runner.get_snapshot(STATUS_SNAPSHOT_TIMEOUT)
+        if snapshot is None:
             try:
-                _, total_hits, relation = (elastic_search.get_search_results(context))
-            except (RequestError) as ex:
-                results.append({'test': example_parameters, 'status': 'ERROR',
-                                'message': ex})
-                continue
-            except Http400 as ex:
-                LOGGING.error(ex.message)
-                context = {'message': ex.message}
-                return render_to_response('400.html', context, status=400)
+                snapshot = run_status_checks()
             except Http503 as ex:
-                return ServiceUnavailable(reason=ex.message)
-            if total_hits > 0:
-                results.append({'test': example_parameters, 'status': 'OK',
-                                'message': '{} {} results found'.
-                                format(relation, total_hits)})
-            else:
-                results.append({'test': example_parameters,
-                                'status': 'WARNING',
-                                'message': ' No results returned'})
-
-        context = {'status': results, 'es_index': ELASTIC_INDEX}
+                return ServiceUnavailable(reason=ex.message,
+                                          retry_after=ex.retry_after)
+        if 'error' in snapshot:
+            return ServiceUnavailable(reason=snapshot['error'])
+
+        context = {'status': snapshot['status'], 'es_index': ELASTIC_INDEX,
+                   'checked': datetime.datetime.utcfromtimestamp(
+                       snapshot['time']),
+                   'took': snapshot['took'],
+                   'pools': get_pool_stats(
+                       CedaOpensearchMiddleware.get_elasticsearch())}
         return render_to_response('status.html', context,
                                   content_type='text/html')